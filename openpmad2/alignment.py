@@ -0,0 +1,601 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+def detectPulses(signal, timestamps=None, fs=None, threshold=None, minimumWidth=0):
+    """
+    Find the pulses in a photodiode trace or digital line
+
+    keywords
+    --------
+    signal
+        Array of samples
+    timestamps
+        Timestamp of each sample (computed from fs if None)
+    fs
+        Sampling rate (in Hz)
+    threshold
+        Signals above the threshold are high (halfway between the 1st and
+        99th percentiles of the signal if None)
+    minimumWidth
+        Pulses shorter than this are discarded (in seconds)
+
+    returns
+    -------
+    onsets
+        Time of the rising edge of each pulse (interpolated between samples)
+    offsets
+        Time of the falling edge of each pulse (interpolated between samples)
+    """
+
+    signal = np.asarray(signal, dtype=np.float64).flatten()
+    if timestamps is None:
+        if fs is None:
+            raise Exception('Either the timestamps or the sampling rate must be specified')
+        timestamps = np.arange(signal.size) / fs
+    else:
+        timestamps = np.asarray(timestamps, dtype=np.float64).flatten()
+
+    #
+    if threshold is None:
+        low, high = np.percentile(signal, [1, 99])
+        threshold = (low + high) / 2
+    states = (signal > threshold).astype(np.int8)
+    transitions = np.diff(states)
+    risingIndices = np.flatnonzero(transitions == 1)
+    fallingIndices = np.flatnonzero(transitions == -1)
+
+    # Pulses which are cut off by the start or end of the recording are ignored
+    if fallingIndices.size != 0 and risingIndices.size != 0 and fallingIndices[0] < risingIndices[0]:
+        fallingIndices = fallingIndices[1:]
+    risingIndices = risingIndices[:fallingIndices.size]
+
+    # Linear interpolation of the threshold crossing
+    def interpolate(indices):
+        s0, s1 = signal[indices], signal[indices + 1]
+        t0, t1 = timestamps[indices], timestamps[indices + 1]
+        fraction = (threshold - s0) / (s1 - s0)
+        return t0 + fraction * (t1 - t0)
+
+    onsets, offsets = interpolate(risingIndices), interpolate(fallingIndices)
+    mask = offsets - onsets >= minimumWidth
+
+    return onsets[mask], offsets[mask]
+
+def decodePulseWidths(onsets, offsets, fps=60, levels=None):
+    """
+    Convert the width of each pulse into a number of frames
+
+    keywords
+    --------
+    levels
+        Valid pulse widths (in frames), e.g., (2, 3, 6, 15); each width is
+        snapped to the nearest level
+
+    returns
+    -------
+    widths
+        Width of each pulse (in frames)
+    errors
+        Difference between the measured width and the decoded width (in frames)
+    """
+
+    frames = (np.asarray(offsets) - np.asarray(onsets)) * fps
+    if levels is None:
+        widths = np.around(frames).astype(np.int64)
+    else:
+        levels = np.sort(np.asarray(levels, dtype=np.int64))
+        widths = levels[np.argmin(np.abs(frames.reshape(-1, 1) - levels), axis=1)]
+    errors = frames - widths
+
+    return widths, errors
+
+def extractSignalEvents(records, field='state'):
+    """
+    Find the signal events in the per-frame records of a frame sidecar or
+    stimulus state log (see writing.readFrameSidecar and writing.readStateLog)
+
+    returns
+    -------
+    flipTimes
+        Flip timestamp of the first frame of each event
+    widths
+        Duration of each event (in frames)
+    codes
+        Event code of each event (zero if the records do not have codes)
+    """
+
+    states = np.concatenate([[0], np.asarray(records[field]) > 0, [0]]).astype(np.int8)
+    transitions = np.diff(states)
+    onsetIndices = np.flatnonzero(transitions == 1)
+    offsetIndices = np.flatnonzero(transitions == -1)
+    flipTimes = np.asarray(records['timestamp'])[onsetIndices]
+    widths = offsetIndices - onsetIndices
+    if 'code' in records.dtype.names:
+        codes = np.asarray(records['code'])[onsetIndices]
+    else:
+        codes = np.zeros(onsetIndices.size, dtype=np.int16)
+
+    return flipTimes, widths, codes
+
+def _scoreOffsets(referenceTimes, referenceWidths, times, widths, nIntervals, tolerance):
+    """
+    Score the non-negative offsets of a sequence of pulses relative to a
+    reference (the fraction of the first intervals and widths which match)
+    """
+
+    nOffsets = referenceTimes.size - nIntervals
+    if nOffsets <= 0:
+        return np.zeros(0)
+    intervals = np.diff(times[:nIntervals + 1])
+    referenceIntervals = sliding_window_view(np.diff(referenceTimes), nIntervals)[:nOffsets]
+    intervalMatches = (np.abs(referenceIntervals - intervals) <= tolerance).sum(axis=1)
+    widthMatches = (sliding_window_view(referenceWidths, nIntervals + 1)[:nOffsets] == widths[:nIntervals + 1]).sum(axis=1)
+    scores = (intervalMatches + widthMatches) / (2 * nIntervals + 1)
+
+    return scores
+
+def findSequenceOffset(
+    referenceTimes,
+    referenceWidths,
+    times,
+    widths,
+    tolerance,
+    nIntervals=32,
+    ):
+    """
+    Find the offset of a sequence of pulses which best matches the reference
+    sequence (e.g., when the recording started late or ended early)
+
+    Pulses are compared by the intervals between their onsets as well as by
+    their widths, so sequences of identical pulses can still be paired.
+
+    keywords
+    --------
+    referenceTimes, referenceWidths
+        Onset (flip) time and width (in frames) of the logged events
+    times, widths
+        Onset time and width (in frames) of the detected pulses
+    tolerance
+        Maximum difference between two matching intervals (in seconds)
+    nIntervals
+        Number of intervals compared at each offset
+
+    returns
+    -------
+    offset
+        Index of the reference which corresponds to the first pulse (negative
+        if the first pulses precede the first event)
+    agreement
+        Fraction of the intervals and widths which match at that offset
+    """
+
+    referenceTimes, times = np.asarray(referenceTimes, dtype=np.float64), np.asarray(times, dtype=np.float64)
+    referenceWidths, widths = np.asarray(referenceWidths), np.asarray(widths)
+    nIntervals = min(nIntervals, referenceTimes.size - 1, times.size - 1)
+    if nIntervals < 1:
+        raise Exception('At least two events and two pulses are required to pair them')
+
+    # Offsets of the pulses relative to the events and vice versa
+    forward = _scoreOffsets(referenceTimes, referenceWidths, times, widths, nIntervals, tolerance)
+    backward = _scoreOffsets(times, widths, referenceTimes, referenceWidths, nIntervals, tolerance)[1:]
+    offsets = np.concatenate([np.arange(forward.size), -1 - np.arange(backward.size)])
+    scores = np.concatenate([forward, backward])
+    if scores.size == 0:
+        scores = np.zeros(1)
+        offsets = np.zeros(1, dtype=np.int64)
+
+    #
+    best = np.flatnonzero(scores == scores.max())
+    if best.size > 1:
+        best = _breakTie(referenceTimes, times, offsets, best, tolerance)
+    offset = int(offsets[best])
+    agreement = scores[best]
+
+    return offset, agreement
+
+def _breakTie(referenceTimes, times, offsets, candidates, tolerance):
+    """
+    Choose between offsets which match equally well (e.g., periodic events)
+
+    If there are as many pulses as events, the offset of zero wins. Otherwise
+    the offsets which pair the most pulses are kept, and the one for which the
+    span between the first and last paired pulse best matches the span of the
+    paired events wins.
+
+    returns
+    -------
+    index
+        Index (in offsets) of the chosen offset
+    """
+
+    if times.size == referenceTimes.size and np.any(offsets[candidates] == 0):
+        return int(candidates[np.flatnonzero(offsets[candidates] == 0)[0]])
+
+    #
+    nPairs, spanErrors = list(), list()
+    for offset in offsets[candidates]:
+        first = max(0, -offset)
+        last = min(times.size, referenceTimes.size - offset) - 1
+        nPairs.append(last - first + 1)
+        spanErrors.append(abs(
+            (times[last] - times[first]) - (referenceTimes[last + offset] - referenceTimes[first + offset])
+        ))
+    nPairs, spanErrors = np.array(nPairs), np.array(spanErrors)
+
+    #
+    remaining = np.flatnonzero(nPairs == nPairs.max())
+    remaining = remaining[spanErrors[remaining] <= spanErrors[remaining].min() + tolerance]
+    if remaining.size > 1:
+        raise Exception(f'The pulses match the events equally well at {remaining.size} offsets (e.g., the events are periodic and the recording is incomplete)')
+
+    return int(candidates[remaining[0]])
+
+def fitClock(flipTimes, acquisitionTimes, degree=1):
+    """
+    Fit a polynomial which maps flip timestamps onto acquisition time
+
+    returns
+    -------
+    coefficients
+        Coefficients of the polynomial (highest degree first, see np.polyfit)
+    residuals
+        Residual of each pair (in seconds)
+    """
+
+    flipTimes = np.asarray(flipTimes, dtype=np.float64)
+    acquisitionTimes = np.asarray(acquisitionTimes, dtype=np.float64)
+    if flipTimes.size <= degree:
+        raise Exception(f'At least {degree + 1} events are required to fit the clock')
+    coefficients = np.polyfit(flipTimes, acquisitionTimes, degree)
+    residuals = acquisitionTimes - np.polyval(coefficients, flipTimes)
+
+    return coefficients, residuals
+
+def alignEvents(
+    signal,
+    records,
+    timestamps=None,
+    fs=None,
+    fps=60,
+    threshold=None,
+    levels=None,
+    degree=1,
+    minimumAgreement=0.9,
+    tolerance=None,
+    ):
+    """
+    Align the signal events of a session with an acquisition system
+
+    keywords
+    --------
+    signal
+        Photodiode trace or digital line recorded by the acquisition system
+    records
+        Records of the frame sidecar or stimulus state log
+    timestamps
+        Timestamp of each sample (computed from fs if None)
+    fs
+        Sampling rate of the acquisition system (in Hz)
+    fps
+        Frame rate of the display
+    threshold
+        Threshold for the signal (see detectPulses)
+    levels
+        Valid pulse widths (in frames, see decodePulseWidths)
+    degree
+        Degree of the clock model
+    minimumAgreement
+        Minimum fraction of the pulse intervals and widths which must match
+        the records (and of the pairs which must fit the clock model)
+    tolerance
+        Maximum timing error of a pair (in seconds, half a frame if None)
+
+    returns
+    -------
+    result
+        Dictionary with the acquisition time of each event (NaN if the event
+        was not recorded or was rejected), the clock model and the residual
+        statistics
+    """
+
+    #
+    onsets, offsets = detectPulses(signal, timestamps, fs, threshold, minimumWidth=0.5 / fps)
+    if onsets.size == 0:
+        raise Exception('No pulses detected in the signal')
+    widths, errors = decodePulseWidths(onsets, offsets, fps, levels)
+    flipTimes, expectedWidths, codes = extractSignalEvents(
+        records,
+        field='patch' if 'patch' in records.dtype.names else 'state'
+    )
+
+    # Pair the detected pulses with the logged events
+    if tolerance is None:
+        tolerance = 0.5 / fps
+    offset, agreement = findSequenceOffset(flipTimes, expectedWidths, onsets, widths, tolerance)
+    if agreement < minimumAgreement:
+        raise Exception(f'Only {agreement * 100:.1f}% of the pulse intervals and widths match the records')
+    if offset >= 0:
+        eventIndices = np.arange(widths.size) + offset
+        pulseIndices = np.arange(widths.size)
+    else:
+        eventIndices = np.arange(expectedWidths.size)
+        pulseIndices = np.arange(expectedWidths.size) - offset
+    valid = (eventIndices < expectedWidths.size) & (pulseIndices < widths.size)
+    eventIndices, pulseIndices = eventIndices[valid], pulseIndices[valid]
+    matched = expectedWidths[eventIndices] == widths[pulseIndices]
+
+    # Pairs which are inconsistent with the clock model (e.g., a missed or
+    # spurious pulse further along the recording) are rejected
+    coefficients, residuals = fitClock(
+        flipTimes[eventIndices[matched]],
+        onsets[pulseIndices[matched]],
+        degree
+    )
+    residuals = onsets[pulseIndices] - np.polyval(coefficients, flipTimes[eventIndices])
+    matched = matched & (np.abs(residuals - np.median(residuals[matched])) <= tolerance)
+    if matched.sum() < minimumAgreement * eventIndices.size:
+        raise Exception(f'Only {matched.sum()} of {eventIndices.size} paired events are consistent with the clock model')
+    coefficients, residuals = fitClock(
+        flipTimes[eventIndices[matched]],
+        onsets[pulseIndices[matched]],
+        degree
+    )
+    eventTimes = np.full(flipTimes.size, np.nan)
+    eventTimes[eventIndices[matched]] = onsets[pulseIndices[matched]]
+
+    #
+    result = {
+        'eventTimes': eventTimes,
+        'predictedTimes': np.polyval(coefficients, flipTimes),
+        'codes': codes,
+        'widths': expectedWidths,
+        'coefficients': coefficients,
+        'residuals': residuals,
+        'residualMean': residuals.mean(),
+        'residualStd': residuals.std(),
+        'residualMax': np.abs(residuals).max(),
+        'widthErrors': errors[pulseIndices],
+        'nEvents': flipTimes.size,
+        'nPulses': onsets.size,
+        'nMatched': int(matched.sum()),
+        'offset': offset,
+    }
+
+    return result
+
+BARCODE_MARKER = (1, 0, 1)
+
+def _barcodeChecksum(symbols, nLevels, checkSymbols):
+    """
+    Weighted sum of the payload symbols (catches single errors and swaps)
+    """
+
+    weights = np.arange(1, len(symbols) + 1)
+    checksum = int(np.dot(np.asarray(symbols, dtype=np.int64), weights)) % (nLevels ** checkSymbols)
+
+    return _toSymbols(checksum, checkSymbols, nLevels)
+
+def _toSymbols(value, nSymbols, nLevels):
+    """
+    Digits of a value in base nLevels (most significant first)
+    """
+
+    symbols = [(int(value) // (nLevels ** iSymbol)) % nLevels for iSymbol in range(nSymbols)][::-1]
+
+    return symbols
+
+def _fromSymbols(symbols, nLevels):
+    """
+    """
+
+    value = 0
+    for symbol in symbols:
+        value = value * nLevels + int(symbol)
+
+    return value
+
+def _barcodeLayout(typeBits, indexBits, checkBits, bitsPerFrame):
+    """
+    Number of frames of the type, index and checksum fields
+    """
+
+    if typeBits % bitsPerFrame or indexBits % bitsPerFrame or checkBits % bitsPerFrame:
+        raise Exception('The number of bits of each field must be a multiple of the bits per frame')
+
+    return typeBits // bitsPerFrame, indexBits // bitsPerFrame, checkBits // bitsPerFrame
+
+def encodeEventBarcode(
+    eventType,
+    trialIndex=0,
+    typeBits=2,
+    indexBits=4,
+    checkBits=2,
+    bitsPerFrame=1,
+    ):
+    """
+    Encode an event as a sequence of signal patch levels (one per frame)
+
+    The barcode starts with a short alternating marker (which plain signal
+    events only produce if they are a single frame long and a single frame
+    apart, in which case the checksum rejects them), followed by the event
+    type, the trial index (modulo 2 ** indexBits), a checksum and a single low
+    frame. With more than one bit per frame the patch takes 2 ** bitsPerFrame
+    intensity levels, which requires an analog (photodiode) recording to
+    decode.
+
+    The default layout takes 12 frames (8 frames with 2 bits per frame), so
+    plain pulses remain the cheaper way to signal events whose identity
+    follows from their order; widen the fields for more event types or trials.
+
+    returns
+    -------
+    symbols
+        Patch level on each frame (0 is low and 2 ** bitsPerFrame - 1 is high)
+    """
+
+    nLevels = 2 ** bitsPerFrame
+    nTypeSymbols, nIndexSymbols, nCheckSymbols = _barcodeLayout(typeBits, indexBits, checkBits, bitsPerFrame)
+    if eventType < 0 or eventType >= 2 ** typeBits:
+        raise Exception(f'Event type must be in the range [0, {2 ** typeBits})')
+
+    #
+    payload = _toSymbols(eventType, nTypeSymbols, nLevels) + _toSymbols(trialIndex % (2 ** indexBits), nIndexSymbols, nLevels)
+    marker = [symbol * (nLevels - 1) for symbol in BARCODE_MARKER]
+    symbols = np.array(marker + payload + _barcodeChecksum(payload, nLevels, nCheckSymbols) + [0], dtype=np.uint8)
+
+    return symbols
+
+def _decodeBarcode(symbols, nLevels, nTypeSymbols, nIndexSymbols, nCheckSymbols):
+    """
+    Decode the symbols which follow a marker
+
+    returns
+    -------
+    eventType, trialIndex, valid
+    """
+
+    nPayload = nTypeSymbols + nIndexSymbols
+    payload = [int(symbol) for symbol in symbols[:nPayload]]
+    checksum = [int(symbol) for symbol in symbols[nPayload: nPayload + nCheckSymbols]]
+    valid = checksum == _barcodeChecksum(payload, nLevels, nCheckSymbols)
+    eventType = _fromSymbols(payload[:nTypeSymbols], nLevels)
+    trialIndex = _fromSymbols(payload[nTypeSymbols:], nLevels)
+
+    return eventType, trialIndex, valid
+
+def decodeBarcodesFromRecords(
+    records,
+    typeBits=2,
+    indexBits=4,
+    checkBits=2,
+    bitsPerFrame=1,
+    field=None,
+    ):
+    """
+    Decode the event barcodes in a frame sidecar or stimulus state log
+
+    returns
+    -------
+    barcodes
+        Dictionary with the frame index, flip timestamp, event type and trial
+        index of each barcode which passed the checksum
+    """
+
+    nLevels = 2 ** bitsPerFrame
+    nTypeSymbols, nIndexSymbols, nCheckSymbols = _barcodeLayout(typeBits, indexBits, checkBits, bitsPerFrame)
+    nFrames = len(BARCODE_MARKER) + nTypeSymbols + nIndexSymbols + nCheckSymbols + 1
+    if field is None:
+        field = 'patch' if 'patch' in records.dtype.names else 'state'
+    symbols = np.asarray(records[field]).astype(np.int64)
+
+    # Candidate markers (which start on a rising edge, like in the signal)
+    marker = np.array(BARCODE_MARKER) * (nLevels - 1)
+    if symbols.size < nFrames:
+        candidates = np.array([], dtype=np.int64)
+    else:
+        windows = sliding_window_view(symbols, marker.size)
+        rising = np.concatenate([[True], symbols[:-1] == 0])[:windows.shape[0]]
+        candidates = np.flatnonzero((windows == marker).all(axis=1) & rising)
+
+    #
+    decoded = list()
+    nextFrame = 0
+    for start in candidates:
+        if start < nextFrame or start + nFrames > symbols.size:
+            continue
+        eventType, trialIndex, valid = _decodeBarcode(
+            symbols[start + marker.size:],
+            nLevels,
+            nTypeSymbols,
+            nIndexSymbols,
+            nCheckSymbols
+        )
+        if valid:
+            decoded.append((start, eventType, trialIndex))
+            nextFrame = start + nFrames
+
+    #
+    decoded = np.array(decoded, dtype=np.int64).reshape(-1, 3)
+    barcodes = {
+        'frameIndices': decoded[:, 0],
+        'flipTimes': np.asarray(records['timestamp'])[decoded[:, 0]],
+        'eventTypes': decoded[:, 1],
+        'trialIndices': decoded[:, 2],
+    }
+
+    return barcodes
+
+def decodeBarcodesFromSignal(
+    signal,
+    timestamps=None,
+    fs=None,
+    fps=60,
+    typeBits=2,
+    indexBits=4,
+    checkBits=2,
+    bitsPerFrame=1,
+    ):
+    """
+    Decode the event barcodes in a photodiode trace or digital line
+
+    The signal is normalized between its 1st and 99th percentiles and sampled
+    in the middle of each frame following the rising edge of a marker.
+
+    returns
+    -------
+    barcodes
+        Dictionary with the onset time, event type and trial index of each
+        barcode which passed the checksum, and the number of rejected markers
+    """
+
+    signal = np.asarray(signal, dtype=np.float64).flatten()
+    if timestamps is None:
+        if fs is None:
+            raise Exception('Either the timestamps or the sampling rate must be specified')
+        timestamps = np.arange(signal.size) / fs
+    else:
+        timestamps = np.asarray(timestamps, dtype=np.float64).flatten()
+
+    #
+    nLevels = 2 ** bitsPerFrame
+    nTypeSymbols, nIndexSymbols, nCheckSymbols = _barcodeLayout(typeBits, indexBits, checkBits, bitsPerFrame)
+    nFrames = len(BARCODE_MARKER) + nTypeSymbols + nIndexSymbols + nCheckSymbols + 1
+    low, high = np.percentile(signal, [1, 99])
+    onsets, offsets = detectPulses(signal, timestamps, threshold=(low + high) / 2)
+    marker = np.array(BARCODE_MARKER) * (nLevels - 1)
+    frameCenters = (np.arange(nFrames) + 0.5) / fps
+
+    #
+    decoded = list()
+    rejected = 0
+    nextOnset = -np.inf
+    for onset in onsets:
+        if onset < nextOnset:
+            continue
+        levels = (np.interp(onset + frameCenters, timestamps, signal) - low) / (high - low)
+        symbols = np.clip(np.around(levels * (nLevels - 1)), 0, nLevels - 1).astype(np.int64)
+        if not np.array_equal(symbols[:marker.size], marker):
+            continue
+        eventType, trialIndex, valid = _decodeBarcode(
+            symbols[marker.size:],
+            nLevels,
+            nTypeSymbols,
+            nIndexSymbols,
+            nCheckSymbols
+        )
+        if valid:
+            decoded.append((onset, eventType, trialIndex))
+            nextOnset = onset + (nFrames - 1) / fps
+        else:
+            rejected += 1
+
+    #
+    decoded = np.array(decoded, dtype=np.float64).reshape(-1, 3)
+    barcodes = {
+        'onsets': decoded[:, 0],
+        'eventTypes': decoded[:, 1].astype(np.int64),
+        'trialIndices': decoded[:, 2].astype(np.int64),
+        'rejected': rejected,
+    }
+
+    return barcodes
@@ -0,0 +1,324 @@
+import numpy as np
+import multiprocessing as mp
+
+def selectTrials(metadata, jittered=False):
+    """
+    Select the trials of a noise protocol by whether the grid was jittered
+
+    keywords
+    --------
+    metadata
+        The metadata dict produced by SparseNoise or JitteredBinaryNoise2
+    jittered
+        Select the jittered (True) or unjittered (False) trials, or all of the
+        trials (None). Protocols without jittered trials are not filtered.
+
+    returns
+    -------
+    mask
+        Mask of the selected trials (None if all of the trials are selected)
+    """
+
+    if jittered is None or 'jittered' not in metadata.keys():
+        return None
+    mask = np.asarray(metadata['jittered']).flatten().astype(bool) == bool(jittered)
+
+    return mask
+
+def extractStimulusMatrix(metadata, jittered=False):
+    """
+    Collect the luminance values for each trial of a noise protocol into a
+    bit-packed stimulus matrix
+
+    keywords
+    --------
+    metadata
+        The metadata dict produced by SparseNoise or JitteredBinaryNoise2
+    jittered
+        Trials to include (see selectTrials). The jittered grid is shifted
+        relative to the unjittered grid, so by default only the unjittered
+        trials are included.
+
+    returns
+    -------
+    packed
+        Bit-packed array with shape (nTrials, ceil(nSubregions / 8)) where a
+        set bit indicates a high (white) subregion
+    nSubregions
+        The number of subregions in the grid
+    """
+
+    #
+    if 'values' in metadata.keys():
+        values = np.asarray(metadata['values'])
+        nTrials = values.shape[0]
+        mask = values.reshape(nTrials, -1) > 0
+    elif 'fields' in metadata.keys():
+        fields = np.asarray(metadata['fields'])
+        nTrials = fields.shape[0]
+        mask = fields.reshape(nTrials, -1) > 0
+    elif 'indices' in metadata.keys():
+        indices = np.asarray(metadata['indices']).flatten()
+        nTrials = indices.size
+        gridHeight, gridWidth = metadata['shape']
+        mask = np.full([nTrials, int(gridHeight * gridWidth)], False)
+        mask[np.arange(nTrials), indices] = True
+    else:
+        raise Exception('Metadata does not contain noise fields')
+
+    #
+    selected = selectTrials(metadata, jittered)
+    if selected is not None:
+        mask = mask[selected]
+    nSubregions = mask.shape[1]
+    packed = np.packbits(mask, axis=1)
+
+    return packed, nSubregions
+
+def selectFieldOnsets(metadata, eventTimestamps, jittered=False):
+    """
+    Select the timestamps for each field (or spot) onset from the full list
+    of event timestamps
+
+    keywords
+    --------
+    metadata
+        The metadata dict produced by SparseNoise or JitteredBinaryNoise2
+    eventTimestamps
+        Timestamps (in seconds) for each entry in metadata['events']
+    jittered
+        Trials to include (see selectTrials)
+    """
+
+    events = np.asarray(metadata['events']).flatten().astype(str)
+    eventTimestamps = np.asarray(eventTimestamps).flatten()
+    if events.size != eventTimestamps.size:
+        raise Exception(f'Found {eventTimestamps.size} timestamps for {events.size} events')
+    mask = np.isin(events, ('field onset', 'spot onset'))
+    fieldOnsets = eventTimestamps[mask]
+    selected = selectTrials(metadata, jittered)
+    if selected is not None:
+        fieldOnsets = fieldOnsets[selected]
+
+    return fieldOnsets
+
+def computeResponseMatrix(fieldOnsets, spikeTimes, responseWindow=(0.04, 0.14)):
+    """
+    Count the number of spikes (or calcium events) in a window following
+    each field onset
+
+    keywords
+    --------
+    fieldOnsets
+        Timestamps (in seconds) for each field onset
+    spikeTimes
+        List of spike timestamp arrays (one per unit)
+    responseWindow
+        Start and stop of the response window relative to field onset (in seconds)
+
+    returns
+    -------
+    responses
+        Array with shape (nTrials, nUnits)
+    """
+
+    fieldOnsets = np.asarray(fieldOnsets).flatten()
+    responses = np.zeros([fieldOnsets.size, len(spikeTimes)], dtype=np.float32)
+    leftEdges = fieldOnsets + responseWindow[0]
+    rightEdges = fieldOnsets + responseWindow[1]
+    for iUnit, timestamps in enumerate(spikeTimes):
+        timestamps = np.sort(np.asarray(timestamps).flatten())
+        responses[:, iUnit] = (
+            np.searchsorted(timestamps, rightEdges, side='left') -
+            np.searchsorted(timestamps, leftEdges, side='left')
+        )
+
+    return responses
+
+def _unpackChunk(packed, start, stop, nSubregions):
+    """
+    Expand a chunk of the packed stimulus matrix into luminance values (-1, 1)
+    """
+
+    bits = np.unpackbits(packed[start: stop], axis=1, count=nSubregions)
+    chunk = bits.astype(np.float32) * 2 - 1
+
+    return chunk
+
+def _computeReverseCorrelation(
+    packed,
+    nSubregions,
+    responses,
+    chunkSize=4096,
+    computeCovariance=False
+    ):
+    """
+    Compute the spike-triggered average (and covariance) for a set of units
+    by accumulating matrix products over chunks of trials
+    """
+
+    nTrials, nUnits = responses.shape
+    weightedSum = np.zeros([nSubregions, nUnits], dtype=np.float64)
+    if computeCovariance:
+        weightedOuterSum = np.zeros([nUnits, nSubregions, nSubregions], dtype=np.float64)
+    else:
+        weightedOuterSum = None
+
+    #
+    for start in range(0, nTrials, chunkSize):
+        stop = min(start + chunkSize, nTrials)
+        X = _unpackChunk(packed, start, stop, nSubregions)
+        R = responses[start: stop]
+        weightedSum += X.T @ R
+        if computeCovariance:
+            for iUnit in range(nUnits):
+                weightedOuterSum[iUnit] += (X * R[:, iUnit].reshape(-1, 1)).T @ X
+
+    #
+    spikeCounts = responses.sum(0).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sta = weightedSum / spikeCounts
+
+    #
+    stc = None
+    if computeCovariance:
+        stc = np.full([nUnits, nSubregions, nSubregions], np.nan)
+        for iUnit in range(nUnits):
+            n = spikeCounts[iUnit]
+            if n < 2:
+                continue
+            mu = sta[:, iUnit].reshape(-1, 1)
+            stc[iUnit] = (weightedOuterSum[iUnit] - n * (mu @ mu.T)) / (n - 1)
+
+    return sta.T, stc, spikeCounts
+
+# Shared state for worker processes
+_packed = None
+_nSubregions = None
+_fieldOnsets = None
+
+def _initializeWorker(packed, nSubregions, fieldOnsets):
+    """
+    """
+
+    global _packed, _nSubregions, _fieldOnsets
+    _packed = packed
+    _nSubregions = nSubregions
+    _fieldOnsets = fieldOnsets
+
+    return
+
+def _processUnits(args):
+    """
+    """
+
+    spikeTimes, responseWindow, chunkSize, computeCovariance = args
+    responses = computeResponseMatrix(_fieldOnsets, spikeTimes, responseWindow)
+    result = _computeReverseCorrelation(
+        _packed,
+        _nSubregions,
+        responses,
+        chunkSize,
+        computeCovariance
+    )
+
+    return result
+
+def computeReceptiveFields(
+    metadata,
+    fieldOnsets,
+    spikeTimes,
+    responseWindow=(0.04, 0.14),
+    chunkSize=4096,
+    nUnitsPerTask=64,
+    computeCovariance=False,
+    nProcesses=None,
+    jittered=False,
+    ):
+    """
+    Estimate receptive fields for many units with reverse correlation
+
+    keywords
+    --------
+    metadata
+        The metadata dict produced by SparseNoise or JitteredBinaryNoise2
+    fieldOnsets
+        Timestamps (in seconds) for each field onset (see selectFieldOnsets)
+    spikeTimes
+        List of spike timestamp arrays (one per unit)
+    responseWindow
+        Start and stop of the response window relative to field onset (in seconds)
+    chunkSize
+        Number of trials unpacked at once (bounds the memory footprint)
+    nUnitsPerTask
+        Number of units processed by a worker in a single task
+    computeCovariance
+        Flag which controls the computation of the spike-triggered covariance
+    nProcesses
+        Number of worker processes (1 disables multiprocessing)
+    jittered
+        Trials to include (see selectTrials). The field onsets can be given
+        for the selected trials or for all of the trials.
+
+    returns
+    -------
+    result
+        Dict with the spike-triggered average (nUnits, gridHeight, gridWidth),
+        the spike-triggered covariance (nUnits, nSubregions, nSubregions) or
+        None, and the total spike count for each unit
+    """
+
+    #
+    packed, nSubregions = extractStimulusMatrix(metadata, jittered)
+    fieldOnsets = np.asarray(fieldOnsets).flatten()
+    selected = selectTrials(metadata, jittered)
+    if selected is not None and fieldOnsets.size == selected.size:
+        fieldOnsets = fieldOnsets[selected]
+    if fieldOnsets.size != packed.shape[0]:
+        raise Exception(f'Found {fieldOnsets.size} field onsets for {packed.shape[0]} trials')
+
+    #
+    if 'shape' in metadata.keys():
+        gridShape = tuple(metadata['shape'])
+    else:
+        gridShape = np.asarray(metadata['fields']).shape[1:]
+
+    # No units to process
+    if len(spikeTimes) == 0:
+        return {
+            'sta': np.zeros([0, *gridShape]),
+            'stc': np.zeros([0, nSubregions, nSubregions]) if computeCovariance else None,
+            'counts': np.zeros(0)
+        }
+
+    #
+    tasks = list()
+    for start in range(0, len(spikeTimes), nUnitsPerTask):
+        tasks.append((
+            spikeTimes[start: start + nUnitsPerTask],
+            responseWindow,
+            chunkSize,
+            computeCovariance
+        ))
+
+    #
+    if nProcesses == 1 or len(tasks) <= 1:
+        _initializeWorker(packed, nSubregions, fieldOnsets)
+        results = [_processUnits(task) for task in tasks]
+    else:
+        with mp.Pool(nProcesses, _initializeWorker, (packed, nSubregions, fieldOnsets)) as pool:
+            results = pool.map(_processUnits, tasks)
+
+    #
+    sta = np.concatenate([result[0] for result in results], axis=0)
+    spikeCounts = np.concatenate([result[2] for result in results])
+    if computeCovariance:
+        stc = np.concatenate([result[1] for result in results], axis=0)
+    else:
+        stc = None
+
+    return {
+        'sta': sta.reshape(-1, *gridShape),
+        'stc': stc,
+        'counts': spikeCounts
+    }
@@ -1,13 +1,80 @@
-from doctest import master
 import numpy as np
 from psychopy.visual import ShapeStim
-from shapely.geometry import LineString, Polygon
 from openpmad2.bases import StimulusBase
 
+# Shapely is only needed for findBoundaryCrossingIndex
+try:
+    from shapely.geometry import LineString
+except ImportError:
+    LineString = None
+
+def computeBarTrajectories(display, stepValues, orientations, barWidthInPixels):
+    """
+    Compute the position of the bar on each frame and the frames on which the
+    leading edge appears and the trailing edge disappears
+
+    The bar is longer than the diagonal of the display, so it overlaps the
+    display whenever its extent along the axis of motion overlaps the
+    projection of the display onto that axis
+
+    keywords
+    --------
+    display
+        Any object with width and height attributes
+    stepValues
+        Distance from the center of the display along the axis of motion for each frame (in pixels)
+    orientations
+        Orientation of the bar for each trial (in degrees)
+    barWidthInPixels
+        Width of the bar (in pixels)
+
+    returns
+    -------
+    positions
+        Array with shape (nOrientations, nSteps, 2)
+    onsetIndices
+        Index of the first frame on which the bar is visible for each orientation (-1 if never)
+    offsetIndices
+        Index of the first frame on which the bar is no longer visible for each orientation (-1 if never)
+    """
+
+    stepValues = np.asarray(stepValues, dtype=float).reshape(1, -1)
+    theta = np.deg2rad(180 - np.asarray(orientations, dtype=float)).reshape(-1, 1)
+
+    #
+    positions = np.stack([
+        stepValues * np.cos(theta),
+        stepValues * np.sin(theta)
+    ], axis=-1)
+
+    # Half-length of the projection of the display onto the axis of motion
+    halfExtent = (
+        display.width  / 2 * np.abs(np.cos(theta)) +
+        display.height / 2 * np.abs(np.sin(theta))
+    )
+    visible = np.abs(stepValues) <= halfExtent + barWidthInPixels / 2
+
+    #
+    nSteps = stepValues.size
+    everVisible = visible.any(axis=1)
+    onsetIndices = np.where(everVisible, np.argmax(visible, axis=1), -1)
+    afterOnset = np.arange(nSteps).reshape(1, -1) > onsetIndices.reshape(-1, 1)
+    hidden = np.logical_and(np.invert(visible), afterOnset)
+    offsetIndices = np.where(
+        np.logical_and(everVisible, hidden.any(axis=1)),
+        np.argmax(hidden, axis=1),
+        -1
+    )
+
+    return positions, onsetIndices, offsetIndices
+
 def findBoundaryCrossingIndex(display, edge='leading', stepSize=1, motionAxisOrientation=0, motionAxisLength=1, barWidthInPixels=0):
     """
     """
 
+    if LineString is None:
+        raise Exception('Shapely is required to compute the boundary crossing index')
+
     displayBoundaryLine = LineString([
         (     display.width / 2,      display.height / 2),
         (-1 * display.width / 2,      display.height / 2),
@@ -96,14 +163,13 @@ class MovingBars(StimulusBase):
         eventID = np.nan
         recordEvent = False
 
-        #
-        displayPolygon = Polygon([
-            (     self.display.width / 2,      self.display.height / 2),
-            (-1 * self.display.width / 2,      self.display.height / 2),
-            (-1 * self.display.width / 2, -1 * self.display.height / 2),
-            (     self.display.width / 2, -1 * self.display.height / 2),
-            (     self.display.width / 2,      self.display.height / 2)
-        ])
+        # Precompute the bar positions and the frames on which the edges cross the display boundary
+        positions, onsetIndices, offsetIndices = computeBarTrajectories(
+            self.display,
+            stepValues,
+            orientations,
+            self.display.ppd * width
+        )
 
         #
         frameIndexCenterCrossed = int(np.ceil(stepValues.size / 2))
@@ -116,38 +182,28 @@ class MovingBars(StimulusBase):
         self.display.idle(3, units='seconds')
 
         #
-        for orientation in orientations:
+        for iOrientation, orientation in enumerate(orientations):
 
-            # Change the bar orientation and define the axis of motion
+            # Change the bar orientation
             bar.ori = orientation
-            theta = np.deg2rad(180 - orientation)
-            barVisible = False
 
             #
-            for frameIndex, stepValue in enumerate(stepValues):
+            for frameIndex in range(stepValues.size):
 
                 # Update the bar position
-                bar.pos = (
-                    stepValue * np.cos(theta),
-                    stepValue * np.sin(theta)
-                )
-                barPolygon = Polygon(bar.verticesPix)
-
-                # Look for the appearance of the leading edge
-                if barVisible == False:
-                    if displayPolygon.intersects(barPolygon) == True:
-                        self.display.signalEvent(0.05, units='seconds')
-                        barVisible = True
-                        recordEvent = True
-                        eventID = 1
-
-                # Look for the disappearance of the trailing edge
-                else:
-                    if displayPolygon.intersects(barPolygon) == False:
-                        self.display.signalEvent(0.05, units='seconds')
-                        barVisible = False
-                        recordEvent = True
-                        eventID = 3
+                bar.pos = positions[iOrientation, frameIndex]
+
+                # Appearance of the leading edge
+                if frameIndex == onsetIndices[iOrientation]:
+                    self.display.signalEvent(0.05, units='seconds')
+                    recordEvent = True
+                    eventID = 1
+
+                # Disappearance of the trailing edge
+                elif frameIndex == offsetIndices[iOrientation]:
+                    self.display.signalEvent(0.05, units='seconds')
+                    recordEvent = True
+                    eventID = 3
 
                 #
                 # if frameIndex == frameIndexCenterCrossed:
@@ -158,6 +214,14 @@ class MovingBars(StimulusBase):
                 #
                 self.display.drawBackground()
                 bar.draw()
+                self.display.logState(
+                    'bar',
+                    x=positions[iOrientation, frameIndex, 0],
+                    y=positions[iOrientation, frameIndex, 1],
+                    ori=orientation,
+                    size=self.display.ppd * width,
+                    value=2 * brightness - 1
+                )
                 timestamp = self.display.flip()
                 
                 #
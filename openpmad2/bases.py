@@ -12,6 +12,18 @@ class StimulusBase():
         self.header = None
         return
 
+    def generateSchedule(self, **kwargs):
+        """
+        Generate the metadata which determines the sequence of trials
+
+        Protocols which override this can have their schedule generated ahead
+        of time in another process (see session.SessionRunner) and accept it
+        through the schedule keyword of present. Only the width, height, ppd,
+        and fps of the display can be used here.
+        """
+
+        return None
+
     def prepareMetadataStream(self, sessionFolder, filename, header):
         """
         """
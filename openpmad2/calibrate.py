@@ -1,6 +1,7 @@
 import numpy as np
 import pathlib as pl
 from PIL import Image
+from scipy import ndimage
 import matplotlib as mpl
 from matplotlib import pylab as plt
 from matplotlib.widgets import Button
@@ -132,10 +133,123 @@ def collectGridPoints(
 
     return
 
-def createWarpfile(destinationCoordinates, filepath, displayShape=(720, 1280)):
+def detectGridPoints(
+    image,
+    gridShape=(11, 19),
+    displayShape=(720, 1280),
+    sigma=2,
+    polarity='bright',
+    ):
+    """
+    Detect the intersections of a calibration grid in a captured image
+
+    Grid lines are enhanced with the second derivatives of a Gaussian, so
+    intersections are the peaks of the product of the horizontal and vertical
+    line responses. Each peak is refined to sub-pixel precision by fitting a
+    parabola along each axis.
+
+    keywords
+    --------
+    image
+        Image of the grid registered to the display (i.e., its frame spans the display)
+    gridShape
+        Number of rows and columns of intersections
+    displayShape
+        Height and width of the display (in pixels)
+    sigma
+        Scale of the filters (about the half-width of a grid line in pixels)
+    polarity
+        Grid lines brighter ('bright') or darker ('dark') than the background
+
+    returns
+    -------
+    points
+        Array with shape (nPoints, 2) of centered display coordinates sorted by
+        row (bottom to top), then column (left to right), i.e., the layout
+        returned by collectGridPoints (see createWarpfile)
+    confidence
+        Score between 0 and 1 for each point (the separation between the
+        point and the strongest rejected peak)
+    """
+
+    image = np.asarray(image, dtype=float)
+    if image.ndim == 3:
+        image = image.mean(2)
+    if polarity == 'dark':
+        image = image.max() - image
+    elif polarity != 'bright':
+        raise Exception(f'{polarity} is an invalid polarity')
+    nRows, nColumns = gridShape
+    nPoints = int(nRows * nColumns)
+
+    # Ridge responses for vertical and horizontal lines
+    image = (image - image.mean()) / (image.std() + 1e-12)
+    vertical = np.clip(-1 * ndimage.gaussian_filter(image, sigma, order=(0, 2)), 0, None)
+    horizontal = np.clip(-1 * ndimage.gaussian_filter(image, sigma, order=(2, 0)), 0, None)
+    response = ndimage.gaussian_filter(vertical * horizontal, sigma / 2)
+
+    # Local maxima separated by at least half of the grid spacing
+    spacing = min(image.shape[0] / nRows, image.shape[1] / nColumns)
+    size = max(3, int(spacing / 2) | 1)
+    peaks = np.logical_and(
+        response == ndimage.maximum_filter(response, size=size, mode='constant'),
+        response > 0
+    )
+    peaks[[0, -1], :] = False
+    peaks[:, [0, -1]] = False
+    rows, columns = np.nonzero(peaks)
+    order = np.argsort(response[rows, columns])[::-1]
+    if order.size < nPoints:
+        raise Exception(f'Found only {order.size} of {nPoints} grid points')
+    accepted, rejected = order[:nPoints], order[nPoints:]
+    rows, columns = rows[accepted], columns[accepted]
+
+    # Sub-pixel refinement (vertex of a parabola through three samples)
+    center = response[rows, columns]
+    def _refine(before, after):
+        curvature = before - 2 * center + after
+        offset = np.zeros(center.size)
+        mask = curvature < 0
+        offset[mask] = 0.5 * (before[mask] - after[mask]) / curvature[mask]
+        return np.clip(offset, -0.5, 0.5)
+    dy = _refine(response[rows - 1, columns], response[rows + 1, columns])
+    dx = _refine(response[rows, columns - 1], response[rows, columns + 1])
+
+    #
+    background = np.sort(response[peaks])[::-1][nPoints] if rejected.size > 0 else 0
+    confidence = np.clip(1 - background / center, 0, 1)
+
+    # Convert to centered display coordinates (y increases upwards)
+    displayHeight, displayWidth = displayShape
+    x = (columns + dx + 0.5) * displayWidth / image.shape[1] - displayWidth / 2
+    y = displayHeight / 2 - (rows + dy + 0.5) * displayHeight / image.shape[0]
+
+    # Group the points into rows, then sort each row by x
+    index = np.argsort(y, kind='stable').reshape(nRows, nColumns)
+    index = np.take_along_axis(index, np.argsort(x[index], axis=1, kind='stable'), axis=1).flatten()
+    points = np.column_stack([x[index], y[index]])
+
+    return points, confidence[index]
+
+def createWarpfile(destinationCoordinates, filepath, displayShape=(720, 1280), writeBinary=True, gridShape=None):
     """
+    Write a warpfile from the destination coordinates of the grid points
+
+    The coordinates are either an array with shape (nRows, nColumns, 2) or a
+    flat array with shape (nPoints, 2) sorted by row, then column (e.g., the
+    output of detectGridPoints or collectGridPoints), in which case the
+    number of rows and columns must be given by gridShape
     """
 
+    destinationCoordinates = np.asarray(destinationCoordinates, dtype=float)
+    if destinationCoordinates.ndim == 2:
+        if gridShape is None:
+            raise Exception('The grid shape is required for a flat array of coordinates')
+        if destinationCoordinates.shape[0] != gridShape[0] * gridShape[1]:
+            raise Exception(f'Found {destinationCoordinates.shape[0]} points for a grid with shape {tuple(gridShape)}')
+        destinationCoordinates = destinationCoordinates.reshape(*gridShape, 2)
+
+    #
     displayHeight, displayWidth = displayShape
     aspectRatio = displayWidth / displayHeight
     nRows, nColumns = destinationCoordinates.shape[:2]
@@ -160,35 +274,20 @@ def createWarpfile(destinationCoordinates, filepath, displayShape=(720, 1280)):
     ])
 
     #
-    header = (
-        f'2\n',
-        f'{nColumns:.0f} {nRows:.0f}\n'
-    )
     data = np.ones([nPoints, 5])
     data[:, 0:2] = destinationCoordinatesNormed
     data[:, 2:4] = sourceCoordinatesNormed
-    with open(filepath, 'w') as stream:
-        for line in header:
-            stream.write(line)
-        for x1, y1, x2, y2, a in data:
-            line = f'{x1} {y1} {x2} {y2} {a}\n'
-            stream.write(line)
+    warping.writeWarpfile(filepath, data, (nRows, nColumns), writeBinary)
             
     return
 
-def loadWarpfile(filepath):
+def loadWarpfile(filepath, useBinary=True):
     """
     """
 
-    with open(filepath, 'r') as stream:
-        lines = stream.readlines()
+    data, gridShape = warping.readWarpfile(filepath, useBinary)
 
-    data = list()
-    for line in lines[2:]:
-        x1, y1, x2, y2, a = line.split()
-        data.append(list(map(float, [x1, y1, x2, y2])))
-
-    return np.around(np.array(data), 3)
+    return np.around(data[:, :4], 3)
 
 def load_sample_image(tag='horizontal-sinusoid-grating'):
     """
@@ -210,7 +309,16 @@ class ManualAdjustmentFigure():
     """
     """
 
-    def __init__(self, grid, proximity=3, allow_online_warping=True, mc='k'):
+    def __init__(
+        self,
+        grid,
+        proximity=3,
+        allow_online_warping=True,
+        mc='k',
+        previewScale=0.25,
+        display='DLPLightCrafter3010',
+        date='2022-02-02',
+        ):
         """
         """
 
@@ -242,6 +350,9 @@ class ManualAdjustmentFigure():
         #
         self.image = None
         self.button = None
+        self.previewScale = previewScale
+        self.display = display
+        self.date = date
         self.allow_online_warping = allow_online_warping
         if self.allow_online_warping:
             self._setup_online_warping()
@@ -253,10 +364,17 @@ class ManualAdjustmentFigure():
         """
 
         self.image = load_sample_image()
-        warped = warping.warp(
-            load_sample_image()
+        src, dst = warping.getCalibrationRegistry().loadLookupTable(self.display, self.date)
+        self.src = src
+        self.warper = warping.IncrementalPiecewiseWarp(self.image, src, dst)
+        self.previewWarper = warping.IncrementalPiecewiseWarp(self.image, src, dst, scale=self.previewScale)
+        self.background = self.ax.imshow(
+            self.warper.warped,
+            cmap='binary_r',
+            zorder=-1,
+            alpha=0.5,
+            extent=self.warper.extent
         )
-        self.background = self.ax.imshow(warped, cmap='binary_r', zorder=-1, alpha=0.5)
         xlim = self.grid[:, 0].min() - margin, self.grid[:, 0].max() + margin
         ylim = self.grid[:, 1].min() - margin, self.grid[:, 1].max() + margin
         self.ax.set_ylim(ylim)
@@ -270,17 +388,42 @@ class ManualAdjustmentFigure():
         """
         """
 
-        # Load the custom transformation
-        warping.load_tform_data(dst=self.grid)
+        # Only the triangles around nodes which moved are warped again
+        self.warper.setDestination(self.grid)
 
         # Update the background image
-        warped = warping.warp(self.image)
-        self.background.remove()
-        self.background = self.ax.imshow(warped, cmap='binary_r', zorder=-1, alpha=0.5)
+        self.background.set_data(self.warper.warped)
         xlim = self.grid[:, 0].min() - margin, self.grid[:, 0].max() + margin
         ylim = self.grid[:, 1].min() - margin, self.grid[:, 1].max() + margin
         self.ax.set_ylim(ylim)
         self.ax.set_xlim(xlim)
+        self.fig.canvas.draw_idle()
+
+        return
+
+    def updatePreview(self):
+        """
+        Update the background with the low-resolution warp of the current grid
+        """
+
+        if not self.allow_online_warping:
+            return
+
+        self.previewWarper.setDestination(self.grid)
+        self.background.set_data(self.previewWarper.warped)
+
+        return
+
+    def _rebuildWarpers(self, src):
+        """
+        Replace the warpers after a node is added or removed (the incremental
+        warp only supports moving nodes)
+        """
+
+        self.src = src
+        self.warper = warping.IncrementalPiecewiseWarp(self.image, src, self.grid)
+        self.previewWarper = warping.IncrementalPiecewiseWarp(self.image, src, self.grid, scale=self.previewScale)
+        self.background.set_data(self.previewWarper.warped)
 
         return
 
@@ -343,6 +486,8 @@ class ManualAdjustmentFigure():
                     color=self.colors,
                     s=20
                 )
+                if self.allow_online_warping:
+                    self._rebuildWarpers(np.delete(self.src, imarker, axis=0))
                 self.fig.canvas.draw()
 
             # No shift modifier (Add node)
@@ -359,6 +504,11 @@ class ManualAdjustmentFigure():
                     color=self.colors,
                     s=20
                 )
+                if self.allow_online_warping:
+                    self._rebuildWarpers(np.vstack([
+                        self.src,
+                        self.warper.mapToSource(mouse)
+                    ]))
                 self.fig.canvas.draw()
 
         return
@@ -395,6 +545,7 @@ class ManualAdjustmentFigure():
             nodes = np.copy(self.grid)
             nodes[self.imarker] = point
             self.markers.set_offsets(nodes)
+            self.updatePreview()
             self.fig.canvas.draw()
 
         return
@@ -405,6 +556,9 @@ class ManualAdjustmentFigure():
 
         if self.dragging:
 
+            if event.xdata is None or event.ydata is None:
+                return
+
             # update positions
             offsets = self.markers.get_offsets()
             offsets[self.imarker, :] = np.array([event.xdata, event.ydata])
@@ -415,8 +569,11 @@ class ManualAdjustmentFigure():
             self.colors[self.imarker] = 'r'
             self.markers.set_color(self.colors)
 
+            # live feedback
+            self.updatePreview()
+
             # draw
-            self.ax.figure.canvas.draw()
+            self.ax.figure.canvas.draw_idle()
 
         return
 
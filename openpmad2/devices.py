@@ -0,0 +1,522 @@
+import json
+import time
+import queue
+import serial
+import threading
+import numpy as np
+import pathlib as pl
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+def _probeDevice(device, baudrate=9600, timeout=1, handshake=b'a'):
+    """
+    Open a serial device and check that it echoes the handshake
+
+    returns
+    -------
+    connection
+        The open connection (None if the device did not respond)
+    """
+
+    try:
+        connection = serial.Serial(
+            str(device),
+            baudrate,
+            timeout=timeout
+        )
+    except Exception as error:
+        return None
+    try:
+        connection.reset_input_buffer()
+        connection.write(handshake)
+        incoming = connection.read(len(handshake))
+    except Exception as error:
+        connection.close()
+        return None
+    if incoming != handshake:
+        connection.close()
+        return None
+
+    return connection
+
+class ConnectionManager():
+    """
+    Keeps a single, persistent connection with the microcontroller
+
+    The last device which completed the handshake is tried first (and
+    remembered in the cache file, if one is given). Otherwise all of the
+    candidate devices are probed in parallel and the first to respond wins.
+    The connection stays open until it is released, so back-to-back protocols
+    within a session reuse it.
+    """
+
+    def __init__(
+        self,
+        baudrate=9600,
+        timeout=1,
+        pattern='*ttyACM*',
+        handshake=b'a',
+        candidates=None,
+        cacheFile=None,
+        ):
+        """
+        keywords
+        --------
+        baudrate
+            Baudrate of the connection
+        timeout
+            Timeout of the handshake (in seconds)
+        pattern
+            Glob pattern of the candidate devices (in /dev)
+        handshake
+            Message the device must echo
+        candidates
+            Explicit list of device paths (overrides the pattern)
+        cacheFile
+            Optional JSON file which remembers the last working device
+        """
+
+        self._baudrate = baudrate
+        self._timeout = timeout
+        self._pattern = pattern
+        self._handshake = handshake
+        self._candidates = candidates
+        self._cacheFile = None if cacheFile is None else pl.Path(cacheFile)
+        self._connection = None
+        self._lock = threading.Lock()
+
+        #
+        self._lastDevice = None
+        if self._cacheFile is not None and self._cacheFile.exists():
+            with open(self._cacheFile, 'r') as stream:
+                self._lastDevice = json.load(stream).get('device')
+
+        return
+
+    def _listCandidates(self):
+        """
+        """
+
+        if self._candidates is not None:
+            candidates = [str(device) for device in self._candidates]
+        else:
+            candidates = [str(device) for device in sorted(pl.Path('/dev/').glob(self._pattern))]
+
+        return candidates
+
+    def _remember(self, device):
+        """
+        """
+
+        self._lastDevice = device
+        if self._cacheFile is not None:
+            self._cacheFile.parent.mkdir(parents=True, exist_ok=True)
+            with open(self._cacheFile, 'w') as stream:
+                json.dump({'device': device}, stream)
+
+        return
+
+    def _probeInParallel(self, candidates):
+        """
+        Probe each candidate on its own thread and keep the first connection
+        """
+
+        if len(candidates) == 0:
+            return None, None
+
+        winner = [None]
+        def closeUnlessWinner(future):
+            connection = future.result()
+            if connection is not None and connection is not winner[0]:
+                connection.close()
+            return
+
+        executor = ThreadPoolExecutor(max_workers=len(candidates))
+        futures = {
+            executor.submit(_probeDevice, device, self._baudrate, self._timeout, self._handshake): device
+                for device in candidates
+        }
+        device = None
+        for future in as_completed(futures):
+            connection = future.result()
+            if connection is not None:
+                winner[0] = connection
+                device = futures[future]
+                break
+
+        # Connections opened by the slower probes are closed as they finish
+        for future in futures:
+            future.add_done_callback(closeUnlessWinner)
+        executor.shutdown(wait=False)
+
+        return winner[0], device
+
+    def connect(self):
+        """
+        Return the open connection (establishing it if necessary)
+
+        returns
+        -------
+        connection
+            The open connection (None if no device responded)
+        """
+
+        with self._lock:
+
+            #
+            if self._connection is not None and self._connection.is_open:
+                return self._connection
+            self._connection = None
+
+            # Try the last working device first
+            candidates = self._listCandidates()
+            if self._lastDevice is not None and self._lastDevice in candidates:
+                connection = _probeDevice(self._lastDevice, self._baudrate, self._timeout, self._handshake)
+                if connection is not None:
+                    self._connection = connection
+                    return connection
+                candidates.remove(self._lastDevice)
+
+            #
+            connection, device = self._probeInParallel(candidates)
+            if connection is not None:
+                self._connection = connection
+                self._remember(device)
+
+        return self._connection
+
+    def release(self):
+        """
+        Close the connection
+        """
+
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+        return
+
+    @property
+    def connected(self):
+        return self._connection is not None and self._connection.is_open
+
+    @property
+    def device(self):
+        return None if self._connection is None else self._connection.port
+
+_connectionManager = None
+
+def getConnectionManager(**kwargs):
+    """
+    Return the (shared) connection manager
+
+    Keywords are passed to ConnectionManager and replace the shared manager
+    (releasing its connection)
+    """
+
+    global _connectionManager
+    if _connectionManager is None or len(kwargs) != 0:
+        if _connectionManager is not None:
+            _connectionManager.release()
+        _connectionManager = ConnectionManager(**kwargs)
+
+    return _connectionManager
+
+class SharedMicrocontroller():
+    """
+    Microcontroller interface (connect, signal and release) backed by the
+    shared connection manager
+
+    Releasing it leaves the connection open for the next protocol
+    """
+
+    def __init__(self, manager=None, message=b's'):
+        """
+        """
+
+        self._manager = getConnectionManager() if manager is None else manager
+        self._message = message
+        self._connection = None
+
+        return
+
+    def connect(self):
+        """
+        """
+
+        self._connection = self._manager.connect()
+        if self._connection is None:
+            raise Exception('Failed to connect with the microcontroller')
+
+        return
+
+    def signal(self):
+        """
+        """
+
+        if self._connection is not None:
+            self._connection.write(self._message)
+
+        return
+
+    def release(self):
+        """
+        """
+
+        self._connection = None
+
+        return
+
+class SerialReader():
+    """
+    Reads a serial port on a background thread
+
+    Each byte is pushed into a deque together with its (monotonic) receive
+    time. Appending to and popping from a deque are atomic, so the frame loop
+    can drain the queue without locking and without ever waiting on the port.
+    """
+
+    def __init__(self, connection, maxlen=1024, pollInterval=0.001, lateThreshold=None):
+        """
+        keywords
+        --------
+        connection
+            An open serial connection (owned by the reader until it is stopped)
+        maxlen
+            Capacity of the queue (the oldest records are dropped when it is full)
+        pollInterval
+            Read timeout of the background thread (in seconds)
+        lateThreshold
+            Records drained more than this long after they were received are
+            counted as late (in seconds)
+        """
+
+        self._connection = connection
+        self._queue = deque(maxlen=maxlen)
+        self._pollInterval = pollInterval
+        self._lateThreshold = lateThreshold
+        self._received = 0
+        self._dropped = 0
+        self._late = 0
+        self._stopEvent = threading.Event()
+        self._thread = None
+        self._timeout = None
+
+        return
+
+    def start(self):
+        """
+        """
+
+        if self._thread is not None:
+            raise Exception('Serial reader already started')
+
+        self._timeout = self._connection.timeout
+        self._connection.timeout = self._pollInterval
+        self._connection.reset_input_buffer()
+        self._stopEvent.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+        return
+
+    def _run(self):
+        """
+        """
+
+        while not self._stopEvent.is_set():
+            incoming = self._connection.read(max(1, self._connection.in_waiting))
+            if len(incoming) == 0:
+                continue
+            receivedAt = time.monotonic()
+            for byte in incoming:
+                if len(self._queue) == self._queue.maxlen:
+                    self._dropped += 1
+                self._queue.append((byte, receivedAt))
+            self._received += len(incoming)
+
+        return
+
+    def drain(self):
+        """
+        Remove and return all of the records in the queue
+        """
+
+        records = list()
+        drainedAt = time.monotonic()
+        while True:
+            try:
+                record = self._queue.popleft()
+            except IndexError:
+                break
+            if self._lateThreshold is not None and drainedAt - record[1] > self._lateThreshold:
+                self._late += 1
+            records.append(record)
+
+        return records
+
+    def stop(self):
+        """
+        """
+
+        if self._thread is not None:
+            self._stopEvent.set()
+            self._thread.join()
+            self._thread = None
+            self._connection.timeout = self._timeout
+
+        return
+
+    def report(self, verbose=True):
+        """
+        """
+
+        summary = {
+            'received': self._received,
+            'dropped': self._dropped,
+            'late': self._late
+        }
+        if verbose:
+            print(f'Received {self._received} bytes ({self._dropped} dropped, {self._late} late)')
+
+        return summary
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        return
+
+    @property
+    def received(self):
+        return self._received
+
+    @property
+    def dropped(self):
+        return self._dropped
+
+    @property
+    def late(self):
+        return self._late
+
+SIGNAL_DTYPE = np.dtype([
+    ('requested', np.float64),
+    ('sent', np.float64),
+])
+
+class SignalWorker():
+    """
+    Performs hardware signaling on a dedicated I/O thread
+
+    request is cheap and never blocks, so it can be registered with
+    callOnFlip. It only enqueues the (monotonic) time of the request; the
+    worker performs the write and records when it actually completed.
+    """
+
+    def __init__(self, target):
+        """
+        keywords
+        --------
+        target
+            Callable which sends the signal (e.g., Microcontroller.signal)
+        """
+
+        self._target = target
+        self._queue = queue.SimpleQueue()
+        self._records = list()
+        self._failed = 0
+        self._thread = None
+
+        return
+
+    def start(self):
+        """
+        """
+
+        if self._thread is not None:
+            raise Exception('Signal worker already started')
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+        return
+
+    def _run(self):
+        """
+        """
+
+        while True:
+            requestedAt = self._queue.get()
+            if requestedAt is None:
+                break
+            try:
+                self._target()
+            except Exception as error:
+                self._failed += 1
+                continue
+            self._records.append((requestedAt, time.monotonic()))
+
+        return
+
+    def request(self):
+        """
+        Enqueue a signal (call this from the render thread)
+        """
+
+        self._queue.put(time.monotonic())
+
+        return
+
+    def stop(self):
+        """
+        Send the pending signals and stop the worker
+        """
+
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+        return
+
+    def report(self, verbose=True):
+        """
+        Summarize the delay between each request and the completed write
+
+        returns
+        -------
+        summary
+            Number of signals sent and failed, and percentiles of the delay (in ms)
+        """
+
+        delays = self.delays * 1000
+        summary = {
+            'sent': delays.size,
+            'failed': self._failed,
+        }
+        if delays.size != 0:
+            for label, q in zip(['median', 'p95', 'p99', 'max'], [50, 95, 99, 100]):
+                summary[label] = np.percentile(delays, q).item()
+        if verbose:
+            if delays.size == 0:
+                print(f'Sent 0 signals ({self._failed} failed)')
+            else:
+                print(f'Sent {delays.size} signals ({self._failed} failed), delay: median={summary["median"]:.3f} ms, p95={summary["p95"]:.3f} ms, max={summary["max"]:.3f} ms')
+
+        return summary
+
+    @property
+    def records(self):
+        return np.array(self._records, dtype=SIGNAL_DTYPE)
+
+    @property
+    def delays(self):
+        records = self.records
+        return records['sent'] - records['requested']
+
+    @property
+    def failed(self):
+        return self._failed
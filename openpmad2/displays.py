@@ -1,14 +1,19 @@
+import ctypes
+from collections import deque
 import numpy as np
 import pathlib as pl
+from pyglet import gl as GL
 from psychopy.visual import Window
 from psychopy.visual.windowwarp import Warper
 from psychopy.visual import GratingStim, ImageStim
 from . import warping
 from myphdlib.general.teensy import Microcontroller
-from openpmad2.writing import VideoWriterSkvideo, VideoWriterOpenCV
+from openpmad2.devices import SharedMicrocontroller, SignalWorker
+from openpmad2.writing import VideoWriterSkvideo, VideoWriterOpenCV, VideoWriterGrayscale, SegmentedVideoWriter, FrameSidecarWriter
+from openpmad2.writing import StateLogWriter, STATE_DTYPE, STATE_KINDS
 from openpmad2.helpers import generateMetadataFilename
+from openpmad2.alignment import encodeEventBarcode
 
-_lowStateTexture = np.full([16, 16], -1).astype(np.int8)
 _highStateTexture = np.full([16, 16], 1).astype(np.int8)
 
 class WarpedWindow(Window):
@@ -25,9 +30,16 @@ class WarpedWindow(Window):
         fullScreen=False,
         patchCoords=(-7, 345, 40, 66),
         textureShape=(16, 16),
-        date='2022-08-25'
+        date='2022-08-25',
+        gpuWarping=True,
+        patchBitsPerFrame=1,
         ):
         """
+        keywords
+        --------
+        patchBitsPerFrame
+            Number of bits per frame carried by the signal patch barcodes
+            (more than 1 bit requires a photodiode to decode, see signalBarcode)
         """
 
         #
@@ -38,8 +50,32 @@ class WarpedWindow(Window):
         self._ppd = self._width / self._azimuth
         self._textureShape = textureShape
         self._mc = None
+        self._signalWorker = None
+        self._signalRecords = None
         self._pulsing = False 
         self._stream = None
+        self._streamBuffer = None
+        self._sidecar = None
+        self._frameIndex = 0
+        self._eventCode = 0
+        self._stateLog = None
+        self._frameState = np.zeros(1, dtype=STATE_DTYPE)[0]
+        self._stateFrameIndex = 0
+        self._patchBitsPerFrame = patchBitsPerFrame
+        self._patchLevels = 2 ** patchBitsPerFrame
+        self._patchSymbol = 0
+        self._barcodeQueue = deque()
+
+        # Resolve and validate the calibration before opening the window
+        self._calibration = warping.getCalibrationRegistry().preload(date=date)
+
+        # CPU warping uses the same mesh as the Warper (WarpedNumPyArrayStim only
+        # warps on the CPU while the Warper is disabled, see setGpuWarping)
+        self._warpModel = warping.WarpModel.fromWarpfile(
+            self._calibration['mesh']['path'],
+            (self._height, self._width)
+        )
+        warping.setWarpModel(self._warpModel)
 
         #
         super().__init__(
@@ -53,7 +89,10 @@ class WarpedWindow(Window):
             fullscr=fullScreen,
         )
 
-        self._warper = Warper(self, warp='warpfile', warpfile=warping.getWarpfile(date))
+        self._warper = Warper(self, warp='warpfile', warpfile=str(self._calibration['mesh']['path']))
+        self._gpuWarping = True
+        if gpuWarping == False:
+            self.setGpuWarping(False)
 
         #
         self._state = False
@@ -61,9 +100,10 @@ class WarpedWindow(Window):
         x, y, w, h = self._patchCoords
         self._patch = GratingStim(
             self,
-            tex=_lowStateTexture,
+            tex=_highStateTexture,
             size=(w, h),
             pos=(x, y),
+            contrast=-1,
             units='pix'
         )
 
@@ -85,19 +125,22 @@ class WarpedWindow(Window):
         """
         """
 
-        # Draw the signal patch
+        # A running pulse finishes before the next barcode starts
         if self._countdown is not None:
 
             # Decrement the signal countdown
             if self._countdown != 0:
+                self._setPatchSymbol(self._patchLevels - 1)
                 self._countdown -= 1
 
             # Set the signal patch to the low state
             else:
-                if self._state != False:
-                    self._patch.tex = _lowStateTexture
-                    self._state = False
-                    self._countdown = None
+                self._setPatchSymbol(0)
+                self._countdown = None
+
+        # Barcodes (and the pulses signaled while they are shown)
+        elif len(self._barcodeQueue) != 0:
+            self._setPatchSymbol(self._barcodeQueue.popleft())
 
         # Draw the signal patch
         if drawSignalPatch:
@@ -105,10 +148,32 @@ class WarpedWindow(Window):
 
         # Write the current frame
         if self._stream is not None:
-            frame = self.getNumpyArray()
+            if self._streamBuffer is None:
+                frame = self.getNumpyArray()
+            else:
+                frame = self.getGrayscaleArray(out=self._streamBuffer)
             self._stream.write(frame)
 
-        return super().flip(**kwargs)
+        #
+        timestamp = super().flip(**kwargs)
+
+        # Record the flip which produced the frame
+        if self._stream is not None:
+            self._sidecar.write(self._frameIndex, timestamp, self._patchSymbol, self._eventCode)
+            self._frameIndex += 1
+        self._eventCode = 0
+
+        # Record the state of the stimulus
+        if self._stateLog is not None:
+            self._frameState['frameIndex'] = self._stateFrameIndex
+            self._frameState['timestamp'] = timestamp
+            self._frameState['background'] = self._backgroundColor
+            self._frameState['patch'] = self._patchSymbol
+            self._stateLog.writeRecord(self._frameState)
+            self._frameState.fill(0)
+            self._stateFrameIndex += 1
+
+        return timestamp
 
     def idle(self, duration=1, units='seconds', returnFirstTimestamp=False):
         """
@@ -129,7 +194,7 @@ class WarpedWindow(Window):
         if returnFirstTimestamp:
             return timestamp
 
-    def signalEvent(self, duration=3, units='frames', mc=False):
+    def signalEvent(self, duration=3, units='frames', mc=False, code=1):
         """
         Flash the visual patch for a specific amount of time
 
@@ -139,22 +204,89 @@ class WarpedWindow(Window):
             Duration of the signalling event
         units: str
             Unit of time (frames or seconds)
+        code: int
+            Event code recorded in the frame sidecar of the video stream
+
+        If a barcode is being shown, the pulse is queued behind it instead of
+        interrupting it (the event code and microcontroller signal are still
+        sent on the next flip)
         """
 
         #
-        self._patch.tex = _highStateTexture
-        self._state = True
         if units == 'frames':
-            self._countdown = int(duration)
+            nFrames = int(duration)
         elif units == 'seconds':
-            self._countdown = round(self.fps * duration)
+            nFrames = round(self.fps * duration)
         else:
             raise Exception(f'{units} is an invalid unit of time')
+        if len(self._barcodeQueue) != 0:
+            self._barcodeQueue.extend([self._patchLevels - 1] * nFrames + [0])
+        else:
+            self._countdown = nFrames
+        self._eventCode = code
 
-        #
-        if mc == True and self._mc is not None:
-            self.callOnFlip(self._mc.signal)
-            # self._mc.signal()
+        # The write happens on the I/O worker, not on the render thread
+        if mc == True and self._signalWorker is not None:
+            self.callOnFlip(self._signalWorker.request)
+
+        return
+
+    def signalBarcode(self, eventType, trialIndex=0, typeBits=2, indexBits=4, checkBits=2):
+        """
+        Signal an event type and trial index with a barcode on the signal patch
+
+        The barcode is queued and shown one symbol per frame once the running
+        pulse (if any) is complete (see alignment.encodeEventBarcode for the
+        layout and alignment.decodeBarcodesFromSignal for the decoder).
+        Barcodes which are signaled back-to-back are shown one after the other.
+
+        A barcode takes longer than a plain pulse (12 frames with the default
+        layout and 1 bit per frame, 8 frames with 2 bits per frame), so plain
+        pulses (signalEvent) remain the default; barcodes are worth it when
+        events must be identified without relying on their order.
+
+        returns
+        -------
+        nFrames
+            Number of frames until the barcode is complete
+        """
+
+        symbols = encodeEventBarcode(
+            eventType,
+            trialIndex,
+            typeBits,
+            indexBits,
+            checkBits,
+            self._patchBitsPerFrame
+        )
+        self._barcodeQueue.extend(symbols.tolist())
+        nFrames = len(self._barcodeQueue)
+
+        return nFrames
+
+    def _setPatchSymbol(self, symbol):
+        """
+        Set the intensity of the signal patch (0 is low and patchLevels - 1 is high)
+        """
+
+        if symbol != self._patchSymbol:
+            self._patch.contrast = -1 + 2 * symbol / (self._patchLevels - 1)
+            self._patchSymbol = symbol
+        self._state = symbol > 0
+
+        return
+
+    def setGpuWarping(self, enabled=True):
+        """
+        Enable or disable the Warper (e.g., when the stimuli are warped on the
+        CPU ahead of time, so they are not warped twice)
+        """
+
+        if enabled:
+            self._warper.changeProjection('warpfile', warpfile=str(self._calibration['mesh']['path']))
+        else:
+            self._warper.changeProjection(None)
+        self._gpuWarping = True if enabled else False
 
         return
 
@@ -181,6 +313,7 @@ class WarpedWindow(Window):
 
         super().close()
         self.disconnectMicrocontroller()
+        self.closeStateLog()
 
         return
 
@@ -197,14 +330,57 @@ class WarpedWindow(Window):
 
         return array
 
+    def getGrayscaleArray(self, buffer='back', out=None):
+        """
+        Read the red channel of the frame directly into a uint8 array
+
+        Unlike getNumpyArray, the rows are in OpenGL order (i.e., the first
+        row is the bottom of the display)
+        """
+
+        if out is None:
+            out = np.empty([self.height, self.width], dtype=np.uint8)
+
+        #
+        if buffer == 'back' and self.useFBO:
+            GL.glBindFramebufferEXT(GL.GL_FRAMEBUFFER_EXT, self.frameBuffer)
+            GL.glReadBuffer(GL.GL_COLOR_ATTACHMENT0_EXT)
+        elif buffer == 'back':
+            GL.glReadBuffer(GL.GL_BACK)
+        else:
+            GL.glReadBuffer(GL.GL_FRONT)
+        GL.glPixelStorei(GL.GL_PACK_ALIGNMENT, 1)
+        GL.glReadPixels(
+            0,
+            0,
+            self.width,
+            self.height,
+            GL.GL_RED,
+            GL.GL_UNSIGNED_BYTE,
+            out.ctypes.data_as(ctypes.POINTER(ctypes.c_ubyte))
+        )
+
+        return out
+
     def connectMicrocontroller(
         self,
+        shared=False,
         ):
         """
+        keywords
+        --------
+        shared
+            Use the persistent connection of the shared connection manager
+            (see devices.getConnectionManager) instead of opening a new one
         """
 
-        self._mc = Microcontroller()
+        if shared:
+            self._mc = SharedMicrocontroller()
+        else:
+            self._mc = Microcontroller()
         self._mc.connect()
+        self._signalWorker = SignalWorker(self._mc.signal)
+        self._signalWorker.start()
 
         return
 
@@ -212,8 +388,8 @@ class WarpedWindow(Window):
         """
         """
 
-        if self._mc is not None:
-            self._mc.signal()
+        if self._signalWorker is not None:
+            self._signalWorker.request()
 
         return
 
@@ -224,6 +400,10 @@ class WarpedWindow(Window):
         """
 
         if self._mc is not None:
+            self._signalWorker.stop()
+            self._signalWorker.report()
+            self._signalRecords = self._signalWorker.records
+            self._signalWorker = None
             self._mc.release()
             self._mc = None
 
@@ -234,27 +414,60 @@ class WarpedWindow(Window):
         tag,
         sessionFolder,
         vflip=True,
-        crf=17
+        crf=17,
+        segmentDuration=None,
+        grayscale=False,
         ):
         """
+        Record every frame to a video
+
+        keywords
+        --------
+        segmentDuration
+            Split the recording into a folder of segments of this duration (in seconds)
+        grayscale
+            Pipe the red channel straight into ffmpeg as single-channel video
         """
 
         if self._stream is not None:
             raise Exception('Video stream already open')
         
         sessionFolderPath = pl.Path(sessionFolder)
-        filename = generateMetadataFilename(sessionFolderPath, tag, '.mp4')
         shape = (
             self.height,
             self.width,
         )
-        self._stream = VideoWriterSkvideo(
-            str(filename),
-            shape,
-            self.fps,
-            crf,
-            vflip
-        )
+        # Frames read with getGrayscaleArray are already upside down
+        if grayscale:
+            vflip = not vflip
+            self._streamBuffer = np.empty(shape, dtype=np.uint8)
+
+        #
+        if segmentDuration is None:
+            filename = generateMetadataFilename(sessionFolderPath, tag, '.mp4')
+            writerClass = VideoWriterGrayscale if grayscale else VideoWriterSkvideo
+            self._stream = writerClass(
+                str(filename),
+                shape,
+                self.fps,
+                crf,
+                vflip
+            )
+            sidecarFilename = filename.with_suffix('.frames')
+        else:
+            filename = generateMetadataFilename(sessionFolderPath, tag, '')
+            self._stream = SegmentedVideoWriter(
+                filename,
+                shape,
+                self.fps,
+                crf,
+                vflip,
+                segmentDuration,
+                grayscale=grayscale
+            )
+            sidecarFilename = filename.joinpath('timestamps.frames')
+        self._sidecar = FrameSidecarWriter(sidecarFilename)
+        self._frameIndex = 0
 
         return
     
@@ -267,9 +480,91 @@ class WarpedWindow(Window):
         if self._stream is not None:
             self._stream.close()
             self._stream = None
+            self._streamBuffer = None
+            self._sidecar.close()
+            self._sidecar = None
+
+        return
+
+    def openStateLog(
+        self,
+        tag,
+        sessionFolder,
+        ):
+        """
+        Record the state of the stimulus on each frame instead of the frame itself
+        """
+
+        if self._stateLog is not None:
+            raise Exception('State log already open')
+
+        filename = generateMetadataFilename(pl.Path(sessionFolder), tag, '.states')
+        header = {
+            'width': self.width,
+            'height': self.height,
+            'ppd': self.ppd,
+            'fps': self.fps,
+            'patchCoords': [float(value) for value in self.patchCoords],
+            'patchLevels': self._patchLevels,
+        }
+        self._stateLog = StateLogWriter(filename, header)
+        self._stateFrameIndex = 0
+
+        return
+
+    def logState(self, kind, **params):
+        """
+        Record the state of the stimulus drawn on the current frame
+
+        keywords
+        --------
+        kind
+            The kind of stimulus (grating, bar, spot, or field)
+        params
+            Any of the fields in writing.STATE_DTYPE (e.g., sf, ori, phase, and
+            contrast for gratings, or the row of the protocol metadata and the
+            x and y jitter for noise fields)
+        """
+
+        if self._stateLog is None:
+            return
+
+        self._frameState['kind'] = STATE_KINDS[kind]
+        for key, value in params.items():
+            self._frameState[key] = value
+
+        # The phase is stored in single precision, so only its fraction is kept
+        if 'phase' in params.keys():
+            self._frameState['phase'] = np.mod(params['phase'], 1)
 
         return
 
+    def closeStateLog(
+        self,
+        ):
+        """
+        """
+
+        if self._stateLog is not None:
+            self._stateLog.close()
+            self._stateLog = None
+
+        return
+
+    @property
+    def signalRecords(self):
+        if self._signalWorker is None:
+            return self._signalRecords
+        return self._signalWorker.records
+
+    @property
+    def warpModel(self):
+        return self._warpModel
+
+    @property
+    def gpuWarping(self):
+        return self._gpuWarping
+
     @property
     def width(self):
         return self._width
@@ -305,11 +600,7 @@ class WarpedWindow(Window):
 
         if value not in [True, False]:
             raise Exception(f'Invalid state: {value}')
-        if value:
-            self._patch.tex = _highStateTexture
-        else:
-            self._patch.tex = _lowStateTexture
-        self._state = True if value else False
+        self._setPatchSymbol(self._patchLevels - 1 if value else 0)
 
         return
 
@@ -0,0 +1,195 @@
+import numpy as np
+
+_gridGeometryCache = dict()
+
+class GridGeometry():
+    """
+    Geometry of a grid of square subregions which uniformly covers the
+    entire display
+
+    All arrays exposed by this class are read-only because instances are
+    shared between protocols (and analysis tools) through the cache
+    """
+
+    def __init__(self, lengthInDegrees, width, height, ppd):
+        """
+        keywords
+        --------
+        lengthInDegrees
+            The side length of a unit grid square (in degrees of visual angle)
+        width
+            Width of the display (in pixels)
+        height
+            Height of the display (in pixels)
+        ppd
+            Pixels per degree of visual angle
+        """
+
+        self._lengthInDegrees = lengthInDegrees
+        self._width = width
+        self._height = height
+        self._ppd = ppd
+        self._lengthInPixels = lengthInDegrees * ppd
+
+        #
+        shape = np.array([
+            int(width  // self._lengthInPixels),
+            int(height // self._lengthInPixels)
+        ])
+        offset = np.array([
+            round(width  % self._lengthInPixels / 2, 2),
+            round(height % self._lengthInPixels / 2, 2)
+        ])
+
+        #
+        xi, yi = np.meshgrid(
+            np.arange(shape[0]) * self._lengthInPixels + (self._lengthInPixels / 2),
+            np.arange(shape[1]) * self._lengthInPixels + (self._lengthInPixels / 2)
+        )
+        xi = xi + offset[0] - (width / 2)
+        yi = yi + offset[1] - (height / 2)
+
+        #
+        self._coordsInPixels = np.around(np.hstack([
+            xi.reshape(-1, 1),
+            yi.reshape(-1, 1)
+        ]), 0)
+        self._coordsInPixels.setflags(write=False)
+        self._shape = tuple(int(n) for n in np.flip(shape))
+
+        #
+        self._jittered = dict()
+        self._rectangles = None
+        self._indexMap = None
+
+        return
+
+    def getCoordsInDegrees(self, correctVerticalReflection=False, decimals=None):
+        """
+        Compute the coordinates for the center of each subregion (in degrees)
+
+        keywords
+        --------
+        correctVerticalReflection
+            Reflect the coordinates across the horizontal axis
+        decimals
+            Number of decimals to round to (no rounding if None)
+        """
+
+        coords = self._coordsInPixels / self._ppd
+        if decimals is not None:
+            coords = np.around(coords, decimals)
+        if correctVerticalReflection:
+            coords[:, 1] *= -1
+
+        return coords
+
+    def getJitteredCoords(self, offsetInPixels):
+        """
+        Compute the coordinates for the center of each subregion (in pixels)
+        after shifting the whole grid by an offset
+
+        keywords
+        --------
+        offsetInPixels
+            The x and y components of the shift (in pixels)
+        """
+
+        key = tuple(np.around(np.asarray(offsetInPixels, dtype=float).flatten(), 3))
+        if key not in self._jittered.keys():
+            coords = self._coordsInPixels + np.array(key)
+            coords.setflags(write=False)
+            self._jittered[key] = coords
+
+        return self._jittered[key]
+
+    @property
+    def lengthInDegrees(self):
+        return self._lengthInDegrees
+
+    @property
+    def lengthInPixels(self):
+        return self._lengthInPixels
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def nSubregions(self):
+        return int(self._shape[0] * self._shape[1])
+
+    @property
+    def coordsInPixels(self):
+        return self._coordsInPixels
+
+    @property
+    def coordsInDegrees(self):
+        return self.getCoordsInDegrees()
+
+    @property
+    def rectangles(self):
+        """
+        Screen rectangle for each subregion in image coordinates (origin in the
+        top-left corner) as (row1, row2, column1, column2), clipped to the display
+        """
+
+        if self._rectangles is None:
+            x, y = self._coordsInPixels.T
+            halfLength = self._lengthInPixels / 2
+            column1 = np.around(x + self._width / 2 - halfLength).astype(int)
+            row1 = np.around(self._height / 2 - y - halfLength).astype(int)
+            column2 = np.around(x + self._width / 2 + halfLength).astype(int)
+            row2 = np.around(self._height / 2 - y + halfLength).astype(int)
+            self._rectangles = np.vstack([
+                np.clip(row1, 0, self._height),
+                np.clip(row2, 0, self._height),
+                np.clip(column1, 0, self._width),
+                np.clip(column2, 0, self._width),
+            ]).T
+            self._rectangles.setflags(write=False)
+
+        return self._rectangles
+
+    @property
+    def indexMap(self):
+        """
+        Array with the same shape as the display which maps each pixel to the
+        index of the subregion which covers it (-1 for uncovered pixels)
+        """
+
+        if self._indexMap is None:
+            self._indexMap = np.full([self._height, self._width], -1, dtype=np.int32)
+            for iSubregion, (row1, row2, column1, column2) in enumerate(self.rectangles):
+                self._indexMap[row1: row2, column1: column2] = iSubregion
+            self._indexMap.setflags(write=False)
+
+        return self._indexMap
+
+def getGridGeometry(lengthInDegrees, display):
+    """
+    Return the (cached) grid geometry for a display
+
+    keywords
+    --------
+    lengthInDegrees
+        The side length of a unit grid square (in degrees of visual angle)
+    display
+        Any object with width, height, and ppd attributes
+    """
+
+    key = (
+        int(display.width),
+        int(display.height),
+        float(display.ppd),
+        float(lengthInDegrees)
+    )
+    if key not in _gridGeometryCache.keys():
+        _gridGeometryCache[key] = GridGeometry(
+            lengthInDegrees,
+            display.width,
+            display.height,
+            display.ppd
+        )
+
+    return _gridGeometryCache[key]
@@ -2,7 +2,7 @@ import numpy as np
 import pathlib as pl
 from psychopy import visual
 from psychopy import core
-import serial
+from openpmad2.devices import SerialReader, getConnectionManager
 
 class StaticGratingWithProbe():
     """
@@ -334,45 +334,25 @@ class StaticGratingWithRealtimeProbe():
     """
     """
 
-    def __init__(self):
+    def __init__(self, display):
         """
         """
 
+        self.display = display
+        self.metadata = None
         self._connection = None
 
         return
     
     def _connectWithMicrocontroller(
         self,
-        baudrate=9600,
-        timeout=1,
         ):
         """
         """
 
-        #
-        if self._connection is not None:
-            self._connection.close()
-            self._connection = None
-
-        outgoing = bytes('a', 'utf-8')
-        connected = False
-        devices = pl.Path('/dev/').glob('*ttyACM*')
-        for device in devices:
-            try:
-                connection = serial.Serial(
-                    str(device),
-                    baudrate,
-                    timeout=timeout
-                )
-            except Exception as error:
-                continue
-            connection.write(outgoing)
-            incoming = connection.read(1)
-            if len(incoming) > 0 and incoming == outgoing:
-                connected = True
-                self._connection = connection
-                break
+        # The connection is shared with (and kept open for) the other protocols
+        self._connection = getConnectionManager().connect()
+        connected = self._connection is not None
 
         #
         return connected
@@ -405,38 +385,54 @@ class StaticGratingWithRealtimeProbe():
         )
 
         #
-        nTrials = round(sessionLength * self.display.fps / 2, 0)
+        nTrials = int(round(sessionLength * self.display.fps / 2))
         self.metadata = np.full([nTrials, 2], np.nan)
 
+        # The serial port is read on a background thread
+        if connected:
+            reader = SerialReader(self._connection, lateThreshold=1 / self.display.fps)
+            reader.start()
+        else:
+            reader = None
+
         #
         iTrial = 0
-        nFrames = round(self.display.fps * sessionLength, 0)
+        nFrames = int(round(self.display.fps * sessionLength))
         countdown = 0
         recordTimestamp = False
-        for iFrame in range(nFrames):
+        try:
+            for iFrame in range(nFrames):
 
-            #
-            if countdown == 0 and gabor.contrast != baselineContrastLevel:
-                gabor.contrast = baselineContrastLevel
+                #
+                if countdown == 0 and gabor.contrast != baselineContrastLevel:
+                    gabor.contrast = baselineContrastLevel
 
-            #
-            if self._connection.inWaiting > 0:
-                message = self._connection.read()
-                gabor.contrast = np.random.choice(probeContrastLevels, p=probeContrastProbabilities, size=1).item()
-                countdown = round(self.display.fps * probeDuration)
-                self.metadata[iTrial, 0] = gabor.contrast
-                recordTimestamp = True
+                # Messages received since the last frame trigger a single probe
+                if reader is not None and len(reader.drain()) > 0 and iTrial < nTrials:
+                    gabor.contrast = np.random.choice(probeContrastLevels, p=probeContrastProbabilities, size=1).item()
+                    countdown = round(self.display.fps * probeDuration)
+                    self.metadata[iTrial, 0] = gabor.contrast
+                    recordTimestamp = True
 
-            #
-            gabor.draw()
-            timestamp = self.display.flip()
-            if recordTimestamp: 
-                self.metadata[iTrial, 1] = timestamp
-                iTrial += 1
-            
-            #
-            if countdown != 0:
-                countdown -= 1
+                #
+                gabor.draw()
+                timestamp = self.display.flip()
+                if recordTimestamp: 
+                    self.metadata[iTrial, 1] = timestamp
+                    recordTimestamp = False
+                    iTrial += 1
+                
+                #
+                if countdown != 0:
+                    countdown -= 1
+
+        finally:
+            if reader is not None:
+                reader.stop()
+                reader.report()
+
+        #
+        self.metadata = self.metadata[:iTrial]
 
         return
     
@@ -4,6 +4,7 @@ from itertools import product
 from psychopy.visual import GratingStim
 from datetime import datetime as dt
 from . import bases
+from .helpers import computeBlockPermutation
 
 class DirectionSelectivityProtocol(bases.StimulusBase):
     """
@@ -38,14 +39,14 @@ class DirectionSelectivityProtocol(bases.StimulusBase):
 
         #
         N = len(spatialFrequencies) * len(orientations) * 2 * repeats
-        self.metadata = np.full([N, 3], np.nan)
-        trialIndex = 0
-        for i in range(repeats):
-            block = np.array(list(product(spatialFrequencies, orientations, [-1, 1])))
-            np.random.shuffle(block)
-            for entry in block:
-                self.metadata[trialIndex, :] = entry
-                trialIndex += 1
+        block = np.array(list(product(spatialFrequencies, orientations, [-1, 1])))
+        self.metadata = np.tile(block, (repeats, 1)).astype(float)
+        permutation = computeBlockPermutation(
+            np.repeat(np.arange(repeats), block.shape[0]),
+            shuffleBlocks=False,
+            shuffleWithinBlocks=True
+        )
+        self.metadata = self.metadata[permutation]
 
         # How long will the stimulus last?
         totalStimulusTime = N * (stimulusDuration + itiDuration) + warmupDuration
@@ -72,6 +73,7 @@ class DirectionSelectivityProtocol(bases.StimulusBase):
             for frameIndex in range(round(self.display.fps * stimulusDuration)):
                 gabor.phase += cpf * direction
                 gabor.draw()
+                self.display.logState('grating', sf=cpp, ori=orientation, phase=gabor.phase[0], contrast=1)
                 self.display.flip()
 
             #
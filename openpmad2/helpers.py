@@ -38,7 +38,7 @@ def generateMetadataFilename(parent, tag, extension='.pkl'):
     """
     """
 
-    existing = list(parent.glob(f'{tag}*'))
+    existing = list(parent.glob(f'{tag}*{extension}'))
     n = len(existing) + 1
     filename = parent.joinpath(f'{tag}-{n}{extension}')
     return filename
@@ -60,4 +60,60 @@ def estimateFrameCount(t, fps=60, roundingMethod='nearest'):
     if nFrames == 0:
         raise Exception(f'Estimated frame count is 0')
 
-    return nFrames
\ No newline at end of file
+    return nFrames
+
+def computeBlockPermutation(blocks, shuffleBlocks=True, shuffleWithinBlocks=False):
+    """
+    Compute a single row permutation which shuffles the order of blocks
+    (and optionally the order of rows within each block)
+
+    keywords
+    --------
+    blocks
+        Block identifier for each row
+    shuffleBlocks
+        Randomize the order of the blocks
+    shuffleWithinBlocks
+        Randomize the order of the rows within each block
+    """
+
+    blocks = np.asarray(blocks).flatten()
+    uniqueBlocks, inverse = np.unique(blocks, return_inverse=True)
+
+    # Position of each block after shuffling
+    order = np.arange(uniqueBlocks.size)
+    if shuffleBlocks:
+        np.random.shuffle(order)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.size)
+
+    #
+    if shuffleWithinBlocks:
+        permutation = np.lexsort((np.random.permutation(blocks.size), rank[inverse]))
+    else:
+        permutation = np.argsort(rank[inverse], kind='stable')
+
+    return permutation
+
+def applyRowPermutation(metadata, permutation, keys):
+    """
+    Reorder the rows of the per-trial entries in a metadata dict
+
+    keywords
+    --------
+    metadata
+        Metadata dict
+    permutation
+        Row indices (see computeBlockPermutation)
+    keys
+        Keys for the per-trial entries (any other entry is left untouched)
+    """
+
+    for key in keys:
+        value = metadata[key]
+        if isinstance(value, list):
+            metadata[key] = [value[index] for index in permutation]
+        else:
+            metadata[key] = value[permutation]
+
+    return metadata
@@ -0,0 +1,158 @@
+import numpy as np
+import pathlib as pl
+from itertools import islice
+
+def listLabjackFiles(labjackFolder):
+    """
+    List the data files of a LabJack recording in acquisition order
+    """
+
+    files = sorted(
+        pl.Path(labjackFolder).glob('*.dat'),
+        key=lambda file: (len(file.stem), file.stem)
+    )
+    if len(files) == 0:
+        raise Exception(f'No LabJack data files found in {labjackFolder}')
+
+    return files
+
+def _skipHeader(stream):
+    """
+    Advance the stream to the first row of data
+
+    returns
+    -------
+    firstRow
+        The first row of data (None if the file is empty)
+    """
+
+    for line in stream:
+        tokens = line.split()
+        if len(tokens) == 0:
+            continue
+        try:
+            float(tokens[0])
+        except ValueError:
+            continue
+        return line
+
+    return None
+
+def iterateLabjackChunks(labjackFolder, chunkSize=1000000):
+    """
+    Read a LabJack recording in chunks of rows
+
+    Only one chunk is held in memory at a time, so the size of the recording
+    is not limited by the amount of memory. The first column of each chunk is
+    the timestamp and the rest are the channels (as in loadLabjackData).
+    """
+
+    for file in listLabjackFiles(labjackFolder):
+        with open(file, 'r') as stream:
+            firstRow = _skipHeader(stream)
+            if firstRow is None:
+                continue
+            lines = [firstRow] + list(islice(stream, chunkSize - 1))
+            while len(lines) != 0:
+                yield np.loadtxt(lines, dtype=np.float64, ndmin=2)
+                lines = list(islice(stream, chunkSize))
+
+    return
+
+def extractLabjackEdges(labjackFolder, channels=None, threshold=0.5, chunkSize=1000000):
+    """
+    Find the rising and falling edges of the digital channels in a single pass
+
+    Edges which straddle two chunks (or two files) are detected by carrying
+    the state of the last sample of each chunk over to the next one.
+
+    keywords
+    --------
+    labjackFolder
+        Folder which contains the LabJack data files
+    channels
+        Column index of each channel (all of the channels by default)
+    threshold
+        Signals above the threshold are high
+    chunkSize
+        Number of rows read at a time
+
+    returns
+    -------
+    edges
+        Dictionary which maps each channel onto a dictionary with the sample
+        indices and timestamps of the rising and falling edges
+    """
+
+    lastState = None
+    sampleOffset = 0
+    rising, falling = list(), list()
+    for chunk in iterateLabjackChunks(labjackFolder, chunkSize):
+
+        #
+        if channels is None:
+            channels = np.arange(1, chunk.shape[1])
+        channels = np.atleast_1d(channels)
+        states = chunk[:, channels] > threshold
+
+        # The first sample of the recording is compared with itself
+        if lastState is None:
+            lastState = states[0]
+        transitions = np.diff(np.vstack([lastState, states]).astype(np.int8), axis=0)
+        lastState = states[-1]
+
+        #
+        for edges, direction in zip([rising, falling], [1, -1]):
+            rows, columns = np.nonzero(transitions == direction)
+            edges.append(np.column_stack([
+                columns,
+                rows + sampleOffset,
+                chunk[rows, 0]
+            ]))
+        sampleOffset += chunk.shape[0]
+
+    #
+    if lastState is None:
+        raise Exception(f'{labjackFolder} does not contain any samples')
+
+    #
+    rising, falling = np.vstack(rising), np.vstack(falling)
+    edges = dict()
+    for iColumn, channel in enumerate(channels):
+        edges[int(channel)] = dict()
+        for key, array in zip(['rising', 'falling'], [rising, falling]):
+            mask = array[:, 0] == iColumn
+            edges[int(channel)][f'{key}Indices'] = array[mask, 1].astype(np.int64)
+            edges[int(channel)][key] = array[mask, 2]
+
+    return edges
+
+def getEdgeTimestamps(edges, channel, edge='rising'):
+    """
+    Return the timestamps of the rising, falling or both edges of a channel
+    """
+
+    if edge in ('rising', 'falling'):
+        timestamps = edges[channel][edge]
+    elif edge == 'both':
+        timestamps = np.sort(np.concatenate([
+            edges[channel]['rising'],
+            edges[channel]['falling']
+        ]))
+    else:
+        raise Exception(f'{edge} is an invalid edge')
+
+    return timestamps
+
+def saveLabjackEdges(edges, filename):
+    """
+    Save the edges of every channel in a single binary file (npz)
+    """
+
+    arrays = dict()
+    for channel in edges.keys():
+        for key, array in edges[channel].items():
+            arrays[f'{key}_{channel}'] = array
+    np.savez(filename, **arrays)
+
+    return
@@ -10,105 +10,59 @@ import pathlib as pl
 from PIL import Image
 from openpmad2.constants import numpyRandomSeed
 from openpmad2.helpers import generateMetadataFilename
+from openpmad2.geometry import getGridGeometry
+from openpmad2.timing import TimingPlanner
+from openpmad2.helpers import computeBlockPermutation, applyRowPermutation
 
 #
 np.random.seed(numpyRandomSeed)
 
-def _computeGridPoints(lengthInDegrees, display):
-    """
-    Compute the coordinates for each square in a grid which uniformly
-    covers the entire display
-
-    keywords
-    --------
-    lengthInDegrees
-        The side length of a unit grid square (in degrees of visual angle)
-    """
-
-    lengthInPixels = lengthInDegrees * display.ppd
-
-    #
-    shape = np.array([
-        int(display.width  // lengthInPixels),
-        int(display.height // lengthInPixels)
-    ])
-    offset = np.array([
-        round(display.width  % lengthInPixels / 2, 2),
-        round(display.height % lengthInPixels / 2, 2)
-    ])
-
-    #
-    xi, yi = np.meshgrid(
-        np.arange(shape[0]) * lengthInPixels + (lengthInPixels / 2),
-        np.arange(shape[1]) * lengthInPixels + (lengthInPixels / 2)
-    )
-    xi = xi + offset[0] - (display.width / 2)
-    yi = yi + offset[1] - (display.height / 2)
-
-    #
-    coordinates = np.hstack([
-        xi.reshape(-1, 1),
-        yi.reshape(-1, 1)
-    ])
-
-    return np.around(coordinates, 0), np.flip(shape)
-
 class SparseNoise(bases.StimulusBase):
     """
     """
 
     def _generateMetadata(
         self,
-        coordsInPixels,
+        geometry,
         repeats,
-        field,
         nTrials,
-        gridShape,
         randomize,
-        correctVerticalReflection
+        correctVerticalReflection,
+        includeFields=True,
         ):
         """
         """
 
         #
-        coordsInDegrees = np.around(coordsInPixels / self.display.ppd, 3)
-        gridHeight, gridWidth = gridShape
-        self.metadata = {
+        coordsInDegrees = geometry.getCoordsInDegrees(correctVerticalReflection, decimals=3)
+        gridShape = geometry.shape
+
+        # Index of the subregion illuminated on each trial
+        indices = np.tile(np.arange(geometry.nSubregions), repeats)
+        if randomize:
+            indices = indices[computeBlockPermutation(np.arange(nTrials))]
 
-            # Luminance values for each subregion on the ith trial
-            'fields': np.full([nTrials, gridHeight, gridWidth], np.nan),
+        #
+        self.metadata = {
 
             # x and y coordinates in degrees for the center of the illuminated subregion for the ith trial
-            'coords': np.full([nTrials, 2], np.nan),
+            'coords': coordsInDegrees[indices],
 
             # indices which indicates the subregion illuminated on the ith trial
-            'indices': np.full([nTrials, 1], 0).astype(np.int64),
-                                                       
+            'indices': indices.astype(np.int64).reshape(-1, 1),
+
             # A list of event names (either spot or flash)
-            'events': np.full([nTrials * 2, 1], '').astype(np.chararray)
-        }
+            'events': np.full([nTrials * 2, 1], '').astype(np.chararray),
 
-        #
-        iTrial = 0
-        for iRepeat in range(repeats):
-            for iSubregion in np.arange(field.nElements):
-                image = np.full(field.nElements, -1)
-                image[iSubregion] = 1
-                self.metadata['fields'][iTrial] = image.reshape(gridShape)
-                coords = coordsInDegrees[iSubregion]
-                if correctVerticalReflection:
-                    coords[1] = coords[1] * -1
-                self.metadata['coords'][iTrial] = coords
-                self.metadata['indices'][iTrial] = iSubregion
-                iTrial += 1
+            # Shape of the grid (rows, columns)
+            'shape': gridShape,
+        }
 
-        #
-        if randomize:
-            trialIndices = np.arange(nTrials)
-            np.random.shuffle(trialIndices)
-            self.metadata['fields'] = self.metadata['fields'][trialIndices]
-            self.metadata['coords'] = self.metadata['coords'][trialIndices]
-            self.metadata['indices'] = self.metadata['indices'][trialIndices]
+        # Luminance values for each subregion on the ith trial
+        if includeFields:
+            fields = np.full([nTrials, geometry.nSubregions], -1.0)
+            fields[np.arange(nTrials), indices] = 1
+            self.metadata['fields'] = fields.reshape(nTrials, *gridShape)
 
         return
 
@@ -119,13 +73,25 @@ class SparseNoise(bases.StimulusBase):
         cycle,
         nTrials,
         nTrialsBetweenSignals,
+        verbose=False,
         ):
         """
         """
 
+        # Quantize the whole timeline
+        planner = TimingPlanner(self.display.fps)
+        planner.add(tIdle, 'idle')
+        planner.extend(np.tile(cycle, nTrials), 'spot')
+        planner.add(tIdle, 'idle')
+        planner.report(verbose)
+
         if self.display.backgroundColor != -1:
             self.display.backgroundColor = -1
-        self.display.idle(tIdle)
+        self.display.idle(planner.next(), units='frames')
+
+        # Persistent color buffer (only one element changes per event)
+        colors = np.full([field.nElements, 1], -1.0)
+        geometry = getGridGeometry(self.metadata['length'], self.display)
 
         iEvent = 0
         for iTrial in range(nTrials):
@@ -138,22 +104,23 @@ class SparseNoise(bases.StimulusBase):
                 signal = False
 
             #
-            iSubregion = self.metadata['indices'][iTrial]
-            colors = np.full(field.nElements, -1)
+            iSubregion = self.metadata['indices'][iTrial, 0]
             colors[iSubregion] = 1
-            field.colors = colors.reshape(-1, 1)
+            field.colors = colors
             
             #
             if signal:
                 self.display.signalEvent(3, units='frames')
                 self.metadata['events'][iEvent] = 'spot onset'
                 iEvent += 1
-            for iFrame in range(int(np.ceil(cycle[0] * self.display.fps))):
+            x, y = geometry.coordsInPixels[iSubregion]
+            for iFrame in range(planner.next()):
                 field.draw()
+                self.display.logState('spot', x=x, y=y, size=geometry.lengthInPixels, fieldIndex=iSubregion, value=1)
                 self.display.flip()
 
             #
-            colors = np.full(field.nElements, -1).reshape(-1, 1)
+            colors[iSubregion] = -1
             field.colors = colors
 
             #
@@ -161,12 +128,12 @@ class SparseNoise(bases.StimulusBase):
                 self.display.signalEvent(3, units='frames')
                 self.metadata['events'][iEvent] = 'spot offset'    
                 iEvent += 1
-            for iFrame in range(int(np.ceil(cycle[1] * self.display.fps))):
+            for iFrame in range(planner.next()):
                 field.draw()
                 self.display.flip()
 
         #
-        self.display.idle(tIdle)
+        self.display.idle(planner.next(), units='frames')
 
         return
 
@@ -179,44 +146,44 @@ class SparseNoise(bases.StimulusBase):
         randomize=True,
         correctVerticalReflection=True,
         nTrialsBetweenSignals=1,
+        includeFields=True,
+        schedule=None,
+        verbose=False,
         ):
         """
         """
 
         #
         length = radius * 2
-        coordsInPixels, gridShape = _computeGridPoints(length, self.display)
-        gridHeight, gridWidth = gridShape
-        nSubregions = coordsInPixels.shape[0]
-
-        #
-        nTrials = int(gridWidth * gridHeight * repeats)
+        geometry = getGridGeometry(length, self.display)
+        nSubregions = geometry.nSubregions
 
         #
         field = visual.ElementArrayStim(
             self.display,
-            fieldPos=coordsInPixels,
+            fieldPos=geometry.coordsInPixels,
             fieldShape='sqr',
             nElements=nSubregions,
-            sizes=length * self.display.ppd,
+            sizes=geometry.lengthInPixels,
             colors=np.random.choice([-1, 1], size=nSubregions).reshape(-1, 1),
             elementMask='circle',
             elementTex=None,
             units='pixels', 
         )
 
-        # Generate metadata
-        self._generateMetadata(
-            coordsInPixels,
-            repeats,
-            field,
-            nTrials,
-            gridShape,
-            randomize,
-            correctVerticalReflection
-        )
-        self.metadata['length'] = length
-        self.metadata['cycle'] = cycle
+        # Generate metadata (unless it was generated ahead of time)
+        if schedule is None:
+            self.generateSchedule(
+                radius,
+                cycle,
+                repeats,
+                randomize,
+                correctVerticalReflection,
+                includeFields
+            )
+        else:
+            self.metadata = schedule
+        nTrials = self.metadata['indices'].shape[0]
 
         # Run main loop
         self._runMainLoop(
@@ -224,7 +191,8 @@ class SparseNoise(bases.StimulusBase):
             tIdle,
             cycle,
             nTrials,
-            nTrialsBetweenSignals
+            nTrialsBetweenSignals,
+            verbose
         )
 
         #
@@ -233,6 +201,38 @@ class SparseNoise(bases.StimulusBase):
 
         return
 
+    def generateSchedule(
+        self,
+        radius=5,
+        cycle=(0.5, 0.5),
+        repeats=1,
+        randomize=True,
+        correctVerticalReflection=True,
+        includeFields=True,
+        ):
+        """
+        """
+
+        #
+        length = radius * 2
+        geometry = getGridGeometry(length, self.display)
+        gridHeight, gridWidth = geometry.shape
+        nTrials = int(gridWidth * gridHeight * repeats)
+
+        #
+        self._generateMetadata(
+            geometry,
+            repeats,
+            nTrials,
+            randomize,
+            correctVerticalReflection,
+            includeFields
+        )
+        self.metadata['length'] = length
+        self.metadata['cycle'] = cycle
+
+        return self.metadata
+
     def saveMetadata(self, sessionFolder):
         """
         """
@@ -284,10 +284,6 @@ class SimpleBinaryNoise(bases.StimulusBase):
             'interval': tImage
         }
 
-        # Reflect coordinates across the horizontal axis
-        if correctVerticalReflection:
-            self.metadata['coords'][:, 1] = self.metadata['coords'][:, 1] * -1
-
         #
         countdown = nImagesBetweenFlashes
 
@@ -324,17 +320,25 @@ class SimpleBinaryNoise(bases.StimulusBase):
         tIdle,
         field,
         nTrialsBetweenSignals,
+        verbose=False,
         ):
         """
         """
 
+        # Quantize the whole timeline
+        nTrials = self.metadata['fields'].shape[0]
+        planner = TimingPlanner(self.display.fps)
+        planner.add(tIdle, 'idle')
+        planner.extend(np.full(nTrials, tImage), 'image')
+        planner.add(tIdle, 'idle')
+        planner.report(verbose)
+
         # Change the background to black and wait 5 seconds
         if self.display.backgroundColor != -1:
             self.display.backgroundColor = -1
-        self.display.idle(tIdle, units='seconds')
+        self.display.idle(planner.next(), units='frames')
 
         #
-        nTrials = self.metadata['fields'].shape[0]
         iterable = zip(
             range(nTrials),
             self.metadata['events'],
@@ -354,7 +358,7 @@ class SimpleBinaryNoise(bases.StimulusBase):
                 self.display.setBackgroundColor(1)
                 if signal:
                     self.display.signalEvent(3, units='frames')
-                for iFrame in range(int(np.ceil(tImage * self.display.fps))):
+                for iFrame in range(planner.next()):
                     self.display.drawBackground()
                     self.display.flip()
 
@@ -363,7 +367,7 @@ class SimpleBinaryNoise(bases.StimulusBase):
                 self.display.setBackgroundColor(-1)
                 if signal:
                     self.display.signalEvent(3, units='frames')
-                for iFrame in range(int(np.ceil(tImage * self.display.fps))):
+                for iFrame in range(planner.next()):
                     self.display.drawBackground()
                     self.display.flip()
 
@@ -378,12 +382,13 @@ class SimpleBinaryNoise(bases.StimulusBase):
                     self.display.signalEvent(3, units='frames')
 
                 #
-                for iFrame in range(int(np.ceil(tImage * self.display.fps))):
+                for iFrame in range(planner.next()):
                     field.draw()
+                    self.display.logState('field', fieldIndex=iTrial)
                     self.display.flip()
 
         # Display black screen for 5 seconds
-        self.display.idle(tIdle, units='seconds')
+        self.display.idle(planner.next(), units='frames')
 
         return
 
@@ -397,47 +402,50 @@ class SimpleBinaryNoise(bases.StimulusBase):
         correctVerticalReflection=True,
         nImagesBetweenFlashes=5,
         nTrialsBetweenSignals=1,
+        schedule=None,
+        verbose=False,
         ):
         """
         """
 
-        coordsInPixels, (gridHeight, gridWidth) = _computeGridPoints(length, self.display)
-        coordsInDegrees = coordsInPixels / self.display.ppd
-        nSubregions = coordsInPixels.shape[0]
+        #
+        geometry = getGridGeometry(length, self.display)
+        nSubregions = geometry.nSubregions
         initialColors = np.random.choice([-1, 1], p=[1 - pHigh, pHigh], size=nSubregions).reshape(-1, 1)
 
+        # Populate the metadata dictionary (unless it was generated ahead of time)
+        if schedule is None:
+            self.generateSchedule(
+                length,
+                tImage,
+                nImages,
+                pHigh,
+                correctVerticalReflection,
+                nImagesBetweenFlashes
+            )
+        else:
+            self.metadata = schedule
+
         # Create the visual field
         field = visual.ElementArrayStim(
             self.display,
-            fieldPos=coordsInPixels,
+            fieldPos=geometry.coordsInPixels,
             fieldShape='sqr',
             nElements=nSubregions,
-            sizes=length * self.display.ppd,
+            sizes=geometry.lengthInPixels,
             colors=initialColors,
             elementMask=None,
             elementTex=None,
             units='pixels', 
         )
 
-        # Populate the metadata dictionary
-        gridShape = (gridHeight, gridWidth)
-        self._generateMetadata(
-            gridShape,
-            coordsInDegrees,
-            correctVerticalReflection,
-            length,
-            tImage,
-            nImagesBetweenFlashes,
-            nImages,
-            pHigh,
-        )
-
         #
         self._runMainLoop(
             tImage,
             tIdle,
             field,
             nTrialsBetweenSignals,
+            verbose
         )
 
         # Clean up the events metadata array
@@ -446,6 +454,32 @@ class SimpleBinaryNoise(bases.StimulusBase):
 
         return
 
+    def generateSchedule(
+        self,
+        length=5,
+        tImage=0.5,
+        nImages=10,
+        pHigh=0.2,
+        correctVerticalReflection=True,
+        nImagesBetweenFlashes=5,
+        ):
+        """
+        """
+
+        geometry = getGridGeometry(length, self.display)
+        self._generateMetadata(
+            geometry.shape,
+            geometry.getCoordsInDegrees(correctVerticalReflection),
+            correctVerticalReflection,
+            length,
+            tImage,
+            nImagesBetweenFlashes,
+            nImages,
+            pHigh,
+        )
+
+        return self.metadata
+
     def saveMetadata(self, sessionFolder):
         """
         """
@@ -470,22 +504,11 @@ class JitteredBinaryNoise(bases.StimulusBase):
         """
         """
 
-        nTrials = len(
-            self.metadata['events'])
-        shuffledTrialIndices = np.random.choice(
-            np.arange(nTrials),
-            size=nTrials
-        )
-
-        for key, oldList in self.metadata.items():
-
-            #
-            newList = list()
-            for iTrial in shuffledTrialIndices:
-                newList.append(oldList[iTrial])
-
-            #
-            self.metadata[key] = newList
+        # Each field onset and its offset (if any) are shuffled together
+        isOnset = np.array([event == 'field onset' for event in self.metadata['events']])
+        trials = np.cumsum(isOnset) - 1
+        permutation = computeBlockPermutation(trials)
+        applyRowPermutation(self.metadata, permutation, list(self.metadata.keys()))
 
         return
 
@@ -634,7 +657,7 @@ class JitteredBinaryNoise(bases.StimulusBase):
 
         #
         self.metadata['length'] = length
-        self.metadata['coords'] = coordsInPixels
+        self.metadata['coords'] = np.copy(coordsInPixels)
         self.metadata['shape'] = gridShape
 
         #
@@ -646,22 +669,27 @@ class JitteredBinaryNoise(bases.StimulusBase):
     def _runMainLoop(
         self,
         field,
+        geometry,
         cycle,
         tIdle,
         nTrialsBetweenSignals,
+        verbose=False,
         ):
         """
         """
 
+        # Quantize the whole timeline
+        isOnPhase = np.isin(self.metadata['events'], ('field onset', 'flash onset'))
+        planner = TimingPlanner(self.display.fps)
+        planner.add(tIdle, 'idle')
+        planner.extend(np.where(isOnPhase, cycle[0], cycle[1]), 'trial')
+        planner.add(tIdle, 'idle')
+        planner.report(verbose)
+
         # Change the background to black and idle
         if self.display.backgroundColor != -1:
             self.display.backgroundColor = -1
-        self.display.idle(tIdle, units='seconds')
-
-        #
-        originFieldPosition = field.fieldPos
-        nFramesOnPhase = int(np.ceil(self.display.fps * cycle[0]))
-        nFramesOffPhase = int(np.ceil(self.display.fps * cycle[1]))
+        self.display.idle(planner.next(), units='frames')
 
         #
         iterable = zip(
@@ -679,39 +707,43 @@ class JitteredBinaryNoise(bases.StimulusBase):
                 signal = False
 
             #
+            state = None
             if event == 'field onset':
                 self.display.clearBuffer()
-                field.fieldPos = offset * self.display.ppd + originFieldPosition
+                field.fieldPos = geometry.getJitteredCoords(offset * self.display.ppd)
                 field.colors = colors
                 methodToCall = field.draw
-                nFramesToDraw = nFramesOnPhase
+                state = {
+                    'fieldIndex': iTrial,
+                    'x': offset[0] * self.display.ppd,
+                    'y': offset[1] * self.display.ppd
+                }
 
             #
             elif event == 'field offset':
                 self.display.setBackgroundColor(-1)
                 methodToCall = self.display.drawBackground
-                nFramesToDraw = nFramesOffPhase
 
             #
             elif event == 'flash onset':
                 self.display.setBackgroundColor(1)
                 methodToCall = self.display.drawBackground
-                nFramesToDraw = nFramesOnPhase
 
             #
             elif event == 'flash offset':
                 self.display.setBackgroundColor(-1)
                 methodToCall = self.display.drawBackground
-                nFramesToDraw = nFramesOffPhase
 
             if signal:
                 self.display.signalEvent(3, units='frames')
-            for iFrame in range(nFramesToDraw):
+            for iFrame in range(planner.next()):
                 methodToCall()
+                if state is not None:
+                    self.display.logState('field', **state)
                 self.display.flip()
 
         #
-        self.display.idle(tIdle)
+        self.display.idle(planner.next(), units='frames')
 
         return
 
@@ -727,56 +759,90 @@ class JitteredBinaryNoise(bases.StimulusBase):
         correctVerticalReflection=True,
         nTrialsBetweenFlashes=5,
         nTrialsBetweenSignals=1,
+        schedule=None,
+        verbose=False,
         ):
         """
         """
 
         #
-        coordsInPixels, gridShape = _computeGridPoints(length, self.display)
-        nSubregions = coordsInPixels.shape[0]
+        geometry = getGridGeometry(length, self.display)
+        nSubregions = geometry.nSubregions
         initialColors = np.random.choice([-1, 1], p=[1 - pHigh, pHigh], size=nSubregions).reshape(-1, 1)
 
+        # Create the metadata container (unless it was generated ahead of time)
+        if schedule is None:
+            self.generateSchedule(
+                length,
+                repeats,
+                nImages,
+                cycle,
+                pHigh,
+                randomize,
+                correctVerticalReflection,
+                nTrialsBetweenFlashes
+            )
+        else:
+            self.metadata = schedule
+
         # Create the visual field
         field = visual.ElementArrayStim(
             self.display,
-            fieldPos=coordsInPixels,
+            fieldPos=geometry.coordsInPixels,
             fieldShape='sqr',
             nElements=nSubregions,
-            sizes=length * self.display.ppd,
+            sizes=geometry.lengthInPixels,
             colors=initialColors,
             elementMask=None,
             elementTex=None,
             units='pixels', 
         )
 
-        # Create the metadata container
+        # Run main presentation loop
+        self._runMainLoop(
+            field,
+            geometry,
+            cycle,
+            tIdle,
+            nTrialsBetweenSignals,
+            verbose
+        )
+
+        return
+
+    def generateSchedule(
+        self,
+        length=10,
+        repeats=1,
+        nImages=20,
+        cycle=(0.5, 0.5),
+        pHigh=0.2,
+        randomize=True,
+        correctVerticalReflection=True,
+        nTrialsBetweenFlashes=5,
+        ):
+        """
+        """
+
         # shiftInPixels = round(length / 2 * self.display.ppd, 2)
+        geometry = getGridGeometry(length, self.display)
         shiftInDegrees = round(length / 2, 2)
         self._generateMetadata(
             nImages,
             repeats,
             pHigh,
-            nSubregions,
+            geometry.nSubregions,
             shiftInDegrees,
-            coordsInPixels,
+            geometry.coordsInPixels,
             randomize,
             length,
             correctVerticalReflection,
             nTrialsBetweenFlashes,
             cycle,
-            gridShape
+            geometry.shape
         )
 
-
-        # Run main presentation loop
-        self._runMainLoop(
-            field,
-            cycle,
-            tIdle,
-            nTrialsBetweenSignals
-        )
-
-        return
+        return self.metadata
 
     def saveMetadata(self, sessionFolder):
         """
@@ -851,13 +917,7 @@ class JitteredBinaryNoise2(bases.StimulusBase):
             for iRepeat in range(nBlockRepeats):
 
                 #
-                barcodes = np.array(list(images.keys()))
-                if randomizeImagesWithinBlocks:
-                    index = np.random.choice(np.arange(barcodes.size), replace=False, size=barcodes.size)
-                    barcodes[:] = barcodes[index]
-
-                #
-                for barcode in barcodes:
+                for barcode in images.keys():
                     values = images[barcode]
                     self.metadata['blocks'][iTrial] = iBlock + 1
                     self.metadata['values'][iTrial] = values
@@ -868,12 +928,21 @@ class JitteredBinaryNoise2(bases.StimulusBase):
                 #
                 iBlock += 1
 
+        # Randomize the order of images within each block
+        if randomizeImagesWithinBlocks:
+            permutation = computeBlockPermutation(
+                self.metadata['blocks'],
+                shuffleBlocks=False,
+                shuffleWithinBlocks=True
+            )
+            applyRowPermutation(self.metadata, permutation, ('blocks', 'values', 'jittered', 'barcodes'))
 
         return
 
     def _runMainLoop(
         self,
         field,
+        geometry,
         fieldCycle,
         offsetInPixels,
         tIdle,
@@ -881,23 +950,34 @@ class JitteredBinaryNoise2(bases.StimulusBase):
         flashCycle,
         nSignalFramesForField,
         nSignalFramesForFlash,
+        verbose=False,
         ):
         """
         """
 
-        #
-        gridNodes = field.fieldPos
+        # Quantize the whole timeline
+        planner = TimingPlanner(self.display.fps)
+        planner.add(tIdle, 'idle')
+        for iTrial in range(self.metadata['values'].shape[0]):
+            if iTrial % nTrialsBetweenFlashes == 0:
+                planner.extend(flashCycle, 'flash')
+            planner.add(fieldCycle[0], 'field')
+            if fieldCycle[1] != 0:
+                planner.add(fieldCycle[1], 'field')
+        planner.add(tIdle, 'idle')
+        planner.report(verbose)
 
         #
         if self.display.backgroundColor != -1:
             self.display.setBackgroundColor(-1)
-        for iFrame in range(int(np.ceil(self.display.fps * tIdle))):
+        for iFrame in range(planner.next()):
             self.display.drawBackground()
             self.display.flip()
 
         #
         iTrial = 0
         iEvent = 0
+        fieldOffset = np.zeros(2)
 
         #
         iterable = zip(
@@ -914,7 +994,7 @@ class JitteredBinaryNoise2(bases.StimulusBase):
                 iEvent += 1
                 self.display.signalEvent(nSignalFramesForFlash, units='frames')
                 self.display.setBackgroundColor(1)
-                for iFrame in range(int(np.ceil(self.display.fps * flashCycle[0]))):
+                for iFrame in range(planner.next()):
                     self.display.drawBackground()
                     self.display.flip()
 
@@ -923,21 +1003,23 @@ class JitteredBinaryNoise2(bases.StimulusBase):
                 iEvent += 1
                 self.display.setBackgroundColor(-1)
                 self.display.signalEvent(nSignalFramesForFlash, units='frames')
-                for iFrame in range(int(np.ceil(self.display.fps * flashCycle[1]))):
+                for iFrame in range(planner.next()):
                     self.display.drawBackground()
                     self.display.flip()
 
             #
             field.colors = colors
             if jittered:
-                field.fieldPos = gridNodes + offsetInPixels
+                field.fieldPos = geometry.getJitteredCoords(offsetInPixels)
+                fieldOffset = offsetInPixels
 
             #
             self.metadata['events'][iEvent] = 'field onset'
             iEvent += 1
             self.display.signalEvent(nSignalFramesForField, units='frames')
-            for iFrame in range(int(np.ceil(self.display.fps * fieldCycle[0]))):
+            for iFrame in range(planner.next()):
                 field.draw()
+                self.display.logState('field', fieldIndex=iTrial, x=fieldOffset[0], y=fieldOffset[1])
                 timestamp = self.display.flip()
 
             #
@@ -945,7 +1027,7 @@ class JitteredBinaryNoise2(bases.StimulusBase):
                 self.metadata['events'][iEvent] = 'field offset'
                 iEvent += 1
                 self.display.signalEvent(nSignalFramesForField, units='frames')
-                for iFrame in range(int(np.ceil(self.display.fps * fieldCycle[1]))):
+                for iFrame in range(planner.next()):
                     self.display.drawBackground()
                     self.display.flip()
 
@@ -953,7 +1035,7 @@ class JitteredBinaryNoise2(bases.StimulusBase):
             iTrial += 1
 
         #
-        for iFrame in range(int(np.ceil(self.display.fps * tIdle))):
+        for iFrame in range(planner.next()):
             self.display.drawBackground()
             self.display.flip()
 
@@ -982,40 +1064,46 @@ class JitteredBinaryNoise2(bases.StimulusBase):
         nSignalFramesForField=3,
         nSignalFramesForFlash=6,
         randomizeImagesWithinBlocks=False,
+        schedule=None,
+        verbose=False,
         ):
         """
         """
 
+        # Generate the metadata (unless it was generated ahead of time)
+        if schedule is None:
+            self.generateSchedule(
+                length,
+                nBlockRepeats,
+                nUniqueImages,
+                includeJitteredBlocks,
+                pSubregionHigh,
+                randomizeImagesWithinBlocks
+            )
+        else:
+            self.metadata = schedule
+
         #
-        coordsInPixels, gridShape = _computeGridPoints(length, self.display)
-        nSubregions = coordsInPixels.shape[0]
+        geometry = getGridGeometry(length, self.display)
+        nSubregions = geometry.nSubregions
 
         # Create the visual field
         field = visual.ElementArrayStim(
             self.display,
-            fieldPos=coordsInPixels,
+            fieldPos=geometry.coordsInPixels,
             fieldShape='sqr',
             nElements=nSubregions,
-            sizes=length * self.display.ppd,
+            sizes=geometry.lengthInPixels,
             elementMask=None,
             elementTex=None,
             units='pixels', 
         )
 
-        #
-        self._generateMetadata(
-            nUniqueImages,
-            nBlockRepeats,
-            includeJitteredBlocks,
-            pSubregionHigh,
-            nSubregions,
-            randomizeImagesWithinBlocks
-        )
-
         #
         offsetInPixels = np.full(2, round(length / 2 * self.display.ppd, 2)) * np.array(jitterDirection)
         self._runMainLoop(
             field,
+            geometry,
             fieldCycle,
             offsetInPixels,
             tIdle,
@@ -1023,16 +1111,39 @@ class JitteredBinaryNoise2(bases.StimulusBase):
             flashCycle,
             nSignalFramesForField,
             nSignalFramesForFlash,
+            verbose
         )
 
         #
-        self.metadata['coords'] = np.around(coordsInPixels / self.display.ppd, 2)
-        if correctVerticalReflection:
-            self.metadata['coords'][:, 1] *= -1
-        self.metadata['shape'] = gridShape
+        self.metadata['coords'] = geometry.getCoordsInDegrees(correctVerticalReflection, decimals=2)
+        self.metadata['shape'] = geometry.shape
         self.metadata['length'] = length
 
         return
+
+    def generateSchedule(
+        self,
+        length=10,
+        nBlockRepeats=1,
+        nUniqueImages=10,
+        includeJitteredBlocks=True,
+        pSubregionHigh=0.2,
+        randomizeImagesWithinBlocks=False,
+        ):
+        """
+        """
+
+        geometry = getGridGeometry(length, self.display)
+        self._generateMetadata(
+            nUniqueImages,
+            nBlockRepeats,
+            includeJitteredBlocks,
+            pSubregionHigh,
+            geometry.nSubregions,
+            randomizeImagesWithinBlocks
+        )
+
+        return self.metadata
         
     def saveMetadata(self, sessionFolder):
         """
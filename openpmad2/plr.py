@@ -3,9 +3,9 @@ import numpy as np
 import pathlib as pl
 from psychopy import visual
 from itertools import product
-# from myphdlib import labjack as lj
+from openpmad2 import labjack as lj
 
-def postprocess(sessionFolder, camera=6, stimulus=7):
+def postprocess(sessionFolder, camera=6, stimulus=7, chunkSize=1000000):
     """
     """
 
@@ -17,30 +17,22 @@ def postprocess(sessionFolder, camera=6, stimulus=7):
         raise Exception('Could not located LabJack folder')
     labjackFolder = str(results.pop())
 
-    #
-    data = lj.loadLabjackData(labjackFolder)
-    timestamps = data[:, 0]
-    exposureOnsetSignal, exposureOnsetIndices = lj.extractLabjackEvent(data, camera, edge='both')
-    stimulusOnsetSignal, stimulusOnsetIndices = lj.extractLabjackEvent(data, stimulus, edge='rising')
+    # The recording is streamed once for all of the digital channels
+    edges = lj.extractLabjackEdges(labjackFolder, chunkSize=chunkSize)
+    lj.saveLabjackEdges(edges, str(sessionFolderPath.joinpath('labjackEdges.npz')))
+    exposureOnsetTimestamps = lj.getEdgeTimestamps(edges, camera, edge='both')
+    stimulusOnsetTimestamps = lj.getEdgeTimestamps(edges, stimulus, edge='rising')
 
     # Discared the first stimulus; this is the dark adaptation period
-    stimulusOnsetIndices = stimulusOnsetIndices[1:]
+    stimulusOnsetTimestamps = stimulusOnsetTimestamps[1:]
 
     #
     stimulusOnsetTimestampsFilePath = str(sessionFolderPath.joinpath('stimulusOnsetTimestamps.txt'))
-    with open(stimulusOnsetTimestampsFilePath, 'w') as stream:
-        for timestamp in timestamps[stimulusOnsetIndices][0::2]:
-            stream.write(f'{timestamp:.3f}\n')
-    
+    np.savetxt(stimulusOnsetTimestampsFilePath, stimulusOnsetTimestamps[0::2], fmt='%.3f')
     stimulusOffsetTimestampsFilePath = str(sessionFolderPath.joinpath('stimulusOffsetTimestamps.txt'))
-    with open(stimulusOffsetTimestampsFilePath, 'w') as stream:
-        for timestamp in timestamps[stimulusOnsetIndices][1::2]:
-            stream.write(f'{timestamp:.3f}\n')
-    
+    np.savetxt(stimulusOffsetTimestampsFilePath, stimulusOnsetTimestamps[1::2], fmt='%.3f')
     exposureOnsetTimestampsFilePath = str(sessionFolderPath.joinpath('exposureOsetTimestamps.txt'))
-    with open(exposureOnsetTimestampsFilePath, 'w') as stream:
-        for timestamp in timestamps[exposureOnsetIndices]:
-            stream.write(f'{timestamp:.3f}\n')  
+    np.savetxt(exposureOnsetTimestampsFilePath, exposureOnsetTimestamps, fmt='%.3f')
 
     return
 
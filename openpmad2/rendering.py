@@ -0,0 +1,456 @@
+import numpy as np
+from openpmad2 import warping
+from openpmad2.geometry import getGridGeometry
+from openpmad2.writing import readStateLog, STATE_KINDS
+
+def computePhaseSequence(temporalFrequency, nFrames, fps=60, initialPhase=0, direction=1):
+    """
+    Compute the phase of a drifting grating on each frame (in cycles)
+
+    keywords
+    --------
+    temporalFrequency
+        Temporal frequency of the grating (in cycles per second)
+    nFrames
+        Number of frames
+    fps
+        Frame rate of the display
+    initialPhase
+        Phase on the first frame (in cycles)
+    direction
+        Direction of motion (-1 or 1)
+    """
+
+    cpf = temporalFrequency / fps * direction
+    phases = np.mod(initialPhase + np.arange(nFrames) * cpf, 1)
+
+    return phases
+
+class GratingSynthesizer():
+    """
+    Renders blocks of sinusoidal grating frames on the CPU
+
+    The luminance of a grating is separable along the rows and columns of the
+    frame, i.e., sin(ax + by + phi) = sin(ax + phi) cos(by) + cos(ax + phi) sin(by),
+    so each frame is the product of two small sinusoid tables and a whole
+    block of frames is rendered with a single batched matrix product. The
+    conventions follow GratingStim (orientation in degrees clockwise, phase
+    in cycles, contrast from 0 to 1, luminance from -1 to 1).
+    """
+
+    def __init__(self, width=1280, height=720, ppd=None, warp=False, backgroundColor=-1):
+        """
+        keywords
+        --------
+        width
+            Width of the frames (in pixels)
+        height
+            Height of the frames (in pixels)
+        ppd
+            Pixels per degree of visual angle (required for spatial frequencies in degrees)
+        warp
+            Apply the affine transformation to each frame (see warping.WarpMap)
+        backgroundColor
+            Luminance of the pixels outside of the warped region (-1 to 1)
+        """
+
+        self._width = width
+        self._height = height
+        self._ppd = ppd
+        self._backgroundColor = backgroundColor
+
+        # Coordinates of the pixel centers with the origin in the center of the frame
+        self._x = np.arange(width) - width / 2 + 0.5
+        self._y = height / 2 - np.arange(height) - 0.5
+
+        #
+        if warp:
+            self._warpMap = warping.getWarpMap((height, width))
+        else:
+            self._warpMap = None
+
+        return
+
+    @classmethod
+    def fromDisplay(cls, display, warp=False):
+        """
+        Create a synthesizer with the same geometry as a display
+        """
+
+        synthesizer = cls(
+            display.width,
+            display.height,
+            display.ppd,
+            warp,
+            display.backgroundColor
+        )
+
+        return synthesizer
+
+    def render(
+        self,
+        spatialFrequencies,
+        orientations,
+        phases,
+        contrasts=1,
+        units='pixels',
+        dtype=np.float32,
+        out=None,
+        ):
+        """
+        Render a block of frames
+
+        keywords
+        --------
+        spatialFrequencies
+            Spatial frequency for each frame (in cycles per pixel or cycles per degree)
+        orientations
+            Orientation for each frame (in degrees)
+        phases
+            Phase for each frame (in cycles)
+        contrasts
+            Contrast for each frame
+        units
+            Unit of the spatial frequencies (pixels or degrees)
+        dtype
+            Data type of the frames (float32 from -1 to 1 or uint8 from 0 to 255)
+        out
+            Optional float32 array with shape (nFrames, height, width)
+
+        returns
+        -------
+        frames
+            Array with shape (nFrames, height, width)
+        """
+
+        spatialFrequencies, orientations, phases, contrasts = np.broadcast_arrays(
+            np.asarray(spatialFrequencies, dtype=float).flatten(),
+            np.asarray(orientations, dtype=float).flatten(),
+            np.asarray(phases, dtype=float).flatten(),
+            np.asarray(contrasts, dtype=float).flatten()
+        )
+        nFrames = spatialFrequencies.size
+
+        #
+        if units == 'degrees':
+            if self._ppd is None:
+                raise Exception('Pixels per degree must be specified for spatial frequencies in degrees')
+            spatialFrequencies = spatialFrequencies / self._ppd
+        elif units != 'pixels':
+            raise Exception(f'{units} is an invalid unit of spatial frequency')
+
+        # The row tables only depend on the spatial frequency and orientation
+        pairs, inverse = np.unique(
+            np.column_stack([spatialFrequencies, orientations]),
+            axis=0,
+            return_inverse=True
+        )
+        inverse = inverse.flatten()
+        theta = np.deg2rad(pairs[:, 1])
+        b = -2 * np.pi * pairs[:, 0] * np.sin(theta)
+        rowTables = np.stack([
+            np.cos(b.reshape(-1, 1) * self._y),
+            np.sin(b.reshape(-1, 1) * self._y)
+        ], axis=2).astype(np.float32)
+
+        # The column tables carry the phase and contrast of each frame
+        a = 2 * np.pi * spatialFrequencies * np.cos(np.deg2rad(orientations))
+        argument = a.reshape(-1, 1) * self._x + 2 * np.pi * phases.reshape(-1, 1)
+        columnTables = np.stack([
+            np.sin(argument),
+            np.cos(argument)
+        ], axis=1) * contrasts.reshape(-1, 1, 1)
+
+        #
+        if self._warpMap is None:
+            if out is None:
+                out = np.empty([nFrames, self._height, self._width], dtype=np.float32)
+            np.matmul(rowTables[inverse], columnTables.astype(np.float32), out=out)
+        else:
+            unwarped = np.matmul(rowTables[inverse], columnTables.astype(np.float32))
+            out = self._warpMap.apply(unwarped, cval=self._backgroundColor, out=out)
+
+        #
+        if np.dtype(dtype) == np.uint8:
+            frames = np.around((np.clip(out, -1, 1) + 1) * 127.5).astype(np.uint8)
+        else:
+            frames = out.astype(dtype, copy=False)
+
+        return frames
+
+    def iterate(
+        self,
+        spatialFrequencies,
+        orientations,
+        phases,
+        contrasts=1,
+        units='pixels',
+        dtype=np.float32,
+        blockSize=120,
+        ):
+        """
+        Render a long sequence of frames in blocks (bounds the memory footprint)
+        """
+
+        spatialFrequencies, orientations, phases, contrasts = np.broadcast_arrays(
+            np.asarray(spatialFrequencies, dtype=float).flatten(),
+            np.asarray(orientations, dtype=float).flatten(),
+            np.asarray(phases, dtype=float).flatten(),
+            np.asarray(contrasts, dtype=float).flatten()
+        )
+
+        #
+        buffer = np.empty([blockSize, self._height, self._width], dtype=np.float32)
+        for start in range(0, spatialFrequencies.size, blockSize):
+            stop = min(start + blockSize, spatialFrequencies.size)
+            frames = self.render(
+                spatialFrequencies[start: stop],
+                orientations[start: stop],
+                phases[start: stop],
+                contrasts[start: stop],
+                units,
+                dtype,
+                buffer[: stop - start]
+            )
+            yield frames
+
+        return
+
+    def export(
+        self,
+        writer,
+        spatialFrequencies,
+        orientations,
+        phases,
+        contrasts=1,
+        units='pixels',
+        blockSize=120,
+        ):
+        """
+        Stream a sequence of frames into a video writer (see writing.py)
+
+        returns
+        -------
+        nFrames
+            The number of frames written
+        """
+
+        nFrames = 0
+        for frames in self.iterate(spatialFrequencies, orientations, phases, contrasts, units, np.uint8, blockSize):
+            for frame in frames:
+                writer.write(frame)
+            nFrames += frames.shape[0]
+
+        return nFrames
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def ppd(self):
+        return self._ppd
+
+class StateLogRenderer():
+    """
+    Reconstructs frames from a stimulus state log (see WarpedWindow.openStateLog)
+    """
+
+    def __init__(self, header, warp=False, metadata=None):
+        """
+        keywords
+        --------
+        header
+            Header of the state log (see writing.readStateLog)
+        warp
+            Apply the affine transformation to each frame
+        metadata
+            Metadata of the noise protocol which was presented (required to
+            reconstruct frames with noise fields)
+        """
+
+        self._header = header
+        self._width = header['width']
+        self._height = header['height']
+        self._ppd = header['ppd']
+        self._metadata = metadata
+        self._fieldColors = None
+        self._synthesizer = GratingSynthesizer(self._width, self._height, header['ppd'])
+        self._x, self._y = np.meshgrid(
+            np.arange(self._width) - self._width / 2 + 0.5,
+            self._height / 2 - np.arange(self._height) - 0.5
+        )
+
+        # Rectangle of the signal patch in image coordinates
+        x, y, w, h = header['patchCoords']
+        self._patchRectangle = (
+            int(round(self._height / 2 - y - h / 2)),
+            int(round(self._height / 2 - y + h / 2)),
+            int(round(self._width / 2 + x - w / 2)),
+            int(round(self._width / 2 + x + w / 2)),
+        )
+
+        #
+        if warp:
+            self._warpMap = warping.getWarpMap((self._height, self._width))
+        else:
+            self._warpMap = None
+
+        return
+
+    def render(self, records, dtype=np.float32):
+        """
+        Render the frame for each record
+
+        returns
+        -------
+        frames
+            Array with shape (nRecords, height, width)
+        """
+
+        nFrames = records.size
+        frames = np.empty([nFrames, self._height, self._width], dtype=np.float32)
+        frames[:] = records['background'].reshape(-1, 1, 1)
+
+        # Gratings cover the whole display
+        mask = records['kind'] == STATE_KINDS['grating']
+        if mask.any():
+            frames[mask] = self._synthesizer.render(
+                records['sf'][mask],
+                records['ori'][mask],
+                records['phase'][mask],
+                records['contrast'][mask]
+            )
+
+        # Bars are longer than the display, so only their width matters
+        for iFrame in np.flatnonzero(records['kind'] == STATE_KINDS['bar']):
+            record = records[iFrame]
+            theta = np.deg2rad(record['ori'])
+            distance = (self._x - record['x']) * np.cos(theta) - (self._y - record['y']) * np.sin(theta)
+            frames[iFrame][np.abs(distance) <= record['size'] / 2] = record['value']
+
+        #
+        for iFrame in np.flatnonzero(records['kind'] == STATE_KINDS['spot']):
+            record = records[iFrame]
+            distance = np.square(self._x - record['x']) + np.square(self._y - record['y'])
+            frames[iFrame][distance <= np.square(record['size'] / 2)] = record['value']
+
+        # Noise fields are looked up in the metadata of the protocol
+        for iFrame in np.flatnonzero(records['kind'] == STATE_KINDS['field']):
+            record = records[iFrame]
+            frames[iFrame] = self._renderField(
+                record['fieldIndex'],
+                record['x'],
+                record['y'],
+                record['background']
+            )
+
+        #
+        row1, row2, column1, column2 = self._patchRectangle
+        patchLevels = self._header.get('patchLevels', 2)
+        frames[:, row1: row2, column1: column2] = (-1 + 2 * np.minimum(records['patch'], patchLevels - 1) / (patchLevels - 1)).reshape(-1, 1, 1)
+
+        #
+        if self._warpMap is not None:
+            frames = self._warpMap.apply(frames, cval=-1)
+
+        #
+        if np.dtype(dtype) == np.uint8:
+            frames = np.around((np.clip(frames, -1, 1) + 1) * 127.5).astype(np.uint8)
+
+        return frames
+
+    def _renderField(self, fieldIndex, x, y, background):
+        """
+        Render the noise field in a row of the metadata (shifted by x and y)
+        """
+
+        if self._metadata is None:
+            raise Exception('The metadata of the protocol is required to render noise fields')
+        if self._fieldColors is None:
+            self._fieldColors = extractFieldColors(self._metadata)
+
+        # Shift the map from pixels to subregions by the jitter
+        indexMap = getGridGeometry(self._metadata['length'], self).indexMap
+        dx, dy = int(round(x)), -int(round(y))
+        shifted = np.full(indexMap.shape, -1, dtype=np.int32)
+        shifted[max(0, dy): self._height + min(0, dy), max(0, dx): self._width + min(0, dx)] = \
+            indexMap[max(0, -dy): self._height + min(0, -dy), max(0, -dx): self._width + min(0, -dx)]
+
+        #
+        colors = self._fieldColors[fieldIndex]
+        frame = np.where(shifted >= 0, colors[np.maximum(shifted, 0)], background).astype(np.float32)
+
+        return frame
+
+    def iterate(self, records, dtype=np.float32, blockSize=120):
+        """
+        Render a long range of records in blocks
+        """
+
+        for start in range(0, records.size, blockSize):
+            yield self.render(records[start: start + blockSize], dtype)
+
+        return
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def ppd(self):
+        return self._ppd
+
+def extractFieldColors(metadata):
+    """
+    Collect the color of each subregion for each row of the metadata of a
+    binary noise protocol
+
+    returns
+    -------
+    colors
+        Array with shape (nRows, nSubregions)
+    """
+
+    for key in ('colors', 'values', 'fields'):
+        if key in metadata.keys():
+            colors = np.asarray(metadata[key], dtype=np.float32)
+            break
+    else:
+        raise Exception('The metadata does not contain any noise fields')
+
+    return colors.reshape(colors.shape[0], -1)
+
+def renderStateLog(filename, start=0, stop=None, warp=False, dtype=np.float32, metadata=None):
+    """
+    Reconstruct a range of frames from a stimulus state log
+
+    keywords
+    --------
+    filename
+        Path to the state log
+    start
+        Index of the first frame
+    stop
+        Index of the last frame (exclusive)
+    warp
+        Apply the affine transformation to each frame
+    dtype
+        Data type of the frames (float32 from -1 to 1 or uint8 from 0 to 255)
+    metadata
+        Metadata of the noise protocol (required for noise fields)
+    """
+
+    header, records = readStateLog(filename)
+    renderer = StateLogRenderer(header, warp, metadata)
+    frames = renderer.render(np.array(records[start: stop]), dtype)
+
+    return frames
@@ -1,8 +1,184 @@
-import copy
 import pickle
 import numpy as np
 import pathlib as pl
 from psychopy import visual
+from openpmad2.timing import TimingPlanner
+from openpmad2.helpers import computeBlockPermutation, applyRowPermutation
+
+def buildTrialTemplate(
+    nFrames,
+    cpf,
+    baselineContrast,
+    saccadePhase=None,
+    probeContrast=None,
+    probeOnsetInFrames=0,
+    probeDurationInFrames=0,
+    ):
+    """
+    Determine the phase increment, contrast, and event for each frame of a
+    single trial (fictive saccade, probe, or both)
+
+    keywords
+    --------
+    nFrames
+        Number of frames in the trial
+    cpf
+        Phase increment (in cycles per frame) outside of the fictive saccade
+    baselineContrast
+        Contrast of the grating outside of the probe
+    saccadePhase
+        Phase increment for each frame of the fictive saccade (None for no saccade)
+    probeContrast
+        Contrast of the grating during the probe (None for no probe)
+    probeOnsetInFrames
+        Latency from the start of the trial to the probe onset
+    probeDurationInFrames
+        Duration of the probe
+    """
+
+    #
+    template = {
+        'phase': np.full(nFrames, cpf, dtype=float),
+        'contrast': np.full(nFrames, baselineContrast, dtype=float),
+        'events': np.full(nFrames, '', dtype=object),
+    }
+
+    #
+    if saccadePhase is not None:
+        n = min(len(saccadePhase), nFrames)
+        template['phase'][:n] = saccadePhase[:n]
+        template['events'][0] = 'saccade onset'
+
+    #
+    if probeContrast is not None:
+        probeOffsetInFrames = probeOnsetInFrames + probeDurationInFrames
+        template['contrast'][probeOnsetInFrames: probeOffsetInFrames] = probeContrast
+        template['events'][probeOnsetInFrames] = 'probe onset'
+
+    return template
+
+class GratingTrajectory():
+    """
+    Collects the per-frame phase increments and contrast of a grating for an
+    entire session and compiles them into cumulative trajectories
+    """
+
+    def __init__(self):
+        """
+        """
+
+        self._phase = list()
+        self._contrast = list()
+        self._visible = list()
+        self._events = list()
+
+        return
+
+    def append(self, nFrames, cpf=0, contrast=1, visible=True):
+        """
+        Append a segment with a constant phase increment and contrast
+
+        keywords
+        --------
+        nFrames
+            Number of frames in the segment
+        cpf
+            Phase increment (in cycles per frame)
+        contrast
+            Contrast of the grating
+        visible
+            Draw the grating (True) or the background (False)
+        """
+
+        self._phase.append(np.full(nFrames, cpf, dtype=float))
+        self._contrast.append(np.full(nFrames, contrast, dtype=float))
+        self._visible.append(np.full(nFrames, visible))
+        self._events.append(np.full(nFrames, '', dtype=object))
+
+        return
+
+    def extend(self, template, gain=1):
+        """
+        Append a trial template (see buildTrialTemplate)
+
+        keywords
+        --------
+        template
+            Dict with the phase increment, contrast, and event for each frame
+        gain
+            Multiplier for the phase increments (e.g., the direction of motion)
+        """
+
+        self._phase.append(template['phase'] * gain)
+        self._contrast.append(template['contrast'])
+        self._visible.append(np.full(template['phase'].size, True))
+        self._events.append(template['events'])
+
+        return
+
+    def compile(self):
+        """
+        Compute the phase and contrast of the grating for every frame
+        """
+
+        trajectory = {
+            'phase': np.mod(np.cumsum(np.concatenate(self._phase)), 1),
+            'contrast': np.concatenate(self._contrast),
+            'visible': np.concatenate(self._visible),
+            'events': np.concatenate(self._events),
+        }
+
+        return trajectory
+
+def presentTrajectory(display, gabor, trajectory, nSignalFrames=2):
+    """
+    Present a compiled grating trajectory
+
+    keywords
+    --------
+    display
+        The display (WarpedWindow)
+    gabor
+        The grating (GratingStim)
+    trajectory
+        Compiled trajectory (see GratingTrajectory.compile)
+    nSignalFrames
+        Number of frames to flash the signal patch for each event
+
+    returns
+    -------
+    events
+        List of (event, timestamp) tuples
+    """
+
+    #
+    phases = trajectory['phase']
+    contrasts = trajectory['contrast']
+    visible = trajectory['visible']
+    labels = trajectory['events']
+    isEvent = labels != ''
+
+    #
+    events = list()
+    currentContrast = None
+    sf, ori = float(np.ravel(gabor.sf)[0]), float(gabor.ori)
+    for iFrame in range(phases.size):
+        if visible[iFrame]:
+            gabor.phase = phases[iFrame]
+            if contrasts[iFrame] != currentContrast:
+                currentContrast = contrasts[iFrame]
+                gabor.contrast = currentContrast
+            gabor.draw()
+            display.logState('grating', sf=sf, ori=ori, phase=phases[iFrame], contrast=currentContrast)
+        else:
+            display.drawBackground()
+        if isEvent[iFrame]:
+            display.signalEvent(nSignalFrames, units='frames')
+        timestamp = display.flip()
+        if isEvent[iFrame]:
+            events.append((labels[iFrame], timestamp))
+
+    return events
 
 class DriftingGratingWithFictiveSaccades():
     """
@@ -55,29 +231,8 @@ class DriftingGratingWithFictiveSaccades():
 
         # Randomize blocks
         if randomizeBlocks:
-
-            #
-            uniqueBlockIndices = np.unique(self.metadata['blocks'].flatten())
-            uniqueBlockIndices.sort()
-            shuffledBlockIndices = np.copy(uniqueBlockIndices)
-
-            #
-            np.random.shuffle(shuffledBlockIndices)
-            metadata2 = copy.deepcopy(self.metadata)
-
-            #
-            for iBlockTarget, iBlockSource in enumerate(shuffledBlockIndices):
-                rowIndicesSource, columnIndicesSource = np.where(self.metadata['blocks'] == iBlockSource)
-                rowIndicesTarget = np.arange(nTrialsPerBlock * 2) + (iBlockTarget * nTrialsPerBlock * 2)
-                for key in ('blocks', 'motion', 'probed'):
-                    try:
-                        metadata2[key][rowIndicesTarget] = self.metadata[key][rowIndicesSource]
-                    except:
-                        import pdb; pdb.set_trace()
-                    
-            #
-            self.metadata = None
-            self.metadata = metadata2
+            permutation = computeBlockPermutation(self.metadata['blocks'])
+            applyRowPermutation(self.metadata, permutation, ('blocks', 'motion', 'probed'))
 
         return
     
@@ -132,51 +287,27 @@ class DriftingGratingWithFictiveSaccades():
 
         #
         sequence = {
-            'probed': {
-                'phase': np.full(nFramesInSequence, np.nan),
-                'signal': np.full(nFramesInSequence, False),
-                'contrast': np.full(nFramesInSequence, np.nan)
-            },
-            'unprobed': {                
-                'phase': np.full(nFramesInSequence, np.nan),
-                'signal': np.full(nFramesInSequence, False),
-                'contrast': np.full(nFramesInSequence, np.nan)
-            },
+            'probed': buildTrialTemplate(
+                nFramesInSequence,
+                cpf1,
+                baselineContrast,
+                cpf2,
+                probeContrast,
+                probeLatencyInFrames,
+                probeDurationInFrames
+            ),
+            'unprobed': buildTrialTemplate(
+                nFramesInSequence,
+                cpf1,
+                baselineContrast,
+                cpf2,
+            ),
         }
 
-        #
-        for iFrame in range(nFramesInSequence):
-
-            #
-            if iFrame == 0:
-                sequence['probed']['signal'][iFrame] = True
-                sequence['unprobed']['signal'][iFrame] = True
-            elif iFrame == probeLatencyInFrames:
-                sequence['probed']['signal'][iFrame] = True
-                sequence['unprobed']['signal'][iFrame] = False
-            else:
-                sequence['probed']['signal'][iFrame] = False
-
-            #
-            if iFrame < nFramesPerSaccade:
-                sequence['probed']['phase'][iFrame] = cpf2[iFrame]
-                sequence['unprobed']['phase'][iFrame] = cpf2[iFrame]
-            else:
-                sequence['probed']['phase'][iFrame] = cpf1
-                sequence['unprobed']['phase'][iFrame] = cpf1
-
-            # Contrast
-            if iFrame >= probeLatencyInFrames:
-                sequence['probed']['contrast'][iFrame] = probeContrast
-                sequence['unprobed']['contrast'][iFrame] = baselineContrast
-            else:
-                sequence['probed']['contrast'][iFrame] = baselineContrast
-                sequence['unprobed']['contrast'][iFrame] = baselineContrast
-
-        # Last frame in the sequence returns the contrast to baseline
+        # Last frame in the sequence returns the grating to baseline
         for key in ('probed', 'unprobed'):
-            for param, value in zip(['phase', 'signal', 'contrast'], [cpf1, False, baselineContrast]):
-                sequence[key][param][-1] = value
+            sequence[key]['phase'][-1] = cpf1
+            sequence[key]['contrast'][-1] = baselineContrast
 
         return sequence
     
@@ -196,7 +327,8 @@ class DriftingGratingWithFictiveSaccades():
         tMargin,
         tStatic,
         tIBI,
-        constantSaccadeVelocity
+        constantSaccadeVelocity,
+        verbose=False,
         ):
         """
         """
@@ -233,91 +365,64 @@ class DriftingGratingWithFictiveSaccades():
         ])
         blockTransitionIndices.sort()
 
-        #
-        iterable = zip(
-            self.metadata['blocks'],
-            self.metadata['motion'],
-            self.metadata['probed'],
+        # Choose the inter trial intervals and quantize the whole timeline
+        nTrials = self.metadata['blocks'].shape[0]
+        itis = np.random.uniform(
+            low=interSaccadeIntervalRange[0],
+            high=interSaccadeIntervalRange[1],
+            size=nTrials
         )
+        nFramesInSequence = fictiveSaccadeSequence['probed']['phase'].size
+        planner = TimingPlanner(self.display.fps)
+        planner.add(tIdle, 'idle')
+        for iTrial in range(nTrials):
+            if iTrial in blockTransitionIndices:
+                planner.extend([tIBI, tStatic, tMargin], 'block')
+            planner.add(itis[iTrial], 'iti')
+            planner.add(nFramesInSequence, 'saccade', units='frames')
+            if iTrial + 1 in blockTransitionIndices:
+                planner.add(tMargin, 'block')
+        planner.add(tIdle, 'idle')
+        planner.report(verbose)
 
-        #
-        if self.display.backgroundColor != 0:
-            self.display.setBackgroundColor(0)
-        for iFrame in range(int(np.ceil(self.display.fps * tIdle))):
-            self.display.drawBackground()
-            self.display.flip()
+        # Build the phase and contrast trajectory for the whole session
+        trajectory = GratingTrajectory()
+        trajectory.append(planner.next(), visible=False)
+        iterable = zip(
+            self.metadata['motion'].flatten(),
+            self.metadata['probed'].flatten(),
+        )
+        for iTrial, (motion, probed) in enumerate(iterable):
 
-        #
-        iEvent = 0
-        for iTrial, (iBlock, motion, probed) in enumerate(iterable):
-            
-            # Transition to new block
+            # Blank screen, static grating, then the grating in motion
             if iTrial in blockTransitionIndices:
+                trajectory.append(planner.next(), visible=False)
+                trajectory.append(planner.next(), 0, baselineContrast)
+                trajectory.append(planner.next(), cpf1 * motion, baselineContrast)
 
-                # Show a blank screen
-                for iFrame in range(int(np.ceil(self.display.fps * tIBI))):
-                    self.display.drawBackground()
-                    self.display.flip()
-
-                # Show the grating static
-                for iFrame in range(int(np.ceil(self.display.fps * tStatic))):
-                    gabor.draw()
-                    self.display.flip()
-
-                # Show the grating in motion
-                for iFrame in range(int(np.ceil(self.display.fps * tMargin))):
-                    gabor.phase += (cpf1 * motion)
-                    gabor.draw()
-                    self.display.flip()
-
-            # Choose an inter trial interval
-            iti = np.random.uniform(
-                low=interSaccadeIntervalRange[0],
-                high=interSaccadeIntervalRange[1],
-                size=1
-            )
-            for iFrame in range(int(np.ceil(self.display.fps * iti))):
-                gabor.phase += (cpf1 * motion)
-                gabor.draw()
-                self.display.flip()
-
-            # Present the fictive saccade
+            # Inter trial interval
+            trajectory.append(planner.next(), cpf1 * motion, baselineContrast)
+
+            # Fictive saccade
+            # TODO: Figure out why the phase needs to be multiplied by -1???
             key = 'probed' if probed else 'unprobed'
-            recordTimestamp = False
-            for iFrame, (phase, signal, contrast) in enumerate(zip(*fictiveSaccadeSequence[key].values())):
-
-                # TODO: Figure out why the phase needs to be multiplied by -1???
-                gabor.phase += (phase * motion * -1)
-                gabor.contrast = contrast
-
-                #
-                if signal:
-                    self.display.signalEvent(2, units='frames')
-                    if iFrame == 0:
-                        event = 'saccade onset'
-                    else:
-                        event = 'probe onset'
-                    recordTimestamp = True
-                gabor.draw()
-                timestamp = self.display.flip()
-
-                #
-                if recordTimestamp:
-                    self.metadata['events'][iEvent] = event
-                    self.metadata['timestamps'][iEvent] = timestamp
-                    iEvent += 1
-                    recordTimestamp = False
+            if planner.next() != fictiveSaccadeSequence[key]['phase'].size:
+                raise Exception('Fictive saccade sequence does not match the planned timeline')
+            trajectory.extend(fictiveSaccadeSequence[key], motion * -1)
 
             #
             if iTrial + 1 in blockTransitionIndices:
-                for iFrame in range(int(np.ceil(self.display.fps * tMargin))):
-                    gabor.phase += (cpf1 * motion)
-                    gabor.draw()
-                    self.display.flip()
+                trajectory.append(planner.next(), cpf1 * motion, baselineContrast)
+
+        trajectory.append(planner.next(), visible=False)
 
-        for iFrame in range(int(np.ceil(self.display.fps * tIdle))):
-            self.display.drawBackground()
-            self.display.flip()
+        #
+        if self.display.backgroundColor != 0:
+            self.display.setBackgroundColor(0)
+        events = presentTrajectory(self.display, gabor, trajectory.compile())
+        for iEvent, (event, timestamp) in enumerate(events):
+            self.metadata['events'][iEvent] = event
+            self.metadata['timestamps'][iEvent] = timestamp
 
         #
         mask = np.array([True if len(entry.item()) != 0 else False for entry in self.metadata['events']])
@@ -345,7 +450,8 @@ class DriftingGratingWithFictiveSaccades():
         tIBI=1,
         tIdle=1,
         randomizeBlocks=True,
-        constantSaccadeVelocity=False
+        constantSaccadeVelocity=False,
+        verbose=False,
         ):
         """
         """
@@ -386,7 +492,8 @@ class DriftingGratingWithFictiveSaccades():
             tMargin,
             tStatic,
             tIBI,
-            constantSaccadeVelocity
+            constantSaccadeVelocity,
+            verbose
         )
 
         return
@@ -475,16 +582,16 @@ class DriftingGratingWithFictiveSaccades2():
         motionByBlock = np.tile(gratingMotion, nBlocksPerDirection)
         np.random.shuffle(motionByBlock)
         for iBlock, motion in enumerate(motionByBlock):
-            blockMetadata = list()
             for trialType in ('saccade', 'probe', 'combined'):
                 for iTrial_ in range(nTrialsPerConditionPerBlock):
                     trial = (iBlock, motion, trialType)
-                    blockMetadata.append(trial)
-            index = np.arange(len(blockMetadata))
-            if randomizeTrialOrder:
-                index = np.random.choice(index, size=index.size, replace=False)
-            for iTrial in index:
-                self.metadata['trials'].append(blockMetadata[iTrial])
+                    self.metadata['trials'].append(trial)
+
+        # Randomize the order of trials within each block
+        if randomizeTrialOrder:
+            blocks = [trial[0] for trial in self.metadata['trials']]
+            permutation = computeBlockPermutation(blocks, shuffleBlocks=False, shuffleWithinBlocks=True)
+            applyRowPermutation(self.metadata, permutation, ('trials',))
 
         #
         nTrials = len(self.metadata['trials'])
@@ -506,7 +613,8 @@ class DriftingGratingWithFictiveSaccades2():
         itiRange,
         tStatic,
         tWarmup,
-        ibi
+        ibi,
+        verbose=False,
         ):
         """
         """
@@ -530,103 +638,80 @@ class DriftingGratingWithFictiveSaccades2():
             spatialFrequency
         )
 
+        #
+        templates = {
+            'saccade': buildTrialTemplate(
+                phases.size,
+                cpf,
+                baselineContrast,
+                phases
+            ),
+            'probe': buildTrialTemplate(
+                probeDurationInFrames,
+                cpf,
+                baselineContrast,
+                None,
+                probeContrast,
+                0,
+                probeDurationInFrames
+            ),
+            'combined': buildTrialTemplate(
+                max(phases.size, probeLatencyInFrames + probeDurationInFrames),
+                cpf,
+                baselineContrast,
+                phases,
+                probeContrast,
+                probeLatencyInFrames,
+                probeDurationInFrames
+            ),
+        }
+
+        # Choose the inter trial intervals and quantize the whole timeline
+        blockIndices = np.array([trial[0] for trial in self.metadata['trials']])
+        itis = np.random.uniform(low=itiRange[0], high=itiRange[1], size=blockIndices.size)
+        planner = TimingPlanner(self.display.fps)
+        planner.extend([ibi, tStatic, tWarmup], 'warmup')
+        for iTrial, (blockIndex, motion, tt) in enumerate(self.metadata['trials']):
+            if blockIndex != (blockIndices[iTrial - 1] if iTrial > 0 else 0):
+                planner.extend([ibi, tStatic, tWarmup], 'block')
+            planner.add(templates[tt]['phase'].size, tt, units='frames')
+            planner.add(itis[iTrial], 'iti')
+        planner.add(ibi, 'idle')
+        planner.report(verbose)
+
         # Warm-up
         motion = self.metadata['trials'][0][1]
-        for iFrame in range(int(round(ibi * self.display.fps))):
-            self.display.drawBackground()
-            self.display.flip()
-        for iFrame in range(int(round(tStatic * self.display.fps))):
-            gabor.draw()
-            self.display.flip()
-        for iFrame in range(int(round(tWarmup * self.display.fps))):
-            gabor.phase += cpf * motion
-            gabor.draw()
-            self.display.flip()
+        trajectory = GratingTrajectory()
+        trajectory.append(planner.next(), visible=False)
+        trajectory.append(planner.next(), 0, baselineContrast)
+        trajectory.append(planner.next(), cpf * motion, baselineContrast)
 
         #
-        iEvent = 0
         currentBlockIndex = 0
         for blockIndex, motion, tt in self.metadata['trials']:
 
             # Block transition
             if blockIndex != currentBlockIndex:
                 currentBlockIndex = blockIndex
-                for iFrame in range(int(round(ibi * self.display.fps))):
-                    self.display.drawBackground()
-                    self.display.flip()
-                for iFrame in range(int(round(tStatic * self.display.fps))):
-                    gabor.draw()
-                    self.display.flip()
-                for iFrame in range(int(round(tWarmup * self.display.fps))):
-                    gabor.phase += cpf * motion
-                    gabor.draw()
-                    self.display.flip()
-
-            # Saccade-only trials
-            if tt == 'saccade':
-                for iFrame, phase in enumerate(phases):
-                    if iFrame == 0:
-                        self.display.signalEvent(2, units='frames')
-                        self.metadata['events'][iEvent] = 'saccade onset'
-                        iEvent += 1
-                    gabor.phase += phase * motion
-                    gabor.draw()
-                    self.display.flip()
-
-            # Probe-only trials
-            elif tt == 'probe':
-                gabor.contrast = probeContrast
-                for iFrame in range(probeDurationInFrames):
-                    if iFrame == 0:
-                        self.display.signalEvent(2, units='frames')
-                        self.metadata['events'][iEvent] = 'probe onset'
-                        iEvent += 1
-                    gabor.phase += cpf * motion
-                    gabor.draw()
-                    self.display.flip()
-                gabor.contrast = baselineContrast
-
-            # Saccade and probe trials
-            elif tt == 'combined':
-                probeOffsetCountdown = 0
-                for iFrame, phase in enumerate(phases):
-                    if iFrame == 0:
-                        self.display.signalEvent(2, units='frames')
-                        self.metadata['events'][iEvent] = 'saccade onset'
-                        iEvent += 1
-                    if probeOffsetCountdown == 0 and gabor.contrast != baselineContrast:
-                        gabor.contrast = baselineContrast
-                    gabor.phase += phase * motion
-                    if iFrame == probeLatencyInFrames:
-                        self.display.signalEvent(2, units='frames')
-                        self.metadata['events'][iEvent] = 'probe onset'
-                        iEvent += 1
-                        probeOffsetCountdown = probeDurationInFrames
-                        gabor.contrast = probeContrast
-                    gabor.draw()
-                    self.display.flip()
-                    # print(iFrame, gabor.contrast, self.display.state)
-                    if probeOffsetCountdown != 0:   
-                        probeOffsetCountdown -= 1
-                if gabor.contrast != baselineContrast:
-                    while probeOffsetCountdown != 0:
-                        gabor.phase += cpf * motion
-                        gabor.draw()
-                        self.display.flip()
-                    gabor.contrast = baselineContrast
+                trajectory.append(planner.next(), visible=False)
+                trajectory.append(planner.next(), 0, baselineContrast)
+                trajectory.append(planner.next(), cpf * motion, baselineContrast)
+
+            # Saccade-only, probe-only, or combined trial
+            if planner.next() != templates[tt]['phase'].size:
+                raise Exception('Trial template does not match the planned timeline')
+            trajectory.extend(templates[tt], motion)
 
             # ITI
-            itiInSeconds = np.random.uniform(low=itiRange[0], high=itiRange[1], size=1).item()
-            itiInFrames = int(round(self.display.fps * itiInSeconds))
-            for iFrame in range(itiInFrames):
-                gabor.phase += cpf * motion
-                gabor.draw()
-                self.display.flip()
+            trajectory.append(planner.next(), cpf * motion, baselineContrast)
+
+        #
+        trajectory.append(planner.next(), visible=False)
 
         #
-        for iFrame in range(int(round(ibi * self.display.fps))):
-            self.display.drawBackground()
-            self.display.flip()
+        events = presentTrajectory(self.display, gabor, trajectory.compile())
+        for iEvent, (event, timestamp) in enumerate(events):
+            self.metadata['events'][iEvent] = event
 
         return
 
@@ -648,6 +733,7 @@ class DriftingGratingWithFictiveSaccades2():
         tStatic=3,
         tWarmup=3,
         ibi=3,
+        verbose=False,
         ):
         """
         """
@@ -671,7 +757,8 @@ class DriftingGratingWithFictiveSaccades2():
             itiRange,
             tStatic,
             tWarmup,
-            ibi
+            ibi,
+            verbose
         )
 
         return
@@ -0,0 +1,204 @@
+import time
+import inspect
+import numpy as np
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from openpmad2.bases import StimulusBase
+
+class DisplayGeometry():
+    """
+    Picklable stand-in for a display which only carries its geometry
+
+    Schedules are generated in a worker process which cannot access the
+    window, so this is what generateSchedule sees as self.display.
+    """
+
+    def __init__(self, width=1280, height=720, ppd=None, fps=60, backgroundColor=-1):
+        """
+        """
+
+        self.width = width
+        self.height = height
+        self.ppd = width / 180 if ppd is None else ppd
+        self.fps = fps
+        self.backgroundColor = backgroundColor
+
+        return
+
+    @classmethod
+    def fromDisplay(cls, display):
+        """
+        """
+
+        geometry = cls(
+            display.width,
+            display.height,
+            display.ppd,
+            display.fps,
+            display.backgroundColor
+        )
+
+        return geometry
+
+def _acceptsSchedule(protocolClass):
+    """
+    Check if a protocol overrides StimulusBase.generateSchedule
+    """
+
+    return issubclass(protocolClass, StimulusBase) and protocolClass.generateSchedule is not StimulusBase.generateSchedule
+
+def _filterKeywords(method, kwargs):
+    """
+    Keep only the keywords accepted by a method
+    """
+
+    parameters = inspect.signature(method).parameters
+    filtered = {
+        key: value
+            for key, value in kwargs.items()
+                if key in parameters.keys()
+    }
+
+    return filtered
+
+def _generateSchedule(protocolClass, geometry, seed, kwargs):
+    """
+    Generate the schedule of a protocol (runs in the worker process)
+    """
+
+    np.random.seed(seed)
+    protocol = protocolClass(geometry)
+    schedule = protocol.generateSchedule(**_filterKeywords(protocol.generateSchedule, kwargs))
+    schedule['seed'] = seed
+
+    return schedule
+
+class SessionRunner():
+    """
+    Presents a sequence of protocols with a fixed gap between them
+
+    The schedules of the protocols which implement generateSchedule are all
+    generated in a worker process at the start of the session (each with its
+    own seed), so they are ready by the time the protocol starts. The metadata
+    of each protocol is saved on a background thread while the next one runs.
+    The worker is spawned, so scripts which use the runner must guard their
+    entry point with if __name__ == '__main__'.
+    """
+
+    def __init__(self, display, sessionFolder, protocols, seed=None, tGap=3):
+        """
+        keywords
+        --------
+        display
+            The WarpedWindow
+        sessionFolder
+            Folder where the metadata is saved
+        protocols
+            List of (protocol class, keywords for present) tuples
+        seed
+            Seed from which the seed of each protocol is derived (random if None)
+        tGap
+            Duration of the idle period between protocols (in seconds)
+        """
+
+        self.display = display
+        self.sessionFolder = sessionFolder
+        self.protocols = list()
+        for protocolClass, kwargs in protocols:
+            self.protocols.append((protocolClass, dict() if kwargs is None else dict(kwargs)))
+        self.tGap = tGap
+
+        #
+        sequence = np.random.SeedSequence(seed)
+        self.seed = sequence.entropy
+        self.seeds = [int(child.generate_state(1)[0]) for child in sequence.spawn(len(self.protocols))]
+        self.timings = list()
+
+        return
+
+    def _waitForSchedule(self, future):
+        """
+        Keep flipping the display until the schedule is ready
+        """
+
+        while not future.done():
+            self.display.idle(1, units='frames')
+
+        return future.result()
+
+    def run(self):
+        """
+        Present every protocol in order
+
+        returns
+        -------
+        protocols
+            The protocol instances (with their metadata)
+        """
+
+        geometry = DisplayGeometry.fromDisplay(self.display)
+        context = mp.get_context('spawn')
+        generator = ProcessPoolExecutor(max_workers=1, mp_context=context)
+        saver = ThreadPoolExecutor(max_workers=1)
+
+        # The worker generates the schedules in the order of presentation
+        futures = list()
+        for (protocolClass, kwargs), seed in zip(self.protocols, self.seeds):
+            if _acceptsSchedule(protocolClass):
+                futures.append(generator.submit(_generateSchedule, protocolClass, geometry, seed, kwargs))
+            else:
+                futures.append(None)
+
+        #
+        instances, saves = list(), list()
+        try:
+            for iProtocol, (protocolClass, kwargs) in enumerate(self.protocols):
+
+                #
+                t0 = time.perf_counter()
+                protocol = protocolClass(self.display)
+                kwargs = dict(kwargs)
+                if futures[iProtocol] is not None:
+                    kwargs['schedule'] = self._waitForSchedule(futures[iProtocol])
+                else:
+                    np.random.seed(self.seeds[iProtocol])
+                tWait = time.perf_counter() - t0
+
+                #
+                t0 = time.perf_counter()
+                protocol.present(**kwargs)
+                tPresent = time.perf_counter() - t0
+
+                #
+                if hasattr(protocol, 'saveMetadata'):
+                    saves.append(saver.submit(protocol.saveMetadata, self.sessionFolder))
+                instances.append(protocol)
+                self.timings.append({
+                    'protocol': protocolClass.__name__,
+                    'seed': self.seeds[iProtocol],
+                    'wait': tWait,
+                    'present': tPresent
+                })
+
+                #
+                if iProtocol + 1 < len(self.protocols):
+                    self.display.idle(self.tGap, units='seconds')
+
+        finally:
+            generator.shutdown(wait=False, cancel_futures=True)
+            saver.shutdown(wait=True)
+
+        # Raise any exception from saving the metadata
+        for save in saves:
+            save.result()
+
+        return instances
+
+    def report(self):
+        """
+        """
+
+        for timing in self.timings:
+            print(f'{timing["protocol"]}: waited {timing["wait"]:.3f} seconds for the schedule, presented for {timing["present"]:.1f} seconds')
+
+        return
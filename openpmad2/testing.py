@@ -1,4 +1,9 @@
+import os
+import pty
+import tty
 import time
+import select
+import threading
 import numpy as np
 import multiprocessing as mp
 
@@ -48,3 +53,94 @@ class DummyDeepLabCutProcess(mp.Process):
         self.started.value = 0
         super().join()
         return
+
+class DummyMicrocontroller():
+    """
+    Pseudo-terminal stand-in for the microcontroller
+
+    Echoes the handshake and records every other byte it receives together
+    with its (monotonic) receive time. The port can be handed to the
+    ConnectionManager as a candidate device.
+    """
+
+    def __init__(self, handshake=b'a', latency=0):
+        """
+        keywords
+        --------
+        handshake
+            Byte echoed back to the host
+        latency
+            Delay before the handshake is echoed (in seconds)
+        """
+
+        self.handshake = handshake
+        self.latency = latency
+        self.received = list()
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._started = threading.Event()
+        self._thread = None
+
+        return
+
+    def start(self):
+        """
+        """
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._started.set()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+        return
+
+    def _run(self):
+        """
+        """
+
+        while self._started.is_set():
+            ready, _, _ = select.select([self._master], [], [], 0.01)
+            if len(ready) == 0:
+                continue
+            try:
+                incoming = os.read(self._master, 1024)
+            except OSError:
+                break
+            receivedAt = time.monotonic()
+            for value in incoming:
+                byte = bytes([value])
+                if byte == self.handshake:
+                    if self.latency > 0:
+                        time.sleep(self.latency)
+                    os.write(self._master, byte)
+                else:
+                    self.received.append((byte, receivedAt))
+
+        return
+
+    def send(self, message=b'p'):
+        """
+        Send a message to the host (e.g., a probe trigger)
+        """
+
+        os.write(self._master, message)
+
+        return
+
+    def join(self):
+        """
+        """
+
+        self._started.clear()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master, self._slave = None, None
+
+        return
@@ -0,0 +1,150 @@
+import numpy as np
+from openpmad2.helpers import estimateFrameCount
+
+class TimingPlanner():
+    """
+    Quantizes an entire session timeline into frames at once
+
+    Each segment is rounded to the nearest frame boundary of the cumulative
+    timeline (i.e., the rounding error is diffused into the next segment), so
+    the planned duration of the session never drifts from the requested
+    duration by more than half a frame. Segments which are added in frames
+    (e.g., trial templates) keep their exact frame count.
+    """
+
+    def __init__(self, fps=60):
+        """
+        """
+
+        self._fps = fps
+        self._durations = list()
+        self._labels = list()
+        self._exact = list()
+        self._frameCounts = None
+        self._cursor = 0
+
+        return
+
+    def add(self, duration, label=None, units='seconds'):
+        """
+        Append a single segment to the timeline and return its index
+
+        keywords
+        --------
+        duration
+            Duration of the segment
+        label
+            Optional name of the segment (used in the report)
+        units
+            Unit of time (seconds or frames)
+        """
+
+        if units == 'frames':
+            exact = int(duration)
+            duration = exact / self._fps
+        elif units == 'seconds':
+            exact = None
+        else:
+            raise Exception(f'{units} is an invalid unit of time')
+
+        self._durations.append(float(np.asarray(duration).item()))
+        self._labels.append(label)
+        self._exact.append(exact)
+        self._frameCounts = None
+
+        return len(self._durations) - 1
+
+    def extend(self, durations, label=None, units='seconds'):
+        """
+        Append a sequence of segments to the timeline and return their indices
+        """
+
+        indices = np.array([
+            self.add(duration, label, units)
+                for duration in np.asarray(durations).flatten()
+        ], dtype=int)
+
+        return indices
+
+    def plan(self):
+        """
+        Compute the number of frames for each segment
+        """
+
+        durations = np.array(self._durations)
+        boundaries = np.round(np.cumsum(durations) * self._fps).astype(int)
+        self._frameCounts = np.diff(np.concatenate([[0], boundaries]))
+
+        # Segments in frames are kept exact (their rounding error is carried
+        # over into the following segment)
+        if any(exact is not None for exact in self._exact):
+            nFrames = 0
+            for iSegment, exact in enumerate(self._exact):
+                count = boundaries[iSegment] - nFrames if exact is None else exact
+                self._frameCounts[iSegment] = count
+                nFrames += count
+        self._cursor = 0
+
+        #
+        totalInSeconds = np.cumsum(durations)[-1] if durations.size > 0 else 0
+        if totalInSeconds > 0 and self._frameCounts.sum() != estimateFrameCount(totalInSeconds, self._fps):
+            raise Exception('Planned frame count does not match the requested duration')
+
+        return self._frameCounts
+
+    def next(self):
+        """
+        Return the number of frames for the next segment in the timeline
+        """
+
+        if self._frameCounts is None:
+            self.plan()
+        if self._cursor >= self._frameCounts.size:
+            raise Exception('All segments in the timeline have been consumed')
+        nFrames = int(self._frameCounts[self._cursor])
+        self._cursor += 1
+
+        return nFrames
+
+    def report(self, verbose=True):
+        """
+        Compare the planned and requested durations
+
+        keywords
+        --------
+        verbose
+            Print the summary
+        """
+
+        if self._frameCounts is None:
+            self.plan()
+
+        #
+        requested = np.array(self._durations)
+        planned = self._frameCounts / self._fps
+        summary = {
+            'requested': requested.sum(),
+            'planned': planned.sum(),
+            'frames': int(self._frameCounts.sum()),
+            'segments': requested.size,
+            'maximumSegmentError': np.max(np.abs(planned - requested)) if requested.size > 0 else 0.0,
+        }
+
+        if verbose:
+            print(
+                f'Planned {summary["frames"]} frames ({summary["planned"]:.3f} seconds) '
+                f'for {summary["requested"]:.3f} seconds requested across {summary["segments"]} segments '
+                f'(maximum segment error: {summary["maximumSegmentError"] * 1000:.1f} ms)'
+            )
+
+        return summary
+
+    @property
+    def fps(self):
+        return self._fps
+
+    @property
+    def frameCounts(self):
+        if self._frameCounts is None:
+            self.plan()
+        return self._frameCounts
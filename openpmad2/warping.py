@@ -2,85 +2,382 @@ import os
 import re
 import pickle
 import numpy as np
+import pandas as pd
 import pathlib as pl
+from concurrent.futures import ThreadPoolExecutor
+from scipy.spatial import Delaunay
+from scipy.ndimage import map_coordinates
+from scipy.interpolate import LinearNDInterpolator, NearestNDInterpolator
 from skimage import transform as tf
-from skimage import exposure as exp
 from psychopy.visual import ImageStim, GratingStim
 
 WARPFILE  = None
 TRANSFORM = None
+WARPMODEL = None
+
+_assetIndex = None
+_datePattern = re.compile(r'\((\d{4}-\d{2}-\d{2})\)')
+
+def indexCalibrationAssets(refresh=False):
+    """
+    Index the warpfiles (by date) and lookup tables (by display and date) in
+    the data folder
+
+    The folders are only scanned once unless refresh is True
+    """
+
+    global _assetIndex
+    if _assetIndex is not None and refresh == False:
+        return _assetIndex
+
+    #
+    folder = pl.Path(__file__).parent.joinpath('data')
+    warpfiles = dict()
+    for file in folder.joinpath('warpfiles').rglob('*warpfile*'):
+        match = _datePattern.search(file.name)
+        if file.suffix != '.txt' or match is None:
+            continue
+        warpfiles[match.group(1)] = file
+
+    #
+    tables = dict()
+    for file in folder.joinpath('tables').rglob('*.pkl'):
+        match = _datePattern.search(file.name)
+        if match is None:
+            continue
+        display = file.name[:match.start()].strip()
+        tables[(display, match.group(1))] = file
+
+    _assetIndex = {
+        'warpfiles': warpfiles,
+        'tables': tables
+    }
+
+    return _assetIndex
+
+def writeWarpfile(filepath, data, gridShape, writeBinary=True):
+    """
+    Write a warp mesh in the PsychoPy warpfile format
+
+    keywords
+    --------
+    filepath
+        Path to the warpfile
+    data
+        Array with shape (nPoints, 5) of destination coordinates, source
+        coordinates, and alpha for each node
+    gridShape
+        Number of rows and columns in the mesh
+    writeBinary
+        Also write a binary (.npy) companion next to the warpfile
+    """
+
+    nRows, nColumns = gridShape
+    data = np.asarray(data, dtype=float).reshape(-1, 5)
+    if data.shape[0] != nRows * nColumns:
+        raise Exception(f'Found {data.shape[0]} nodes for a {nRows} x {nColumns} mesh')
+
+    #
+    np.savetxt(
+        filepath,
+        data,
+        fmt='%.17g',
+        delimiter=' ',
+        header=f'2\n{nColumns:.0f} {nRows:.0f}',
+        comments=''
+    )
+    if writeBinary:
+        np.save(pl.Path(filepath).with_suffix('.npy'), data.reshape(nRows, nColumns, 5))
+
+    # The new warpfile might belong in the index
+    global _assetIndex
+    _assetIndex = None
+
+    return
+
+def readWarpfile(filepath, useBinary=True):
+    """
+    Read a warp mesh written in the PsychoPy warpfile format
+
+    The binary companion is used if it exists, is at least as recent as the
+    warpfile, and matches the dimensions in the header of the warpfile
+
+    returns
+    -------
+    data
+        Array with shape (nPoints, 5)
+    gridShape
+        Number of rows and columns in the mesh
+    """
+
+    filepath = pl.Path(filepath)
+    with open(filepath, 'r') as stream:
+        version = stream.readline().strip()
+        nColumns, nRows = [int(float(value)) for value in stream.readline().split()]
+    if version != '2':
+        raise Exception(f'Unsupported warpfile version: {version}')
+
+    #
+    companion = filepath.with_suffix('.npy')
+    if useBinary and companion.exists() and companion.stat().st_mtime >= filepath.stat().st_mtime:
+        mesh = np.load(companion)
+        if mesh.shape == (nRows, nColumns, 5) and np.isfinite(mesh).all():
+            return mesh.reshape(-1, 5), (nRows, nColumns)
+
+    #
+    data = np.loadtxt(filepath, skiprows=2, ndmin=2)
+    if data.shape != (nRows * nColumns, 5):
+        raise Exception(f'Warpfile contains {data.shape[0]} nodes for a {nRows} x {nColumns} mesh')
+
+    return data, (nRows, nColumns)
+
+class CalibrationRegistry():
+    """
+    Resolves, loads, and validates calibration assets (warpfiles and lookup
+    tables)
+
+    Assets are resolved to the latest one on or before the requested date.
+    Loaded assets are kept in memory and can optionally be written to a cache
+    file, which lets other processes skip parsing and estimation.
+    """
+
+    def __init__(self, cacheFile=None):
+        """
+        keywords
+        --------
+        cacheFile
+            Optional path to a pickle shared between processes
+        """
+
+        self._cacheFile = None if cacheFile is None else pl.Path(cacheFile)
+        self._cache = dict()
+        if self._cacheFile is not None and self._cacheFile.exists():
+            with open(self._cacheFile, 'rb') as stream:
+                self._cache = pickle.load(stream)
+
+        return
+
+    def _resolve(self, assets, date, description):
+        """
+        """
+
+        dates = sorted([key for key in assets.keys() if key <= date])
+        if len(dates) == 0:
+            raise Exception(f'No {description} found on or before {date}')
+
+        return dates[-1]
+
+    def resolveWarpfile(self, date):
+        """
+        Return the path to the latest warpfile on or before the date
+        """
+
+        resolved = self._resolve(indexCalibrationAssets()['warpfiles'], date, 'warpfile')
+
+        return indexCalibrationAssets()['warpfiles'][resolved]
+
+    def resolveTable(self, display, date):
+        """
+        Return the path to the latest lookup table for the display on or before the date
+        """
+
+        tables = {
+            tableDate: path
+                for (tableDisplay, tableDate), path in indexCalibrationAssets()['tables'].items()
+                    if tableDisplay == display
+        }
+        resolved = self._resolve(tables, date, f'lookup table for {display}')
+
+        return tables[resolved]
+
+    def _lookup(self, path):
+        """
+        Return a cached asset if the file has not changed since it was loaded
+        """
+
+        key = str(path)
+        if key in self._cache.keys() and self._cache[key]['mtime'] == path.stat().st_mtime:
+            return self._cache[key]['asset']
+
+        return None
+
+    def _store(self, path, asset):
+        """
+        """
+
+        self._cache[str(path)] = {
+            'mtime': path.stat().st_mtime,
+            'asset': asset
+        }
+        if self._cacheFile is not None:
+            temporary = self._cacheFile.with_suffix('.tmp')
+            with open(temporary, 'wb') as stream:
+                pickle.dump(self._cache, stream)
+            os.replace(temporary, self._cacheFile)
+
+        return
+
+    def loadMesh(self, date):
+        """
+        Load and validate the latest warp mesh on or before the date
+
+        returns
+        -------
+        mesh
+            Dict with the path, nodes (nPoints, 5), and grid shape of the mesh
+        """
+
+        path = self.resolveWarpfile(date)
+        mesh = self._lookup(path)
+        if mesh is not None:
+            return mesh
+
+        #
+        data, gridShape = readWarpfile(path)
+        if min(gridShape) < 2:
+            raise Exception(f'Warp mesh in {path.name} has fewer than 2 rows or columns')
+        if not np.isfinite(data).all():
+            raise Exception(f'Warp mesh in {path.name} contains invalid coordinates')
+        if np.any(data[:, 2:] < 0) or np.any(data[:, 2:] > 1):
+            raise Exception(f'Texture coordinates or alpha in {path.name} are outside of the range (0, 1)')
+
+        #
+        mesh = {
+            'path': path,
+            'data': data,
+            'gridShape': gridShape
+        }
+        self._store(path, mesh)
+
+        return mesh
+
+    def loadLookupTable(self, display, date):
+        """
+        Load and validate the source and destination coordinates of the latest
+        lookup table on or before the date
+        """
+
+        path = self.resolveTable(display, date)
+        try:
+            lut = pd.read_pickle(path)
+        except Exception as error:
+            raise Exception(f'Failed to load the lookup table {path.name}') from error
+
+        #
+        src = np.array(lut['src'], dtype=float)
+        dst = np.array(lut['dst'], dtype=float)
+        if src.ndim != 2 or src.shape[1] != 2 or src.shape != dst.shape:
+            raise Exception(f'Source and destination coordinates do not match in {path.name}')
+        if src.shape[0] < 3 or not np.isfinite(src).all() or not np.isfinite(dst).all():
+            raise Exception(f'Lookup table {path.name} contains too few or invalid coordinates')
+
+        return src, dst
+
+    def loadTransform(self, display, date, dst=None, tolerance=1):
+        """
+        Load the latest lookup table on or before the date and estimate the
+        affine transformation
+
+        keywords
+        --------
+        display
+            Name of the display
+        date
+            Date of the calibration (YYYY-MM-DD)
+        dst
+            Replaces the destination coordinates of the lookup table
+        tolerance
+            Largest acceptable error when mapping the source coordinates (in pixels)
+        """
+
+        path = self.resolveTable(display, date)
+        if dst is None:
+            transform = self._lookup(path)
+            if transform is not None:
+                return transform
+
+        #
+        src, lutDst = self.loadLookupTable(display, date)
+        if dst is None:
+            dst = lutDst
+        dst = np.array(dst, dtype=float)
+        if src.shape != dst.shape:
+            raise Exception(f'Source and destination coordinates do not match in {path.name}')
+        if not np.isfinite(dst).all():
+            raise Exception(f'Destination coordinates are invalid')
+
+        #
+        transform = tf.PiecewiseAffineTransform()
+        if transform.estimate(src, dst) == False:
+            raise Exception(f'Failed to estimate the transformation from {path.name}')
+        error = np.max(np.linalg.norm(transform(src) - dst, axis=1))
+        if error > tolerance:
+            raise Exception(f'Transformation from {path.name} maps the source coordinates with an error of {error:.1f} pixels')
+
+        #
+        if np.array_equal(dst, lutDst):
+            self._store(path, transform)
+
+        return transform
+
+    def preload(self, display='DLPLightCrafter3010', date='2022-08-25'):
+        """
+        Load and validate the warp mesh and transformation for a date
+        """
+
+        calibration = {
+            'mesh': self.loadMesh(date),
+            'transform': self.loadTransform(display, date)
+        }
+
+        return calibration
+
+_calibrationRegistry = None
+
+def getCalibrationRegistry(cacheFile=None):
+    """
+    Return the (shared) calibration registry
+    """
+
+    global _calibrationRegistry
+    if _calibrationRegistry is None or cacheFile is not None:
+        _calibrationRegistry = CalibrationRegistry(cacheFile)
+
+    return _calibrationRegistry
 
 def load_tform_data(display='DLPLightCrafter3010', date='2022-02-02', dst=None):
     """
+    Estimate the global transformation from the latest lookup table on or
+    before the date
     """
 
     print(f'Loading transformation for {display} on {date}')
 
-    lut = None
-    cwd = pl.Path(__file__)
-    folder = cwd.parent.joinpath('data', 'tables')
-    result = folder.rglob(f'*{display}*')
-    for file in result:
-        if date in str(file):
-            path = pl.Path().joinpath(folder, file)
-            with open(str(path), 'rb') as stream:
-                try:
-                    lut = pickle.load(stream)
-                except:
-                    return
-            break
-
-    if lut is None:
-        raise Exception(f'No lookup table found for {display} on {date}')
-
-    src = np.array(lut['src'])
-    if dst is None:
-        dst = np.array(lut['dst'])
-
     global TRANSFORM
-    TRANSFORM = tf.PiecewiseAffineTransform()
-    TRANSFORM.estimate(src, dst)
+    TRANSFORM = getCalibrationRegistry().loadTransform(display, date, dst)
 
     return
 
-load_tform_data()
-
 def load_wfile_data(date='2022-08-25'):
     """
     Set the warpfile filepath global variable
     """
 
-    wfile = None
-    cwd = pl.Path(__file__)
-    folder = cwd.parent.joinpath('data', 'warpfiles')
-    result = folder.rglob(f'*warpfile*')
-    for file in result:
-        if date in str(file):
-            path = pl.Path().joinpath(folder, file)
-            wfile = str(path)
-
-    if wfile is not None:
-        global WARPFILE
-        WARPFILE = wfile
+    global WARPFILE
+    WARPFILE = getWarpfile(date)
 
     return
 
 def getWarpfile(date):
     """
+    Return the latest warpfile on or before the date
     """
 
-    wfile = None    
-    cwd = pl.Path(__file__)
-    folder = cwd.parent.joinpath('data', 'warpfiles')
-    result = folder.rglob(f'*warpfile*')
-    for file in result:
-        if date in str(file):
-            path = pl.Path().joinpath(folder, file)
-            wfile = str(path)
-            break
+    wfile = str(getCalibrationRegistry().resolveWarpfile(date))
 
     return wfile
 
+load_tform_data()
 load_wfile_data()
 
 def warp(image, rescale=False):
@@ -103,6 +400,680 @@ def warp(image, rescale=False):
 
     return warped
 
+# Warp maps of the current transformation (keyed by shape)
+_warpMapCache = {
+    'transform': None,
+    'maps': dict(),
+}
+
+class WarpMap():
+    """
+    Precomputed bilinear sampling map for the affine transformation
+
+    Evaluating the inverse transformation is the expensive part of warp, so it
+    is done once for every pixel of the output and blocks of frames are then
+    warped with a single gather per neighbor
+    """
+
+    def __init__(self, shape=(720, 1280), transform=None):
+        """
+        keywords
+        --------
+        shape
+            Height and width of the frames (in pixels)
+        transform
+            Estimated transformation or WarpModel (defaults to the global transformation)
+        """
+
+        if transform is None:
+            transform = TRANSFORM
+        if transform is None:
+            raise Exception('Affine transformation has not been estimated (or estimation failed)')
+
+        #
+        height, width = shape
+        rows, cols = np.mgrid[0: height, 0: width]
+        coords = transform.inverse(np.column_stack([
+            cols.ravel(),
+            rows.ravel()
+        ]).astype(float))
+        x, y = coords[:, 0], coords[:, 1]
+
+        # Pixels which map to coordinates outside of the frame are filled in with cval
+        valid = np.logical_and.reduce([
+            np.isfinite(x),
+            np.isfinite(y),
+            x >= 0,
+            x <= width - 1,
+            y >= 0,
+            y <= height - 1,
+        ])
+        x = np.where(valid, x, 0)
+        y = np.where(valid, y, 0)
+
+        #
+        col1 = np.clip(np.floor(x), 0, max(width - 2, 0)).astype(np.int64)
+        row1 = np.clip(np.floor(y), 0, max(height - 2, 0)).astype(np.int64)
+        dx = (x - col1).astype(np.float32)
+        dy = (y - row1).astype(np.float32)
+        col2 = np.minimum(col1 + 1, width - 1)
+        row2 = np.minimum(row1 + 1, height - 1)
+        self._indices = np.stack([
+            row1 * width + col1,
+            row1 * width + col2,
+            row2 * width + col1,
+            row2 * width + col2,
+        ]).astype(np.int32)
+        self._weights = np.stack([
+            (1 - dx) * (1 - dy),
+            dx * (1 - dy),
+            (1 - dx) * dy,
+            dx * dy,
+        ])
+        self._weights[:, np.invert(valid)] = 0
+        self._valid = valid
+        self._shape = (height, width)
+
+        return
+
+    def apply(self, frames, cval=0, out=None):
+        """
+        Warp a single frame (height, width) or a block of frames (nFrames, height, width)
+
+        keywords
+        --------
+        frames
+            Frame or block of frames
+        cval
+            Value used for pixels outside of the transformation
+        out
+            Optional float32 array with the same shape as frames
+        """
+
+        frames = np.asarray(frames)
+        if frames.shape[-2:] != self._shape:
+            raise Exception(f'Frames with shape {frames.shape[-2:]} do not match the warp map {self._shape}')
+
+        #
+        flattened = frames.reshape(-1, self._shape[0] * self._shape[1])
+        if out is None:
+            warped = np.zeros(flattened.shape, dtype=np.float32)
+        elif np.shares_memory(out, frames):
+            raise Exception('Frames cannot be warped in place')
+        else:
+            warped = out.reshape(flattened.shape)
+            warped[:] = 0
+        for indices, weights in zip(self._indices, self._weights):
+            warped += flattened[:, indices] * weights
+        warped[:, np.invert(self._valid)] = cval
+
+        return warped.reshape(frames.shape)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def valid(self):
+        return self._valid.reshape(self._shape)
+
+def getWarpMap(shape=(720, 1280)):
+    """
+    Return the (cached) warp map for the global warp model (or the global
+    transformation if no warp model was set)
+    """
+
+    # The cache holds the transformation it was built for, so the maps are
+    # dropped (not reused) when the transformation is replaced
+    transform = TRANSFORM if WARPMODEL is None else WARPMODEL
+    if _warpMapCache['transform'] is not transform:
+        clearWarpMapCache()
+        _warpMapCache['transform'] = transform
+    key = tuple(shape)
+    if key not in _warpMapCache['maps'].keys():
+        _warpMapCache['maps'][key] = WarpMap(shape, transform)
+
+    return _warpMapCache['maps'][key]
+
+def clearWarpMapCache():
+    """
+    Release the cached warp maps
+    """
+
+    _warpMapCache['transform'] = None
+    _warpMapCache['maps'] = dict()
+
+    return
+
+def setWarpModel(model):
+    """
+    Use a warp model for all CPU warping (see getWarpMap)
+    """
+
+    global WARPMODEL
+    WARPMODEL = model
+    clearWarpMapCache()
+
+    return
+
+class WarpModel():
+    """
+    Correspondence between positions on the display and positions in the
+    unwarped frame
+
+    A model can be built from a warpfile (the GPU mesh) or from a lookup
+    table (the CPU transformation), and it exports both a warpfile and a
+    dense sampling map (WarpMap), so frames warped on the CPU match frames
+    warped by the Warper. Coordinates are in pixels with the origin in the
+    top-left corner.
+    """
+
+    def __init__(self, src, dst, displayShape=(720, 1280), source=None):
+        """
+        keywords
+        --------
+        src
+            Position of each node in the unwarped frame (x, y)
+        dst
+            Position of each node on the display (x, y)
+        displayShape
+            Height and width of the display (in pixels)
+        source
+            Description of where the model came from
+        """
+
+        self._src = np.array(src, dtype=float)
+        self._dst = np.array(dst, dtype=float)
+        if self._src.shape != self._dst.shape:
+            raise Exception('Source and destination coordinates do not match')
+        self._displayShape = tuple(displayShape)
+        self._source = source
+        self._interpolator = LinearNDInterpolator(self._dst, self._src, fill_value=np.nan)
+        self._forwardInterpolator = None
+        self._warpMaps = dict()
+
+        return
+
+    @classmethod
+    def fromMeshData(cls, data, displayShape=(720, 1280), source=None):
+        """
+        Build a model from nodes in the warpfile layout (transparent nodes are ignored)
+        """
+
+        data = np.asarray(data, dtype=float)
+        data = data[data[:, 4] > 0]
+        height, width = displayShape
+        dst = np.column_stack([
+            (data[:, 0] + 1) / 2 * width - 0.5,
+            (1 - data[:, 1]) / 2 * height - 0.5,
+        ])
+        src = np.column_stack([
+            data[:, 2] * width - 0.5,
+            (1 - data[:, 3]) * height - 0.5,
+        ])
+        model = cls(src, dst, displayShape, source)
+
+        return model
+
+    @classmethod
+    def fromWarpfile(cls, filepath, displayShape=(720, 1280)):
+        """
+        Build a model from a PsychoPy warpfile
+        """
+
+        data, gridShape = readWarpfile(filepath)
+        model = cls.fromMeshData(data, displayShape, str(filepath))
+
+        return model
+
+    @classmethod
+    def fromLookupTable(cls, display='DLPLightCrafter3010', date='2022-02-02', displayShape=(720, 1280)):
+        """
+        Build a model from the latest lookup table on or before the date
+        """
+
+        src, dst = getCalibrationRegistry().loadLookupTable(display, date)
+        path = getCalibrationRegistry().resolveTable(display, date)
+        model = cls(src, dst, displayShape, str(path))
+
+        return model
+
+    def inverse(self, coords):
+        """
+        Map positions on the display to positions in the unwarped frame (NaN
+        outside of the mesh)
+        """
+
+        return self._interpolator(np.asarray(coords, dtype=float))
+
+    def forward(self, coords):
+        """
+        Map positions in the unwarped frame to positions on the display (NaN
+        outside of the mesh)
+        """
+
+        if self._forwardInterpolator is None:
+            self._forwardInterpolator = LinearNDInterpolator(self._src, self._dst, fill_value=np.nan)
+
+        return self._forwardInterpolator(np.asarray(coords, dtype=float))
+
+    def getWarpMap(self, shape=None):
+        """
+        Return the (cached) dense sampling map for frames of a given shape
+        """
+
+        shape = self._displayShape if shape is None else tuple(shape)
+        if shape not in self._warpMaps.keys():
+            self._warpMaps[shape] = WarpMap(shape, self)
+
+        return self._warpMaps[shape]
+
+    def exportMesh(self, gridShape=(37, 65)):
+        """
+        Sample the model on a regular grid of texture coordinates
+
+        returns
+        -------
+        data
+            Array with shape (nPoints, 5) in the warpfile layout (nodes outside
+            of the model are moved to the nearest node and made transparent)
+        """
+
+        nRows, nColumns = gridShape
+        height, width = self._displayShape
+        u, v = np.meshgrid(
+            np.linspace(0, 1, nColumns),
+            np.linspace(0, 1, nRows)
+        )
+        u, v = u.flatten(), v.flatten()
+        positions = np.column_stack([
+            u * width - 0.5,
+            (1 - v) * height - 0.5,
+        ])
+        coords = self.forward(positions)
+        valid = np.isfinite(coords).all(axis=1)
+        if valid.sum() == 0:
+            raise Exception('The grid does not intersect the model')
+        if np.invert(valid).any():
+            nearest = NearestNDInterpolator(positions[valid], coords[valid])
+            coords[np.invert(valid)] = nearest(positions[np.invert(valid)])
+
+        #
+        data = np.zeros([u.size, 5])
+        data[:, 0] = (coords[:, 0] + 0.5) / width * 2 - 1
+        data[:, 1] = 1 - (coords[:, 1] + 0.5) / height * 2
+        data[:, 2] = u
+        data[:, 3] = v
+        data[:, 4] = valid.astype(float)
+
+        return data
+
+    def writeWarpfile(self, filepath, gridShape=(37, 65), writeBinary=True):
+        """
+        Export the model as a warpfile for the Warper
+        """
+
+        writeWarpfile(filepath, self.exportMesh(gridShape), gridShape, writeBinary)
+
+        return
+
+    def compare(self, other, step=4):
+        """
+        Measure the disagreement between two models on a grid of display positions
+
+        returns
+        -------
+        report
+            Dict with the mean, median, 95th percentile, and maximum distance
+            between the mapped positions (in pixels) and the fraction of
+            positions inside exactly one of the models
+        """
+
+        height, width = self._displayShape
+        rows, columns = np.mgrid[0: height: step, 0: width: step]
+        coords = np.column_stack([columns.ravel(), rows.ravel()]).astype(float)
+        a, b = self.inverse(coords), other.inverse(coords)
+        validA, validB = np.isfinite(a).all(axis=1), np.isfinite(b).all(axis=1)
+        both = np.logical_and(validA, validB)
+        distance = np.linalg.norm(a[both] - b[both], axis=1)
+
+        #
+        if distance.size == 0:
+            distance = np.array([np.nan])
+        report = {
+            'mean': float(np.mean(distance)),
+            'median': float(np.median(distance)),
+            'p95': float(np.percentile(distance, 95)),
+            'max': float(np.max(distance)),
+            'coverageMismatch': float(np.mean(validA != validB)),
+        }
+
+        return report
+
+    def reportDisagreement(self, gridShape=(37, 65), step=4, verbose=True):
+        """
+        Compare the dense map of this model with the mesh exported for the GPU
+        """
+
+        mesh = WarpModel.fromMeshData(self.exportMesh(gridShape), self._displayShape)
+        report = self.compare(mesh, step)
+
+        if verbose:
+            print(
+                f'GPU mesh ({gridShape[0]} x {gridShape[1]}) vs. CPU map: '
+                f'mean={report["mean"]:.2f} px, p95={report["p95"]:.2f} px, max={report["max"]:.2f} px, '
+                f'coverage mismatch={report["coverageMismatch"] * 100:.1f}%'
+            )
+
+        return report
+
+    @property
+    def displayShape(self):
+        return self._displayShape
+
+    @property
+    def source(self):
+        return self._source
+
+def _warpAndRescaleChunk(images, out, warpMap, inRange=(0, 255)):
+    """
+    Warp a chunk of images and rescale the intensity into the output array
+    (float32 from -1 to 1 or uint8 from 0 to 255)
+    """
+
+    if warpMap is None:
+        warped = np.array(images, dtype=np.float32)
+    else:
+        warped = warpMap.apply(images, cval=inRange[0])
+    lower, upper = inRange
+    if out.dtype == np.uint8:
+        scale = 255 / (upper - lower)
+        np.clip((warped - lower) * scale, 0, 255, out=warped)
+        np.around(warped, out=warped)
+    else:
+        scale = 2 / (upper - lower)
+        np.clip((warped - lower) * scale - 1, -1, 1, out=warped)
+    out[:] = warped
+
+    return
+
+def iterateWarpedChunks(images, chunkSize=64, dtype=np.float32, inRange=(0, 255), nThreads=1, warp=True):
+    """
+    Warp and rescale a stack (or any iterable) of images in chunks
+
+    keywords
+    --------
+    images
+        Array with shape (nImages, height, width) or an iterable of images
+    chunkSize
+        Number of images warped at once (bounds the memory footprint)
+    dtype
+        Data type of the output (float32 from -1 to 1 or uint8 from 0 to 255)
+    inRange
+        Range of intensities in the input images
+    nThreads
+        Number of threads which share each chunk
+    warp
+        Warp the images (only rescale them if False, e.g., when the Warper
+        already warps the window)
+    """
+
+    dtype = np.dtype(dtype)
+    if dtype not in (np.dtype(np.float32), np.dtype(np.uint8)):
+        raise Exception(f'{dtype} is an invalid data type for warped images')
+
+    #
+    if isinstance(images, np.ndarray):
+        chunks = (images[start: start + chunkSize] for start in range(0, images.shape[0], chunkSize))
+    else:
+        def _collect():
+            chunk = list()
+            for image in images:
+                chunk.append(image)
+                if len(chunk) == chunkSize:
+                    yield np.stack(chunk)
+                    chunk = list()
+            if len(chunk) != 0:
+                yield np.stack(chunk)
+        chunks = _collect()
+
+    #
+    executor = ThreadPoolExecutor(nThreads) if nThreads > 1 else None
+    try:
+        for chunk in chunks:
+            warpMap = getWarpMap(chunk.shape[-2:]) if warp else None
+            out = np.empty(chunk.shape, dtype=dtype)
+            if executor is None:
+                _warpAndRescaleChunk(chunk, out, warpMap, inRange)
+            else:
+                bounds = np.linspace(0, chunk.shape[0], nThreads + 1).astype(int)
+                futures = [
+                    executor.submit(_warpAndRescaleChunk, chunk[start: stop], out[start: stop], warpMap, inRange)
+                        for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start
+                ]
+                for future in futures:
+                    future.result()
+            yield out
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    return
+
+def warpStack(images, chunkSize=64, dtype=np.float32, inRange=(0, 255), nThreads=1, warp=True):
+    """
+    Warp and rescale a stack (or any iterable) of images
+
+    returns
+    -------
+    warped
+        Array with shape (nImages, height, width)
+    """
+
+    chunks = list(iterateWarpedChunks(images, chunkSize, dtype, inRange, nThreads, warp))
+    if len(chunks) == 0:
+        return np.empty([0, 0, 0], dtype=dtype)
+    warped = np.concatenate(chunks, axis=0)
+
+    return warped
+
+class IncrementalPiecewiseWarp():
+    """
+    Piecewise affine warp which only recomputes the triangles around the
+    nodes that move
+
+    The triangulation of the source coordinates is fixed, so moving a
+    destination node only changes the affine maps of the triangles which
+    share it, and only the pixels covered by those triangles (before and
+    after the move) are sampled again. The output can be computed at a lower
+    resolution than the image for interactive previews.
+    """
+
+    def __init__(self, image, src, dst, scale=1, cval=0):
+        """
+        keywords
+        --------
+        image
+            The image to warp
+        src
+            Source coordinates of the nodes (x, y in pixels)
+        dst
+            Destination coordinates of the nodes (x, y in pixels)
+        scale
+            Resolution of the output relative to the image
+        cval
+            Value used for pixels outside of the mesh
+        """
+
+        self._image = np.asarray(image, dtype=float)
+        self._src = np.array(src, dtype=float)
+        self._dst = np.array(dst, dtype=float)
+        if self._src.shape != self._dst.shape:
+            raise Exception('Source and destination coordinates do not match')
+        self._simplices = Delaunay(self._src).simplices
+        self._cval = cval
+
+        # Pixel centers of the output in the coordinates of the image
+        height, width = self._image.shape
+        self._shape = (
+            max(1, int(round(height * scale))),
+            max(1, int(round(width * scale)))
+        )
+        self._rows = (np.arange(self._shape[0]) + 0.5) * (height / self._shape[0]) - 0.5
+        self._columns = (np.arange(self._shape[1]) + 0.5) * (width / self._shape[1]) - 0.5
+
+        #
+        self._matrices = np.zeros([self._simplices.shape[0], 3, 2])
+        self._owner = np.full(self._shape, -1, dtype=int)
+        self._warped = np.full(self._shape, cval, dtype=float)
+        allSimplices = np.arange(self._simplices.shape[0])
+        self._estimate(allSimplices)
+        self._rasterize(allSimplices)
+        self._sample(np.full(self._shape, True))
+
+        return
+
+    def _estimate(self, simplexIndices):
+        """
+        Compute the affine maps from destination to source coordinates
+        """
+
+        vertices = self._dst[self._simplices[simplexIndices]]
+        A = np.concatenate([vertices, np.ones([vertices.shape[0], 3, 1])], axis=2)
+        self._matrices[simplexIndices] = np.linalg.pinv(A) @ self._src[self._simplices[simplexIndices]]
+
+        return
+
+    def _rasterize(self, simplexIndices):
+        """
+        Assign the pixels inside each triangle to it and return the mask of
+        assigned pixels
+        """
+
+        assigned = np.full(self._shape, False)
+        for simplexIndex in simplexIndices:
+            (x1, y1), (x2, y2), (x3, y3) = self._dst[self._simplices[simplexIndex]]
+            row1, row2 = np.searchsorted(self._rows, [min(y1, y2, y3), max(y1, y2, y3)], side='left')
+            col1, col2 = np.searchsorted(self._columns, [min(x1, x2, x3), max(x1, x2, x3)], side='left')
+            row2, col2 = row2 + 1, col2 + 1
+            if row1 >= self._shape[0] or col1 >= self._shape[1]:
+                continue
+
+            # Barycentric coordinates
+            determinant = (y2 - y3) * (x1 - x3) + (x3 - x2) * (y1 - y3)
+            if determinant == 0:
+                continue
+            x, y = np.meshgrid(self._columns[col1: col2], self._rows[row1: row2])
+            l1 = ((y2 - y3) * (x - x3) + (x3 - x2) * (y - y3)) / determinant
+            l2 = ((y3 - y1) * (x - x3) + (x1 - x3) * (y - y3)) / determinant
+            inside = np.logical_and.reduce([l1 >= -1e-9, l2 >= -1e-9, 1 - l1 - l2 >= -1e-9])
+
+            #
+            self._owner[row1: row2, col1: col2][inside] = simplexIndex
+            assigned[row1: row2, col1: col2] |= inside
+
+        return assigned
+
+    def _sample(self, mask):
+        """
+        Sample the image for the pixels in the mask
+        """
+
+        rows, columns = np.nonzero(mask)
+        owner = self._owner[rows, columns]
+        valid = owner >= 0
+        self._warped[rows[np.invert(valid)], columns[np.invert(valid)]] = self._cval
+
+        #
+        rows, columns, owner = rows[valid], columns[valid], owner[valid]
+        x, y = self._columns[columns], self._rows[rows]
+        M = self._matrices[owner]
+        xs = x * M[:, 0, 0] + y * M[:, 1, 0] + M[:, 2, 0]
+        ys = x * M[:, 0, 1] + y * M[:, 1, 1] + M[:, 2, 1]
+        self._warped[rows, columns] = map_coordinates(
+            self._image,
+            [ys, xs],
+            order=1,
+            mode='constant',
+            cval=self._cval
+        )
+
+        return
+
+    def setDestination(self, dst):
+        """
+        Move any nodes whose destination coordinates changed and return the
+        mask of updated pixels
+        """
+
+        dst = np.asarray(dst, dtype=float)
+        if dst.shape != self._dst.shape:
+            raise Exception('Nodes cannot be added or removed from an incremental warp')
+        moved = np.flatnonzero(np.any(dst != self._dst, axis=1))
+        if moved.size == 0:
+            return np.full(self._shape, False)
+
+        #
+        affected = np.flatnonzero(np.isin(self._simplices, moved).any(axis=1))
+        updated = np.isin(self._owner, affected)
+        self._owner[updated] = -1
+        self._dst[moved] = dst[moved]
+        self._estimate(affected)
+        updated |= self._rasterize(affected)
+        self._sample(updated)
+
+        return updated
+
+    def moveNode(self, index, position):
+        """
+        Move a single node
+        """
+
+        dst = np.copy(self._dst)
+        dst[index] = position
+
+        return self.setDestination(dst)
+
+    def mapToSource(self, points):
+        """
+        Map destination coordinates onto source coordinates
+
+        Points outside of the mesh are mapped with the affine map of the
+        triangle with the closest centroid
+        """
+
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        vertices = self._dst[self._simplices]
+
+        # Barycentric coordinates of each point in each triangle
+        (x1, y1), (x2, y2), (x3, y3) = np.moveaxis(vertices, 1, 0).transpose(0, 2, 1)
+        x, y = points[:, 0:1], points[:, 1:2]
+        determinant = (y2 - y3) * (x1 - x3) + (x3 - x2) * (y1 - y3)
+        determinant[determinant == 0] = np.nan
+        l1 = ((y2 - y3) * (x - x3) + (x3 - x2) * (y - y3)) / determinant
+        l2 = ((y3 - y1) * (x - x3) + (x1 - x3) * (y - y3)) / determinant
+        inside = np.logical_and.reduce([l1 >= -1e-9, l2 >= -1e-9, 1 - l1 - l2 >= -1e-9])
+
+        #
+        distances = np.linalg.norm(points[:, None, :] - vertices.mean(axis=1)[None, :, :], axis=2)
+        owner = np.where(inside.any(axis=1), inside.argmax(axis=1), distances.argmin(axis=1))
+        M = self._matrices[owner]
+        mapped = np.column_stack([
+            points[:, 0] * M[:, 0, 0] + points[:, 1] * M[:, 1, 0] + M[:, 2, 0],
+            points[:, 0] * M[:, 0, 1] + points[:, 1] * M[:, 1, 1] + M[:, 2, 1],
+        ])
+
+        return mapped
+
+    @property
+    def warped(self):
+        return self._warped
+
+    @property
+    def extent(self):
+        height, width = self._image.shape
+        return (-0.5, width - 0.5, height - 0.5, -0.5)
+
 class WarpedNumPyArrayStim():
     """
     Uses PsychoPy's ImageStim class to present warped NumPy arrays
@@ -138,15 +1109,28 @@ class WarpedNumPyArrayStim():
     def array(self, value):
         """
         Warp and rescale the target image/array
+
+        The array is only rescaled if the display warps the window on the GPU
+        (see WarpedWindow.gpuWarping), so it is never warped twice
         """
 
-        warped = warp(value).astype(np.float64)
-        rescaled = exp.rescale_intensity(warped, in_range=(0, 255), out_range=(-1, 1))
-        self._heart.image = rescaled
+        self.warped = warpStack(np.asarray(value)[np.newaxis], dtype=np.float32, warp=not self.gpuWarping)[0]
         self._array = value
 
         return
 
+    @warped.setter
+    def warped(self, value):
+        """
+        Present an image which was already warped and rescaled (see warpStack,
+        which should only warp if the display does not, i.e., warp=not gpuWarping)
+        """
+
+        self._heart.image = value
+        self._array = None
+
+        return
+
     @property
     def heart(self):
         return self._heart
@@ -155,10 +1139,17 @@ class WarpedNumPyArrayStim():
     def display(self):
         return self._display
 
+    @property
+    def gpuWarping(self):
+        return getattr(self._display, 'gpuWarping', False)
+
 class SignaledAndWarpedStim(WarpedNumPyArrayStim):
     """
     Extension of the WarpedNumPyArrayStim class which lets you signal low or
     high states over a small subregion of the display
+
+    The signal patch is composited in place on a persistent buffer, and the
+    texture is only updated when the image or the state changes
     """
 
     def __init__(
@@ -170,19 +1161,27 @@ class SignaledAndWarpedStim(WarpedNumPyArrayStim):
         """
         """
 
+        #
+        self._buffer = None
+        self._unsignaled = None
+        self._composited = None
+        self._stale = True
+
         super().__init__(display)
 
-        #
-        unwarped = np.full([self.display.height, self.display.width], False).astype(bool)
+        # The masks go through the same warp as the image (none on the GPU path)
+        unwarped = np.full([2, self.display.height, self.display.width], False).astype(bool)
         x, y, w, h = subregion
         row1, row2 = y, y + h
         col1, col2 = int(self.display.width / 2) + x, int(self.display.width / 2) + x + w
-        unwarped[row1: row2, col1: col2] = True
-        self._subregion = warp(unwarped.astype(float)).astype(bool)
-
-        #
-        unwarped = np.full([self.display.height, self.display.width], 1)
-        self._region = warp(unwarped.astype(float)).astype(bool)
+        unwarped[0, row1: row2, col1: col2] = True
+        unwarped[1] = True
+        if self.gpuWarping:
+            masks = unwarped
+        else:
+            masks = getWarpMap((self.display.height, self.display.width)).apply(unwarped.astype(np.float32)).astype(bool)
+        self._subregion = masks[0]
+        self._region = masks[1]
         self._region[self.subregion] = False
 
         #
@@ -194,21 +1193,39 @@ class SignaledAndWarpedStim(WarpedNumPyArrayStim):
         """
         """
 
-        swap = np.copy(self._heart.image)
-
-        if self.state:
-            swap[self.subregion] =  1
-        elif self.state is False:
-            swap[self.subregion] = -1
-        else:
-            pass
+        if self._buffer is None:
+            self._buffer = np.full([self.display.height, self.display.width], -1, dtype=np.float32)
+            self._unsignaled = self._buffer[self.subregion]
+            self._stale = True
 
-        self._heart.image = swap
+        #
+        if self._stale or self._composited is not self.state:
+            if self.state:
+                self._buffer[self.subregion] =  1
+            elif self.state is False:
+                self._buffer[self.subregion] = -1
+            else:
+                self._buffer[self.subregion] = self._unsignaled
+            self._heart.image = self._buffer
+            self._composited = self.state
+            self._stale = False
 
         super().draw()
 
         return
 
+    @WarpedNumPyArrayStim.warped.setter
+    def warped(self, value):
+        """
+        """
+
+        self._buffer = np.array(value, dtype=np.float32)
+        self._unsignaled = self._buffer[self.subregion]
+        self._stale = True
+        self._array = None
+
+        return
+
     @property
     def subregion(self):
         return self._subregion
@@ -1,5 +1,9 @@
+import os
+import json
+import subprocess as sp
 import cv2 as cv
 import numpy as np
+import pathlib as pl
 import skvideo.io as io
 
 class VideoWriterOpenCV():
@@ -31,13 +35,14 @@ class VideoWriterOpenCV():
         """
         """
 
-        stack = np.dstack([frame, frame, frame])
-
+        # The writer is opened in grayscale mode, so single-channel frames are written as is
+        if self._writer is None:
+            return
+        if frame.ndim == 3:
+            frame = frame[:, :, 0]
         if self._vflip:
-            stack = cv.flip(stack, 0)
-
-        if self._writer is not None:
-            self._writer.write(stack)
+            frame = cv.flip(frame, 0)
+        self._writer.write(np.ascontiguousarray(frame, dtype=np.uint8))
 
         return
 
@@ -54,7 +59,7 @@ class VideoWriterSkvideo():
     """
     """
 
-    def __init__(self, filename=None, shape=(720, 1280), fps=60, crf=17, vflip=False):
+    def __init__(self, filename=None, shape=(720, 1280), fps=60, crf=17, vflip=False, gop=None):
         """
         """
 
@@ -78,6 +83,8 @@ class VideoWriterSkvideo():
         #
         if vflip:
             odct['-vf'] = f'vflip'
+        if gop is not None:
+            odct['-g'] = f'{gop}'
 
         self._writer = io.FFmpegWriter(
             filename,
@@ -103,4 +110,424 @@ class VideoWriterSkvideo():
         if self._writer is not None:
             self._writer.close()
 
-        return
\ No newline at end of file
+        return
+
+class VideoWriterGrayscale():
+    """
+    Pipes single-channel frames directly into ffmpeg as raw gray video
+
+    Frames are written from a reusable contiguous buffer (or directly from
+    the frame if it is already a contiguous uint8 array), and the vertical
+    flip is done by the encoder
+    """
+
+    def __init__(self, filename=None, shape=(720, 1280), fps=60, crf=17, vflip=False, gop=None, ffmpeg='ffmpeg'):
+        """
+        """
+
+        if filename is None:
+            self._process = None
+            return
+
+        height, width = shape
+        command = [
+            ffmpeg, '-y', '-loglevel', 'error',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'gray',
+            '-s', f'{width}x{height}',
+            '-r', f'{fps}',
+            '-i', '-',
+            '-c:v', 'libx264',
+            '-crf', f'{crf}',
+            '-preset', 'ultrafast',
+            '-pix_fmt', 'yuv420p',
+        ]
+        if vflip:
+            command.extend(['-vf', 'vflip'])
+        if gop is not None:
+            command.extend(['-g', f'{gop}'])
+        command.append(str(filename))
+
+        #
+        self._buffer = np.empty(shape, dtype=np.uint8)
+        self._process = sp.Popen(command, stdin=sp.PIPE)
+
+        return
+
+    def write(self, frame):
+        """
+        """
+
+        if self._process is None:
+            return
+
+        # Only the first channel of color frames is kept
+        if frame.ndim == 3:
+            frame = frame[:, :, 0]
+        if frame.dtype != np.uint8 or not frame.flags['C_CONTIGUOUS']:
+            np.copyto(self._buffer, frame, casting='unsafe')
+            frame = self._buffer
+        self._process.stdin.write(memoryview(frame))
+
+        return
+
+    def close(self):
+        """
+        """
+
+        if self._process is not None:
+            self._process.stdin.close()
+            self._process.wait()
+            self._process = None
+
+        return
+
+    @property
+    def buffer(self):
+        return self._buffer
+
+class SegmentedVideoWriter():
+    """
+    Splits a long recording into a folder of shorter videos
+
+    Every segment is an independent file which starts on a keyframe, and the
+    manifest (rewritten each time a segment is closed) maps global frame
+    indices to segments, so a crash only loses the current segment and
+    segments can be decoded in parallel
+    """
+
+    def __init__(
+        self,
+        folder,
+        shape=(720, 1280),
+        fps=60,
+        crf=17,
+        vflip=False,
+        segmentDuration=300,
+        segmentLength=None,
+        grayscale=False,
+        ):
+        """
+        keywords
+        --------
+        folder
+            Folder which will contain the segments and the manifest
+        segmentDuration
+            Duration of each segment (in seconds)
+        segmentLength
+            Number of frames in each segment (overrides the segment duration)
+        grayscale
+            Write single-channel frames (see VideoWriterGrayscale)
+        """
+
+        if segmentLength is None:
+            segmentLength = int(round(segmentDuration * fps))
+        if segmentLength < 1:
+            raise Exception('Segments must contain at least one frame')
+
+        #
+        self._folder = pl.Path(folder)
+        self._folder.mkdir(parents=True, exist_ok=True)
+        self._shape = shape
+        self._fps = fps
+        self._crf = crf
+        self._vflip = vflip
+        self._segmentLength = segmentLength
+        self._grayscale = grayscale
+        self._segments = list()
+        self._writer = None
+        self._frameIndex = 0
+
+        return
+
+    def _openSegment(self):
+        """
+        """
+
+        filename = self._folder.joinpath(f'segment-{len(self._segments) + 1}.mp4')
+        writerClass = VideoWriterGrayscale if self._grayscale else VideoWriterSkvideo
+        self._writer = writerClass(
+            str(filename),
+            self._shape,
+            self._fps,
+            self._crf,
+            self._vflip,
+            gop=self._segmentLength
+        )
+        self._segments.append({
+            'filename': filename.name,
+            'firstFrame': self._frameIndex,
+            'nFrames': 0
+        })
+
+        return
+
+    def _closeSegment(self):
+        """
+        """
+
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._writeManifest()
+
+        return
+
+    def _writeManifest(self):
+        """
+        """
+
+        manifest = {
+            'fps': self._fps,
+            'shape': list(self._shape),
+            'segmentLength': self._segmentLength,
+            'nFrames': self._frameIndex,
+            'segments': self._segments
+        }
+        filename = self._folder.joinpath('manifest.json')
+        temporary = filename.with_suffix('.tmp')
+        with open(temporary, 'w') as stream:
+            json.dump(manifest, stream, indent=4)
+        os.replace(temporary, filename)
+
+        return
+
+    def write(self, array):
+        """
+        """
+
+        if self._writer is None:
+            self._openSegment()
+        self._writer.write(array)
+        self._segments[-1]['nFrames'] += 1
+        self._frameIndex += 1
+
+        # Roll over to the next segment
+        if self._segments[-1]['nFrames'] == self._segmentLength:
+            self._closeSegment()
+
+        return
+
+    def close(self):
+        """
+        """
+
+        self._closeSegment()
+
+        return
+
+    @property
+    def folder(self):
+        return self._folder
+
+def readSegmentManifest(folder):
+    """
+    Load the manifest of a segmented recording
+    """
+
+    with open(pl.Path(folder).joinpath('manifest.json'), 'r') as stream:
+        manifest = json.load(stream)
+
+    return manifest
+
+def locateFrames(manifest, frameIndices):
+    """
+    Map global frame indices to segments
+
+    returns
+    -------
+    filenames
+        Filename of the segment which contains each frame
+    localIndices
+        Index of each frame within its segment
+    """
+
+    frameIndices = np.asarray(frameIndices).flatten()
+    firstFrames = np.array([segment['firstFrame'] for segment in manifest['segments']])
+    if np.any(frameIndices < 0) or np.any(frameIndices >= manifest['nFrames']):
+        raise Exception('Frame index out of range')
+
+    #
+    segmentIndices = np.searchsorted(firstFrames, frameIndices, side='right') - 1
+    filenames = np.array([segment['filename'] for segment in manifest['segments']])[segmentIndices]
+    localIndices = frameIndices - firstFrames[segmentIndices]
+
+    return filenames, localIndices
+
+# Record layout of the frame sidecar
+SIDECAR_DTYPE = np.dtype([
+    ('frameIndex', '<u4'),
+    ('timestamp' , '<f8'),
+    ('state'     , 'u1' ),
+    ('code'      , '<i2'),
+])
+
+class FrameSidecarWriter():
+    """
+    Writes a binary record (frame index, flip timestamp, signal-patch state,
+    and event code) for each frame of a recorded video
+
+    Records have a fixed size, so the record for any frame can be read
+    without scanning the file (see readFrameSidecar)
+    """
+
+    def __init__(self, filename=None, bufferSize=600, dtype=SIDECAR_DTYPE):
+        """
+        """
+
+        if filename is None:
+            self._stream = None
+            return
+
+        self._stream = open(str(filename), 'wb')
+        self._buffer = np.zeros(bufferSize, dtype=dtype)
+        self._count = 0
+
+        return
+
+    def write(self, frameIndex, timestamp, state=False, code=0):
+        """
+        """
+
+        self.writeRecord((frameIndex, timestamp, state, code))
+
+        return
+
+    def writeRecord(self, record):
+        """
+        """
+
+        if self._stream is None:
+            return
+
+        self._buffer[self._count] = record
+        self._count += 1
+        if self._count == self._buffer.size:
+            self.flush()
+
+        return
+
+    def flush(self):
+        """
+        """
+
+        if self._stream is not None and self._count != 0:
+            self._buffer[:self._count].tofile(self._stream)
+            self._stream.flush()
+            self._count = 0
+
+        return
+
+    def close(self):
+        """
+        """
+
+        if self._stream is not None:
+            self.flush()
+            self._stream.close()
+            self._stream = None
+
+        return
+
+def readFrameSidecar(filename):
+    """
+    Memory-map the records of a frame sidecar
+    """
+
+    records = np.memmap(str(filename), dtype=SIDECAR_DTYPE, mode='r')
+
+    return records
+
+def findFramesAroundEvents(records, code=None, window=(-30, 30)):
+    """
+    Find the frames around each event in a frame sidecar
+
+    keywords
+    --------
+    records
+        Records returned by readFrameSidecar
+    code
+        Event code to look for (any event if None)
+    window
+        Number of frames before and after each event
+
+    returns
+    -------
+    frameIndices
+        Array with shape (nEvents, nFrames) of frame indices (-1 outside of the video)
+    """
+
+    if code is None:
+        eventIndices = np.flatnonzero(records['code'] != 0)
+    else:
+        eventIndices = np.flatnonzero(records['code'] == code)
+
+    #
+    offsets = np.arange(window[0], window[1] + 1)
+    indices = eventIndices.reshape(-1, 1) + offsets
+    frameIndices = np.where(
+        np.logical_and(indices >= 0, indices < records.size),
+        records['frameIndex'][np.clip(indices, 0, max(records.size - 1, 0))].astype(np.int64),
+        -1
+    )
+
+    return frameIndices
+
+# Record layout of the stimulus state log
+STATE_DTYPE = np.dtype([
+    ('frameIndex', '<u4'),
+    ('timestamp' , '<f8'),
+    ('background', '<f4'),
+    ('patch'     , 'u1' ),
+    ('kind'      , 'u1' ),
+    ('sf'        , '<f4'),
+    ('ori'       , '<f4'),
+    ('phase'     , '<f4'),
+    ('contrast'  , '<f4'),
+    ('x'         , '<f4'),
+    ('y'         , '<f4'),
+    ('size'      , '<f4'),
+    ('fieldIndex', '<i4'),
+    ('value'     , '<f4'),
+])
+
+# Codes for the kind of stimulus drawn on each frame
+STATE_KINDS = {
+    None     : 0,
+    'grating': 1,
+    'bar'    : 2,
+    'spot'   : 3,
+    'field'  : 4,
+}
+
+class StateLogWriter(FrameSidecarWriter):
+    """
+    Records the state of the stimulus on each frame instead of its pixels
+
+    The geometry of the display is stored in a small header next to the log
+    so that frames can be reconstructed offline (see rendering.renderStateLog)
+    """
+
+    def __init__(self, filename=None, header=None, bufferSize=600):
+        """
+        """
+
+        super().__init__(filename, bufferSize, STATE_DTYPE)
+        if filename is None:
+            return
+
+        with open(pl.Path(filename).with_suffix('.json'), 'w') as stream:
+            json.dump(header if header is not None else dict(), stream, indent=4)
+
+        return
+
+def readStateLog(filename):
+    """
+    Load the header and memory-map the records of a stimulus state log
+    """
+
+    with open(pl.Path(filename).with_suffix('.json'), 'r') as stream:
+        header = json.load(stream)
+    records = np.memmap(str(filename), dtype=STATE_DTYPE, mode='r')
+
+    return header, records